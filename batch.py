@@ -0,0 +1,676 @@
+from array import array
+from util import *
+from logical_classes import *
+from student_code import InferenceEngine
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def variables(statement):
+    """Variable names of a statement, in order of first appearance
+    """
+    names = []
+    for term in statement.terms:
+        if is_var(term) and term.term.element not in names:
+            names.append(term.term.element)
+    return names
+
+class JoinPlan(object):
+    """Premises of an asserted rule compiled into a left-deep chain of joins.
+        Matching premise k binds its variables, and only the variables still
+        used by later premises or the RHS are carried on, so the rules
+        curried from the asserted rule after k premises are exactly the
+        distinct carried bindings at depth k. Each depth has a TokenTable of
+        those rules, joined with the fact table of its premise.
+
+    Attributes:
+        rule (Rule): the asserted rule
+        premises (listof Statement): its LHS statements
+        rhs (Statement): its RHS statement
+        tables (listof tuple): (predicate, arity) of each premise
+        carried (listof listof str): variables bound before each premise and
+            still needed from it on, plus those needed by the RHS at the end
+        constants (listof tuple): (position, symbol id) pairs of each premise
+        repeats (listof tuple): (position, earlier position) pairs of each
+            premise that must hold the same symbol
+        joins (listof tuple): (position, carried column) pairs of each premise
+            that must hold the symbol bound to a carried variable
+        outputs (listof list): for each premise, where each variable carried
+            past it is read from: (0, carried column) or (1, fact position)
+        slots (listof listof list): for each depth, the (position, carried
+            column) pairs of the remaining premises and RHS to substitute
+        locations (listof list): for each depth, the (statement, position)
+            each carried variable is read from in a curried rule
+        levels (listof TokenTable): rules waiting on each premise
+    """
+    def __init__(self, rule):
+        """Constructor for JoinPlan
+
+        Args:
+            rule (Rule): asserted rule to compile
+        """
+        super(JoinPlan, self).__init__()
+        self.rule = rule
+        self.premises = list(rule.lhs)
+        self.rhs = rule.rhs
+        statements = self.premises + [self.rhs]
+        needed = [set() for _ in statements]
+        later = set()
+        for depth in range(len(statements) - 1, -1, -1):
+            later.update(variables(statements[depth]))
+            needed[depth] = set(later)
+        self.carried = [[]]
+        bound = []
+        for depth, premise in enumerate(self.premises):
+            bound += [name for name in variables(premise) if name not in bound]
+            self.carried.append([name for name in bound if name in needed[depth + 1]])
+        self.tables = []
+        self.constants = []
+        self.repeats = []
+        self.joins = []
+        self.outputs = []
+        for depth, premise in enumerate(self.premises):
+            columns = dict((name, col) for col, name in enumerate(self.carried[depth]))
+            constants, repeats, joins, first = [], [], [], {}
+            for pos, term in enumerate(premise.terms):
+                if not is_var(term):
+                    constants.append((pos, term.term.id))
+                elif term.term.element in first:
+                    repeats.append((pos, first[term.term.element]))
+                else:
+                    first[term.term.element] = pos
+                    if term.term.element in columns:
+                        joins.append((pos, columns[term.term.element]))
+            self.tables.append((premise.predicate, len(premise.terms)))
+            self.constants.append(tuple(constants))
+            self.repeats.append(tuple(repeats))
+            self.joins.append(tuple(joins))
+            self.outputs.append([(0, columns[name]) if name in columns else (1, first[name])
+                                 for name in self.carried[depth + 1]])
+        self.slots = []
+        self.locations = []
+        for depth in range(len(statements)):
+            columns = dict((name, col) for col, name in enumerate(self.carried[depth]))
+            slots = [[(pos, columns[term.term.element]) for pos, term in enumerate(statement.terms)
+                      if is_var(term) and term.term.element in columns]
+                     for statement in statements[depth:]]
+            locations = dict()
+            for index, statement_slots in enumerate(slots):
+                for pos, col in statement_slots:
+                    locations.setdefault(col, (index, pos))
+            self.slots.append(slots)
+            self.locations.append([locations[col] for col in range(len(columns))])
+        self.levels = [TokenTable(self, depth) for depth in range(len(self.premises))]
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'JoinPlan({!r}, {!r} rules)'.format(
+                self.tables, [len(tokens) for tokens in self.levels])
+
+    def read(self, rule, depth):
+        """Symbols a rule curried from the asserted rule after depth premises
+            binds to the carried variables, checking that the rule is the one
+            build would make of them
+
+        Args:
+            rule (Rule): curried rule
+            depth (int): number of premises matched
+
+        Returns:
+            tupleof int|None: symbol ids, None if the rule does not follow the
+                remaining premises, e.g. a carried variable is bound to a
+                variable or the other terms differ (the rule was curried from
+                a fact with variables)
+        """
+        values = [None] * len(self.carried[depth])
+        for template, statement, slots in zip((self.premises + [self.rhs])[depth:],
+                                              rule.lhs + [rule.rhs], self.slots[depth]):
+            if (statement.predicate != template.predicate
+                    or len(statement.terms) != len(template.terms)):
+                return None
+            terms = statement.terms
+            for pos, col in slots:
+                if is_var(terms[pos]) or values[col] not in (None, terms[pos].term.id):
+                    return None
+                values[col] = terms[pos].term.id
+            carried = set(pos for pos, col in slots)
+            for pos, term in enumerate(template.terms):
+                if pos not in carried and terms[pos].term.id != term.term.id:
+                    return None
+        return tuple(values)
+
+    def build(self, depth, values):
+        """Statements left once depth premises are matched with the given
+            carried symbols: the remaining premises, then the RHS
+
+        Args:
+            depth (int): number of premises matched
+            values (tupleof int): symbol ids of the carried variables
+
+        Returns:
+            listof Statement
+        """
+        statements = []
+        shared = symbols.terms
+        for statement, slots in zip((self.premises + [self.rhs])[depth:], self.slots[depth]):
+            terms = [statement.predicate] + statement.terms
+            for pos, col in slots:
+                # symbols read from facts already have their shared term
+                terms[pos + 1] = shared[values[col]] or symbols.term(symbols.name_of(values[col]))
+            statements.append(Statement(terms))
+        return statements
+
+class TokenTable(object):
+    """Rules waiting on one premise of a JoinPlan: the asserted rule at depth
+        0, the rules curried from it after depth premises otherwise. Like
+        FactTable, rules are rows of symbol columns, here the symbols bound
+        to the carried variables, with an index on the symbols the premise
+        joins on. Rules that are not what the plan builds from their
+        symbols, e.g. curried from facts with variables, cannot be joined
+        on symbols and are kept apart as wild rules.
+
+    Attributes:
+        plan (JoinPlan): plan of the rules
+        depth (int): index of the premise they wait on
+        rules (listof Rule|None): rule of each row, None once removed
+        columns (listof array): symbol ids of each carried variable, one per row
+        slot_of (dictof int): maps each rule to its row
+        by_key (dictof int): maps the symbols of a row to the row
+        index (dictof dict): maps the symbols at the join columns to an
+            insertion-ordered set (dict with None values) of rows
+        wild (dictof None): insertion-ordered set of the wild rules
+    """
+    def __init__(self, plan, depth):
+        """Constructor for TokenTable
+
+        Args:
+            plan (JoinPlan): plan of the rules
+            depth (int): index of the premise they wait on
+        """
+        super(TokenTable, self).__init__()
+        self.plan = plan
+        self.depth = depth
+        self.rules = []
+        self.columns = [array('l') for _ in plan.carried[depth]]
+        self.slot_of = {}
+        self.by_key = {}
+        self.index = {}
+        self.wild = {}
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'TokenTable({!r}, {!r} rules)'.format(self.depth, len(self))
+
+    def __len__(self):
+        """Define behavior of len, i.e. the number of rules in the table
+        """
+        return len(self.slot_of) + len(self.wild)
+
+    def join_key(self, values):
+        """Symbols of a row at the columns its premise joins on
+        """
+        return tuple(values[col] for pos, col in self.plan.joins[self.depth])
+
+    def values(self, slot):
+        """Symbols of a row
+        """
+        return tuple(column[slot] for column in self.columns)
+
+    def add(self, rule, values):
+        """Add a rule as a new row, or as a wild rule when values is None
+        """
+        if values is None:
+            self.wild[rule] = None
+            return
+        slot = self.slot_of[rule] = len(self.rules)
+        self.rules.append(rule)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        self.by_key[values] = slot
+        self.index.setdefault(self.join_key(values), {})[slot] = None
+
+    def remove(self, rule):
+        """Empty the row of a rule, compacting the table once more than half
+            of it is empty
+        """
+        if rule in self.wild:
+            del self.wild[rule]
+            return
+        slot = self.slot_of.pop(rule, None)
+        if slot is None:
+            return
+        self.rules[slot] = None
+        values = self.values(slot)
+        if self.by_key.get(values) == slot:
+            del self.by_key[values]
+        key = self.join_key(values)
+        bucket = self.index[key]
+        del bucket[slot]
+        if not bucket:
+            del self.index[key]
+        if len(self.rules) > 2 * len(self.slot_of) + 16:
+            self.compact()
+
+    def compact(self):
+        """Rebuild the table from its remaining rules, in order
+        """
+        rows = [(rule, self.values(slot)) for slot, rule in enumerate(self.rules) if rule is not None]
+        wild = self.wild
+        self.__init__(self.plan, self.depth)
+        self.wild = wild
+        for rule, values in rows:
+            self.add(rule, values)
+
+def gather(column, rows):
+    """Symbols of a column at the given rows: an int64 NumPy array, or a
+        list without NumPy
+    """
+    if np is None:
+        return [column[row] for row in rows]
+    if not len(rows) or not len(column):
+        return np.zeros(0, dtype=np.int64)
+    # copy out of the array buffer, so the column can grow again at once
+    view = np.frombuffer(column, dtype=np.dtype('l'))
+    values = view[rows].astype(np.int64)
+    del view
+    return values
+
+def select(table, rows, constants, repeats):
+    """Rows of a fact table holding the given symbols at the given positions
+        and the same symbol at each pair of repeated positions
+    """
+    if not constants and not repeats:
+        return rows
+    columns = table.columns
+    if np is None:
+        return [row for row in rows
+                if all(columns[pos][row] == symbol for pos, symbol in constants)
+                and all(columns[pos][row] == columns[first][row] for pos, first in repeats)]
+    keep = np.ones(len(rows), dtype=bool)
+    for pos, symbol in constants:
+        keep &= gather(columns[pos], rows) == symbol
+    for pos, first in repeats:
+        keep &= gather(columns[pos], rows) == gather(columns[first], rows)
+    return rows[keep]
+
+def join(left, right, sizes):
+    """Equi-join of two relations given as lists of key columns. Uses NumPy
+        sort-merge joins when NumPy is installed, a hash join otherwise.
+
+    Args:
+        left (listof array): key columns of the left relation
+        right (listof array): key columns of the right relation, as many
+        sizes ((int, int)): number of rows of each relation
+
+    Returns:
+        (array, array): left and right row of every pair with equal keys
+    """
+    if np is None:
+        by_key = {}
+        for i, key in enumerate(zip(*left) if left else [()] * sizes[0]):
+            by_key.setdefault(key, []).append(i)
+        pairs = [(i, j) for j, key in enumerate(zip(*right) if right else [()] * sizes[1])
+                 for i in by_key.get(key, ())]
+        return [i for i, j in pairs], [j for i, j in pairs]
+    if not sizes[0] or not sizes[1]:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if not left:
+        return (np.tile(np.arange(sizes[0]), sizes[1]),
+                np.repeat(np.arange(sizes[1]), sizes[0]))
+    if len(left) == 1:
+        left_keys, right_keys = left[0], right[0]
+    else:
+        # number the distinct key tuples, so the merge is on one integer
+        stacked = np.concatenate((np.stack(left, axis=1), np.stack(right, axis=1)))
+        codes = np.unique(stacked, axis=0, return_inverse=True)[1].reshape(-1)
+        left_keys, right_keys = codes[:sizes[0]], codes[sizes[0]:]
+    order = np.argsort(left_keys, kind='stable')
+    sorted_keys = left_keys[order]
+    low = np.searchsorted(sorted_keys, right_keys, side='left')
+    counts = np.searchsorted(sorted_keys, right_keys, side='right') - low
+    total = int(counts.sum())
+    starts = np.repeat(low - (np.cumsum(counts) - counts), counts)
+    return order[np.arange(total) + starts], np.repeat(np.arange(sizes[1]), counts)
+
+def distinct(columns, count):
+    """Distinct rows of a relation given as columns
+
+    Returns:
+        (listof tuple, listof int): the distinct rows, and the index among
+            them of each row
+    """
+    if not columns:
+        return [()], [0] * count
+    if np is None:
+        keys = {}
+        inverse = [keys.setdefault(key, len(keys)) for key in zip(*columns)]
+        return list(keys), inverse
+    keys, inverse = np.unique(np.stack(columns, axis=1), axis=0, return_inverse=True)
+    return [tuple(key) for key in keys.tolist()], inverse.reshape(-1).tolist()
+
+def concat(first, second):
+    """Rows of two parts of a join, one after the other
+    """
+    if np is None:
+        return list(first) + list(second)
+    return np.concatenate((np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64)))
+
+class BatchInferenceEngine(InferenceEngine):
+    """Inference engine saturating a KB in rounds, usable by KnowledgeBase in
+        place of InferenceEngine. Every asserted rule is compiled into a
+        JoinPlan, and each round joins its premises one after the other
+        over the columnar fact tables, semi-naively: at each premise, the
+        rules that were already waiting are joined with the round's new
+        facts by probing the index of their TokenTable, and the rules new
+        to it (asserted, or curried at the previous premise in this round)
+        with all its facts by NumPy sort-merge joins (a hash join without
+        NumPy), reading candidate rows from the fact postings when that is
+        smaller. Each join yields the curried rules or the inferred facts
+        as distinct rows of symbols, built once each with all their
+        supports. Curried rules join the next premise in the same round;
+        inferred facts are added together at the end of the round.
+
+        Curried rules and support links are kept as with InferenceEngine,
+        since retraction needs them, so the KB ends up with the same facts,
+        rules and supports, in a different order. Facts with variables
+        cannot be joined on symbols: while a predicate has some, premises
+        on it are matched pair by pair, as InferenceEngine does, and so are
+        the wild rules that do not follow their plan.
+
+    Attributes:
+        plans_on (dictof dict): maps (predicate, arity) to an insertion-ordered
+            set (dict with None values) of the plans with a premise on it
+        tokens_of (dictof TokenTable): the token table each rule sits in
+    """
+    def __init__(self):
+        """Constructor for BatchInferenceEngine
+        """
+        super(BatchInferenceEngine, self).__init__()
+        self.plans_on = {}
+        self.tokens_of = {}
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'BatchInferenceEngine({!r} predicates, {!r} rules)'.format(
+                len(self.plans_on), len(self.tokens_of))
+
+    def saturate(self, kb):
+        """Empty the agenda of a KB in rounds of semi-naive evaluation, every
+            fact/rule pair being joined once
+
+        Args:
+            kb (KnowledgeBase) - The KnowledgeBase to saturate
+        """
+        while kb.agenda:
+            new_facts = {}
+            new_rules = []
+            while kb.agenda:
+                fact_rule = kb.agenda.popleft()
+                if fact_rule not in kb.pending:
+                    continue
+                kb.pending.discard(fact_rule)
+                if isinstance(fact_rule, Fact):
+                    statement = fact_rule.statement
+                    key = (statement.predicate, len(statement.terms))
+                    new_facts.setdefault(key, []).append(fact_rule)
+                else:
+                    new_rules.append(fact_rule)
+            self.run_round(new_facts, new_rules, kb)
+
+    def place(self, rule):
+        """Find the token table a rule new to the engine belongs to: the next
+            one after the table of the rule it was curried from, or the first
+            table of a new plan for rules that were not curried
+
+        Returns:
+            (TokenTable, tupleof int|None): the table, and the symbols of the
+                rule's carried variables, see JoinPlan.read
+        """
+        for fact, parent in rule.supported_by:
+            tokens = self.tokens_of.get(parent)
+            if tokens is None:
+                continue
+            plan, depth = tokens.plan, tokens.depth + 1
+            if depth < len(plan.premises) and len(rule.lhs) == len(plan.premises) - depth:
+                return plan.levels[depth], plan.read(rule, depth)
+        plan = JoinPlan(rule)
+        for key in plan.tables:
+            self.plans_on.setdefault(key, {})[plan] = None
+        return plan.levels[0], ()
+
+    def add_token(self, tokens, rule, values, fresh):
+        """Add a rule to a token table, noting in fresh the first row and the
+            wild rules added to the table in this round
+        """
+        added = fresh.get(tokens)
+        if added is None:
+            added = fresh[tokens] = (len(tokens.rules), [])
+        if values is None:
+            added[1].append(rule)
+        tokens.add(rule, values)
+        self.tokens_of[rule] = tokens
+
+    def run_round(self, new_facts, new_rules, kb):
+        """Join the facts and rules of one round through every plan they
+            take part in, then add the inferred facts
+
+        Args:
+            new_facts (dictof listof Fact): new facts by (predicate, arity)
+            new_rules (listof Rule): new rules
+            kb (KnowledgeBase) - The KnowledgeBase they were added to
+        """
+        fresh = {}
+        plans = {}
+        for rule in new_rules:
+            # rules curried in bulk already joined the facts of their round
+            if rule not in self.tokens_of:
+                tokens, values = self.place(rule)
+                self.add_token(tokens, rule, values, fresh)
+                plans[tokens.plan] = None
+        for key in new_facts:
+            for plan in self.plans_on.get(key, ()):
+                plans[plan] = None
+        derived = []
+        unmatched = []
+        for plan in plans:
+            for tokens in plan.levels:
+                self.join_level(tokens, new_facts, fresh, derived, unmatched, kb)
+        stats = kb.stats
+        for fact, pairs in derived:
+            kb.kb_add(fact)
+            f = kb._get_fact(fact)
+            new = f is fact
+            for support, rule in pairs:
+                writable(support, 'supports_facts').add(f)
+                writable(rule, 'supports_facts').add(f)
+                if stats is not None:
+                    stats.fired(support, rule, f, new)
+                    new = False
+        for fact, rule in unmatched:
+            self.fc_infer(fact, rule, kb)
+
+    def join_level(self, tokens, new_facts, fresh, derived, unmatched, kb):
+        """Join the rules waiting on a premise with its facts: the rules
+            from earlier rounds with the new facts, and the rules new in this
+            round with all facts. Curried rules go straight into the next
+            token table, inferred facts are appended to derived.
+
+        Args:
+            tokens (TokenTable): rules waiting on the premise
+            new_facts (dictof listof Fact): new facts by (predicate, arity)
+            fresh (dict): first row and wild rules of each token table added
+                in this round
+            derived (listof (Fact, listof tuple)): inferred facts, with their
+                (fact, rule) supports
+            unmatched (listof (Fact, Rule)): pairs left to fc_infer, for
+                facts or rules with variables
+            kb (KnowledgeBase) - The KnowledgeBase to infer in
+        """
+        plan, depth = tokens.plan, tokens.depth
+        key = plan.tables[depth]
+        table = kb.fact_index.tables.get(key)
+        if table is None or not tokens:
+            return
+        start, new_wild = fresh.get(tokens, (len(tokens.rules), ()))
+        constants, repeats, joins = plan.constants[depth], plan.repeats[depth], plan.joins[depth]
+        new = [fact for fact in new_facts.get(key, ()) if fact in table.row_of]
+        if key[0] in kb.fact_index.nonground:
+            # facts with variables can match any symbol, so while the
+            # predicate has some every pair is matched by fc_infer
+            rules = [rule for rule in tokens.rules[start:] if rule is not None] + list(new_wild)
+            unmatched += [(fact, rule) for fact in new for rule in tokens.rules[:start] if rule is not None]
+            unmatched += [(fact, rule) for fact in new for rule in tokens.wild if rule not in new_wild]
+            unmatched += [(fact, rule) for rule in rules for fact in kb.fact_index.candidates(rule.lhs[0])]
+            return
+
+        # rules from earlier rounds with the new facts, probing the token index
+        old_slots, old_rows = [], []
+        if new and (start or len(tokens.wild) > len(new_wild)):
+            unmatched += [(fact, rule) for fact in new for rule in tokens.wild if rule not in new_wild]
+            rows = [table.row_of[fact] for fact in new]
+            if np is not None:
+                rows = np.asarray(rows, dtype=np.int64)
+            rows = select(table, rows, constants, repeats)
+            columns = [gather(table.columns[pos], rows) for pos, col in joins]
+            if np is not None:
+                rows, columns = rows.tolist(), [column.tolist() for column in columns]
+            for row, key_symbols in zip(rows, zip(*columns) if columns else [()] * len(rows)):
+                for slot in tokens.index.get(key_symbols, ()):
+                    if slot < start:
+                        old_slots.append(slot)
+                        old_rows.append(row)
+
+        # rules new in this round with every fact, by sort-merge join
+        new_slots, new_rows = [], []
+        if start < len(tokens.rules) or new_wild:
+            for rule in new_wild:
+                unmatched += [(fact, rule) for fact in kb.fact_index.candidates(rule.lhs[0])]
+            slots = [slot for slot in range(start, len(tokens.rules)) if tokens.rules[slot] is not None]
+            rows = self.candidate_rows(table, tokens, slots, constants, joins)
+            if len(table.facts) != len(table.row_of):
+                rows = [row for row in rows if table.facts[row] is not None]
+            if np is not None:
+                slots = np.asarray(slots, dtype=np.int64)
+                rows = np.asarray(rows, dtype=np.int64)
+            rows = select(table, rows, constants, repeats)
+            left, right = join([gather(tokens.columns[col], slots) for pos, col in joins],
+                               [gather(table.columns[pos], rows) for pos, col in joins],
+                               (len(slots), len(rows)))
+            if np is not None:
+                new_slots, new_rows = slots[left], rows[right]
+            else:
+                new_slots, new_rows = [slots[i] for i in left], [rows[j] for j in right]
+
+        slots = concat(old_slots, new_slots)
+        rows = concat(old_rows, new_rows)
+        if not len(slots):
+            return
+        if kb.stats is not None:
+            kb.stats.joined(plan.rule, len(slots))
+        values = [gather(tokens.columns[index], slots) if source == 0 else gather(table.columns[index], rows)
+                  for source, index in plan.outputs[depth]]
+        keys, inverse = distinct(values, len(slots))
+        supports = [[] for _ in keys]
+        rules, facts = tokens.rules, table.facts
+        for slot, row, d in zip(slots.tolist() if np is not None else slots,
+                                rows.tolist() if np is not None else rows, inverse):
+            supports[d].append((facts[row], rules[slot]))
+        if depth + 1 == len(plan.premises):
+            for values, pairs in zip(keys, supports):
+                derived.append((Fact(plan.build(depth + 1, values)[-1], pairs), pairs))
+        else:
+            self.curry(plan.levels[depth + 1], keys, supports, fresh, kb)
+
+    def candidate_rows(self, table, tokens, slots, constants, joins):
+        """Rows of a fact table that may match the premise of new rules: the
+            postings of its rarest constant, else the postings of the
+            symbols the new rules bind at the first join position when
+            there are fewer of those than facts, else every row
+        """
+        postings = table.postings
+        if constants:
+            rows = min((postings[pos].get(symbol, ()) for pos, symbol in constants), key=len)
+            return list(rows)
+        if joins:
+            pos, col = joins[0]
+            column = tokens.columns[col]
+            found = [postings[pos].get(symbol, ()) for symbol in set(column[slot] for slot in slots)]
+            if sum(len(rows) for rows in found) < len(table.facts):
+                return sorted(row for rows in found for row in rows)
+        return range(len(table.facts))
+
+    def curry(self, tokens, keys, supports, fresh, kb):
+        """Add the rules curried from the pairs of a join to the next token
+            table: rules it already holds get the new supports, the others
+            are built once with all of theirs and join in this round
+
+        Args:
+            tokens (TokenTable): token table of the next premise
+            keys (listof tuple): symbols carried by each curried rule
+            supports (listof listof tuple): (fact, rule) supports of each
+            fresh (dict): first row and wild rules of each token table added
+                in this round
+            kb (KnowledgeBase) - The KnowledgeBase to add them to
+        """
+        plan, depth, stats = tokens.plan, tokens.depth, kb.stats
+        for values, pairs in zip(keys, supports):
+            slot = tokens.by_key.get(values)
+            if slot is not None:
+                derived = tokens.rules[slot]
+                for fact, rule in pairs:
+                    writable(derived, 'supported_by').add(fact, rule)
+                new = False
+            else:
+                statements = plan.build(depth, values)
+                rule = Rule([statements[:-1], statements[-1]], pairs)
+                kb.kb_add(rule)
+                derived = kb._get_rule(rule)
+                new = derived is rule
+                if new and kb._forward_chained(derived):
+                    self.add_token(tokens, derived, values, fresh)
+            for fact, rule in pairs:
+                writable(rule, 'supports_rules').add(derived)
+                writable(fact, 'supports_rules').add(derived)
+                if stats is not None:
+                    stats.fired(fact, rule, derived, new)
+                    new = False
+
+    def restored(self, kb):
+        """Put the forward-chained rules of a KB restored from a snapshot in
+            their token tables, without joining them: the next round joins
+            them with new facts only
+
+        Args:
+            kb (KnowledgeBase) - The restored KnowledgeBase
+        """
+        for rule in kb.rules:
+            if kb._forward_chained(rule) and rule not in self.tokens_of:
+                tokens, values = self.place(rule)
+                tokens.add(rule, values)
+                self.tokens_of[rule] = tokens
+
+    def rule_removed(self, rule, kb):
+        """Drop a removed rule from its token table, and the plan of the
+            asserted rule once none of its rules are left
+
+        Args:
+            rule (Rule) - The removed rule
+            kb (KnowledgeBase) - The KnowledgeBase it was removed from
+        """
+        tokens = self.tokens_of.pop(rule, None)
+        if tokens is None:
+            return
+        tokens.remove(rule)
+        plan = tokens.plan
+        if not any(plan.levels):
+            for key in plan.tables:
+                plans = self.plans_on.get(key)
+                if plans is not None:
+                    plans.pop(plan, None)
+                    if not plans:
+                        del self.plans_on[key]
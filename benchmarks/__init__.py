@@ -0,0 +1,11 @@
+"""Benchmarks of kb_assert, kb_ask and kb_retract on synthetic KBs.
+
+generators builds the workloads, run times them and writes one JSON object
+per workload, size and engine.
+
+Usage:
+    python -m benchmarks [--workloads NAME ...] [--sizes N ...]
+                         [--engines NAME ...] [--processes N ...]
+                         [--operations N] [--seed N]
+                         [--no-memory] [--output FILE]
+"""
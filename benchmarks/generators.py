@@ -0,0 +1,164 @@
+"""Synthetic workloads shaped like the statements_kb*.txt files, scaled by a
+size parameter. Every generator is deterministic for a given seed and
+returns a Workload of statement lines in read.parse_input syntax, so each
+run parses its own Facts and Rules.
+"""
+import random
+
+class Workload(object):
+    """Synthetic KB and the operations to run against it once it is loaded
+
+    Attributes:
+        name (str): name of the generator
+        params (dict): parameters it was called with
+        statements (listof str): facts and rules of the KB
+        asserts (listof str): facts to assert one at a time after loading
+        asks (listof str): questions to ask
+        retracts (listof str): asserted facts to retract one at a time
+    """
+    def __init__(self, name, params):
+        """Constructor for Workload
+
+        Args:
+            name (str): name of the generator
+            params (dict): parameters it was called with
+        """
+        super(Workload, self).__init__()
+        self.name = name
+        self.params = params
+        self.statements = []
+        self.asserts = []
+        self.asks = []
+        self.retracts = []
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Workload({!r}, {!r}, {!r} statements)'.format(
+                self.name, self.params, len(self.statements))
+
+def taxonomy(size, fanout=3, operations=200, seed=0):
+    """inst/isa workload as in statements_kb.txt: a tree of size // 10
+        classes, size instances of its lower classes, and the rules
+        propagating inst up the tree and closing isa transitively
+
+    Args:
+        size (int): number of inst facts
+        fanout (int): subclasses of each class
+        operations (int): number of asserts, asks and retracts each
+        seed (int): random seed
+
+    Returns:
+        Workload
+    """
+    rng = random.Random(seed)
+    workload = Workload('taxonomy', dict(size=size, fanout=fanout, operations=operations, seed=seed))
+    classes = max(fanout + 1, size // 10)
+    for c in range(1, classes):
+        workload.statements.append("fact: (isa c%d c%d)" % (c, (c - 1) // fanout))
+    lower = range(classes // 2, classes)
+    instances = []
+    for i in range(size):
+        instances.append("fact: (inst o%d c%d)" % (i, rng.choice(lower)))
+    workload.statements += instances
+    workload.statements.append("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)")
+    workload.statements.append("rule: ((isa ?x ?y) (isa ?y ?z)) -> (isa ?x ?z)")
+    for i in range(operations):
+        workload.asserts.append("fact: (inst n%d c%d)" % (i, rng.choice(lower)))
+        kind = rng.randrange(3)
+        if kind == 0:
+            workload.asks.append("fact: (inst ?x c%d)" % rng.randrange(classes))
+        elif kind == 1:
+            workload.asks.append("fact: (inst o%d ?y)" % rng.randrange(size))
+        else:
+            workload.asks.append("fact: (isa c%d ?z)" % rng.randrange(classes))
+    workload.retracts = rng.sample(instances, min(operations, len(instances)))
+    return workload
+
+def family(size, sisters=0.3, operations=200, seed=0):
+    """motherof/grandmotherof workload as in statements_kb5.txt: a forest of
+        size people, each but the first ones with a recent mother, sisters
+        facts between some daughters of the same mother, and the parentof,
+        auntof, grandmotherof and cousins rules
+
+    Args:
+        size (int): number of people
+        sisters (float): share of people with a sisters fact
+        operations (int): number of asserts, asks and retracts each
+        seed (int): random seed
+
+    Returns:
+        Workload
+    """
+    rng = random.Random(seed)
+    workload = Workload('family', dict(size=size, sisters=sisters, operations=operations, seed=seed))
+    roots = max(1, size // 20)
+    children = {}
+    mothers = []
+    for person in range(roots, size):
+        mother = rng.randrange(max(0, person - 50), person)
+        children.setdefault(mother, []).append(person)
+        mothers.append("fact: (motherof p%d p%d)" % (mother, person))
+    workload.statements += mothers
+    for mother, kids in sorted(children.items()):
+        for a, b in zip(kids, kids[1:]):
+            if rng.random() < sisters:
+                workload.statements.append("fact: (sisters p%d p%d)" % (a, b))
+                workload.statements.append("fact: (sisters p%d p%d)" % (b, a))
+    workload.statements += [
+        "rule: ((motherof ?x ?y)) -> (parentof ?x ?y)",
+        "rule: ((parentof ?x ?y) (sisters ?x ?z)) -> (auntof ?z ?y)",
+        "rule: ((parentof ?x ?y) (motherof ?z ?x)) -> (grandmotherof ?z ?y)",
+        "rule: ((grandmotherof ?x ?y) (sisters ?x ?z)) -> (cousins ?y ?z)",
+    ]
+    for i in range(operations):
+        workload.asserts.append("fact: (motherof p%d q%d)" % (rng.randrange(size), i))
+        kind = rng.randrange(3)
+        if kind == 0:
+            workload.asks.append("fact: (grandmotherof p%d ?x)" % rng.randrange(size))
+        elif kind == 1:
+            workload.asks.append("fact: (auntof ?x p%d)" % rng.randrange(size))
+        else:
+            workload.asks.append("fact: (parentof ?x p%d)" % rng.randrange(size))
+    workload.retracts = rng.sample(mothers, min(operations, len(mothers)))
+    return workload
+
+def wide(size, premises=3, degree=2, operations=200, seed=0):
+    """Multi-premise workload: size facts spread over binary relations r0 ..
+        r(premises - 1) on a domain sized so each constant has about degree
+        successors per relation, a rule joining the relations as a chain and
+        one joining them on a shared first term
+
+    Args:
+        size (int): number of facts
+        premises (int): number of LHS statements of the rules
+        degree (int): average successors of a constant in a relation
+        operations (int): number of asserts, asks and retracts each
+        seed (int): random seed
+
+    Returns:
+        Workload
+    """
+    rng = random.Random(seed)
+    workload = Workload('wide', dict(size=size, premises=premises, degree=degree,
+                                     operations=operations, seed=seed))
+    domain = max(2, size // (premises * degree))
+    facts = []
+    for i in range(size):
+        facts.append("fact: (r%d d%d d%d)" % (i % premises, rng.randrange(domain), rng.randrange(domain)))
+    workload.statements += facts
+    chain = " ".join("(r%d ?v%d ?v%d)" % (p, p, p + 1) for p in range(premises))
+    workload.statements.append("rule: (%s) -> (path ?v0 ?v%d)" % (chain, premises))
+    star = " ".join("(r%d ?x ?y%d)" % (p, p) for p in range(premises))
+    workload.statements.append("rule: (%s) -> (hub ?x)" % star)
+    for i in range(operations):
+        workload.asserts.append("fact: (r%d d%d d%d)" % (
+                rng.randrange(premises), rng.randrange(domain), rng.randrange(domain)))
+        if rng.randrange(2):
+            workload.asks.append("fact: (path d%d ?y)" % rng.randrange(domain))
+        else:
+            workload.asks.append("fact: (hub ?x)")
+    workload.retracts = rng.sample(facts, min(operations, len(facts)))
+    return workload
+
+GENERATORS = {'taxonomy': taxonomy, 'family': family, 'wide': wide}
@@ -0,0 +1,221 @@
+"""Runs the workloads of benchmarks.generators against each inference engine
+and writes the results as JSON lines, one object per workload, size and
+engine, so runs can be compared over time.
+"""
+import argparse, contextlib, datetime, gc, json, os, platform, subprocess, sys, time, tracemalloc
+import read
+from student_code import KnowledgeBase, InferenceEngine
+from rete import ReteInferenceEngine
+from batch import BatchInferenceEngine
+from parallel import ParallelInferenceEngine
+from benchmarks.generators import GENERATORS
+
+ENGINES = {'classic': InferenceEngine, 'rete': ReteInferenceEngine,
+           'batch': BatchInferenceEngine, 'parallel': ParallelInferenceEngine}
+
+def percentile_ms(values, fraction):
+    """Value in milliseconds below which the given fraction of the sorted
+        latencies fall, None without latencies
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+def latencies(values):
+    """Summary of a list of latencies in seconds
+
+    Returns:
+        dict: count, operations per second and p50/p95/p99/max in milliseconds
+    """
+    values = sorted(values)
+    total = sum(values)
+    return {'count': len(values),
+            'per_s': len(values) / total if total else None,
+            'p50_ms': percentile_ms(values, 0.5),
+            'p95_ms': percentile_ms(values, 0.95),
+            'p99_ms': percentile_ms(values, 0.99),
+            'max_ms': values[-1] * 1000 if values else None}
+
+def make_engine(engine, processes=None):
+    """New inference engine, with the given number of worker processes for
+        the parallel engine (the number of CPUs by default)
+
+    Args:
+        engine (str): key of ENGINES
+        processes (int|None): worker processes of the parallel engine
+    """
+    if engine == 'parallel':
+        return ParallelInferenceEngine(processes)
+    return ENGINES[engine]()
+
+def build(workload, engine, processes=None):
+    """Parse the statements of a workload and load them into a new KB
+
+    Args:
+        workload (Workload): workload to load
+        engine (str): key of ENGINES
+        processes (int|None): worker processes of the parallel engine
+
+    Returns:
+        (KnowledgeBase, float, float): the saturated KB, and the seconds spent
+            parsing and loading
+    """
+    start = time.perf_counter()
+    data = [read.parse_input(line) for line in workload.statements]
+    parsed = time.perf_counter()
+    KB = KnowledgeBase([], [], make_engine(engine, processes))
+    KB.kb_assert_many(data)
+    return KB, parsed - start, time.perf_counter() - parsed
+
+def close(KB):
+    """Stop the worker processes of a KB's engine, if it has any
+    """
+    if isinstance(KB.ie, ParallelInferenceEngine):
+        KB.ie.close()
+
+def peak_memory(workload, engine, processes=None):
+    """Peak bytes allocated while parsing and loading a workload, measured in
+        a pass of its own since tracing slows everything down
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        KB = build(workload, engine, processes)[0]
+        peak = tracemalloc.get_traced_memory()[1]
+        close(KB)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def measure(workload, engine, memory=True, processes=None):
+    """Time loading a workload, then its asserts, asks and retracts one at
+        a time, in that order
+
+    Args:
+        workload (Workload): workload to run
+        engine (str): key of ENGINES
+        memory (bool): also measure the peak memory of loading
+        processes (int|None): worker processes of the parallel engine
+
+    Returns:
+        dict: results, see the README
+    """
+    KB, parse_s, load_s = build(workload, engine, processes)
+    result = {'workload': workload.name, 'params': workload.params, 'engine': engine,
+              'processes': KB.ie.processes if isinstance(KB.ie, ParallelInferenceEngine) else None,
+              'statements': len(workload.statements),
+              'facts': len(KB.facts), 'rules': len(KB.rules),
+              'parse_s': parse_s, 'load_s': load_s,
+              'statements_per_s': len(workload.statements) / load_s if load_s else None,
+              'derived_per_s': ((len(KB.facts) + len(KB.rules) - len(workload.statements)) / load_s
+                                if load_s else None)}
+    try:
+        times = []
+        for fact in [read.parse_input(line) for line in workload.asserts]:
+            start = time.perf_counter()
+            KB.kb_assert(fact)
+            times.append(time.perf_counter() - start)
+        result['assert'] = latencies(times)
+
+        times = []
+        answers = 0
+        for fact in [read.parse_input(line) for line in workload.asks]:
+            start = time.perf_counter()
+            found = KB.kb_ask(fact)
+            times.append(time.perf_counter() - start)
+            answers += len(found) if found else 0
+        result['ask'] = latencies(times)
+        result['ask']['answers'] = answers
+
+        times = []
+        cascades = []
+        for fact in [read.parse_input(line) for line in workload.retracts]:
+            start = time.perf_counter()
+            facts, rules = KB.kb_retract(fact)
+            times.append(time.perf_counter() - start)
+            cascades.append(facts + rules)
+        result['retract'] = latencies(times)
+        cascades.sort()
+        result['retract']['cascade'] = {
+            'total': sum(cascades),
+            'mean': sum(cascades) / len(cascades) if cascades else None,
+            'p50': cascades[len(cascades) // 2] if cascades else None,
+            'max': cascades[-1] if cascades else None}
+    finally:
+        close(KB)
+    if memory:
+        result['peak_bytes'] = peak_memory(workload, engine, processes)
+    return result
+
+def metadata():
+    """Where and when the results were measured
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+
+def run(workloads, sizes, engines, operations=200, seed=0, memory=True, output=sys.stdout,
+        processes=None):
+    """Run every workload at every size with every engine
+
+    Args:
+        workloads (listof str): keys of GENERATORS
+        sizes (listof int): size parameters
+        engines (listof str): keys of ENGINES
+        operations (int): number of asserts, asks and retracts of each run
+        seed (int): random seed of the generators
+        memory (bool): also measure peak memory
+        output (file): where the JSON lines are written
+        processes (listof int|None): worker processes of the parallel engine,
+            run once for each count, by default once with the number of CPUs
+
+    Returns:
+        listof dict: the results written
+    """
+    meta = metadata()
+    results = []
+    for name in workloads:
+        for size in sizes:
+            workload = GENERATORS[name](size, operations=operations, seed=seed)
+            for engine in engines:
+                for count in (processes or [None]) if engine == 'parallel' else [None]:
+                    # kb_ask and kb_retract print to stdout, which is not what is measured
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        result = measure(workload, engine, memory, count)
+                    result.update(meta)
+                    output.write(json.dumps(result) + '\n')
+                    output.flush()
+                    results.append(result)
+    return results
+
+def main(argv=None):
+    """Command line entry point, see the benchmarks package docstring
+    """
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Benchmarks of the KB on synthetic workloads')
+    parser.add_argument('--workloads', nargs='+', choices=sorted(GENERATORS),
+                        default=sorted(GENERATORS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 5000])
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=['classic', 'rete'])
+    parser.add_argument('--operations', type=int, default=200,
+                        help='asserts, asks and retracts per run')
+    parser.add_argument('--processes', nargs='+', type=int,
+                        help='worker processes of the parallel engine, one run per count')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the peak memory pass')
+    parser.add_argument('--output', help='append the JSON lines to this file instead of stdout')
+    args = parser.parse_args(argv)
+    if args.output:
+        with open(args.output, 'a') as output:
+            run(args.workloads, args.sizes, args.engines, args.operations, args.seed,
+                args.memory, output, args.processes)
+    else:
+        run(args.workloads, args.sizes, args.engines, args.operations, args.seed, args.memory,
+            processes=args.processes)
@@ -0,0 +1,271 @@
+"""Counters, timers and event hooks for the inference of a KnowledgeBase.
+
+A KB only pays for instrumentation when it has some: KnowledgeBase.stats is
+None by default and every hook is behind an `is not None` check. Pass
+stats=Instrumentation() to the KnowledgeBase (timers=True to also time the
+phases and the rules) and read the counters, or subscribe callbacks to the
+events:
+
+    'assert'    (fact_rule)                     fact or rule asserted by a caller
+    'fire'      (fact, rule, derived, new)      a fact and rule fired; derived is
+                                                the fact or rule the KB kept, new
+                                                False when it was already known
+    'retract'   (fact_rule, facts, rules)       a retraction removed that many
+                                                facts and rules
+    'phase'     (name, seconds)                 with timers, a 'saturate', 'ask'
+                                                or 'retract' call returned
+
+Counters of a curried rule go to the asserted rule it was curried from, so
+the rules of a statements file can be compared directly.
+"""
+EVENTS = ('assert', 'fire', 'retract', 'phase')
+
+class RuleStats(object):
+    """Counters of one asserted rule and the rules curried from it
+
+    Attributes:
+        rule (Rule): the asserted rule
+        attempts (int): facts tested against its first LHS statement
+        matches (int): facts that matched it
+        firings (int): facts and rules inferred, known ones included
+        derived (int): facts and rules inferred that were new to the KB
+        duplicates (int): facts and rules inferred that the KB already had
+        seconds (float): time spent matching and firing, with timers only
+    """
+    __slots__ = ('rule', 'attempts', 'matches', 'firings', 'derived', 'duplicates', 'seconds')
+
+    def __init__(self, rule):
+        """Constructor for RuleStats
+
+        Args:
+            rule (Rule): the asserted rule
+        """
+        super(RuleStats, self).__init__()
+        self.rule = rule
+        self.attempts = 0
+        self.matches = 0
+        self.firings = 0
+        self.derived = 0
+        self.duplicates = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'RuleStats({!r} attempts, {!r} matches, {!r} firings, {!r} derived, {!r} duplicates, {:.6f} s)'.format(
+                self.attempts, self.matches, self.firings, self.derived, self.duplicates, self.seconds)
+
+    def as_dict(self):
+        """Counters as a dict, with the rule as text
+        """
+        rule = self.rule
+        return {'rule': "(" + " ".join(str(s) for s in rule.lhs) + ") -> " + str(rule.rhs),
+                'attempts': self.attempts, 'matches': self.matches, 'firings': self.firings,
+                'derived': self.derived, 'duplicates': self.duplicates, 'seconds': self.seconds}
+
+class Instrumentation(object):
+    """Counters of the inference of a KB, with optional timers and event
+        subscribers, see the module docstring
+
+    Attributes:
+        timers (bool): time the phases and the rules
+        attempts (int): fact/rule pairs tested for a match. Engines joining
+            on indexes (Rete, batch, parallel) only produce matching pairs,
+            so for them attempts and matches are the same.
+        matches (int): pairs that matched
+        firings (int): facts and rules inferred, known ones included
+        facts_derived (int): inferred facts new to the KB
+        rules_derived (int): inferred rules new to the KB
+        duplicates (int): inferred facts and rules the KB already had
+        retractions (int): retractions that removed something
+        cascade_facts (int): facts removed by retractions
+        cascade_rules (int): rules removed by retractions
+        cascade_max (int): most facts and rules removed by one retraction
+        rules (dictof RuleStats): counters of each asserted rule
+        phases (dictof list): [calls, seconds] of each phase, with timers
+        subscribers (dictof listof callable): callbacks of each event
+    """
+    def __init__(self, timers=False):
+        """Constructor for Instrumentation
+
+        Args:
+            timers (bool): time the phases and the rules
+        """
+        super(Instrumentation, self).__init__()
+        self.timers = timers
+        self.subscribers = dict((event, []) for event in EVENTS)
+        self.reset()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Instrumentation({!r} matches, {!r} firings, {!r} duplicates, {!r} rules)'.format(
+                self.matches, self.firings, self.duplicates, len(self.rules))
+
+    def reset(self):
+        """Zero every counter and timer, keeping the subscribers
+        """
+        self.attempts = 0
+        self.matches = 0
+        self.firings = 0
+        self.facts_derived = 0
+        self.rules_derived = 0
+        self.duplicates = 0
+        self.retractions = 0
+        self.cascade_facts = 0
+        self.cascade_rules = 0
+        self.cascade_max = 0
+        self.rules = {}
+        self.phases = {}
+
+    def subscribe(self, event, callback):
+        """Call callback with the arguments of event every time it happens
+
+        Args:
+            event (str): one of EVENTS
+            callback (callable): called with the event's arguments
+
+        Raises:
+            ValueError: if event is not one of EVENTS
+        """
+        if event not in self.subscribers:
+            raise ValueError("event must be one of {!r}, not {!r}".format(EVENTS, event))
+        self.subscribers[event].append(callback)
+
+    def unsubscribe(self, event, callback):
+        """Stop calling a callback subscribed to event
+        """
+        self.subscribers[event].remove(callback)
+
+    def emit(self, event, *args):
+        """Call the subscribers of event
+        """
+        for callback in self.subscribers[event]:
+            callback(*args)
+
+    def rule_stats(self, rule):
+        """Counters of the asserted rule a rule was curried from, walking up
+            its first justification; a curried rule inferred from several
+            rules counts for the first one
+
+        Args:
+            rule (Rule): asserted or curried rule
+
+        Returns:
+            RuleStats
+        """
+        while not rule.asserted and rule.supported_by:
+            rule = next(iter(rule.supported_by))[1]
+        stats = self.rules.get(rule)
+        if stats is None:
+            stats = self.rules[rule] = RuleStats(rule)
+        return stats
+
+    def attempt(self, rule, matched, seconds=0.0):
+        """Count a fact tested against the first LHS statement of rule
+
+        Args:
+            rule (Rule): rule tested
+            matched (bool): whether the fact matched
+            seconds (float): time spent matching, with timers
+        """
+        stats = self.rule_stats(rule)
+        stats.attempts += 1
+        self.attempts += 1
+        if matched:
+            stats.matches += 1
+            self.matches += 1
+        stats.seconds += seconds
+
+    def joined(self, rule, pairs=1):
+        """Count fact/rule pairs an engine found matching with a join
+
+        Args:
+            rule (Rule): rule of the pairs
+            pairs (int): number of pairs
+        """
+        stats = self.rule_stats(rule)
+        stats.attempts += pairs
+        stats.matches += pairs
+        self.attempts += pairs
+        self.matches += pairs
+
+    def fired(self, fact, rule, derived, new, seconds=0.0):
+        """Count a fact or rule inferred from a fact and rule
+
+        Args:
+            fact (Fact): fact that matched
+            rule (Rule): rule it matched
+            derived (Fact|Rule): what the KB kept
+            new (bool): whether derived was new to the KB
+            seconds (float): time spent firing, with timers
+        """
+        stats = self.rule_stats(rule)
+        stats.firings += 1
+        self.firings += 1
+        if new:
+            stats.derived += 1
+            if derived.name == 'fact':
+                self.facts_derived += 1
+            else:
+                self.rules_derived += 1
+        else:
+            stats.duplicates += 1
+            self.duplicates += 1
+        stats.seconds += seconds
+        if self.subscribers['fire']:
+            self.emit('fire', fact, rule, derived, new)
+
+    def retracted(self, fact_rule, facts, rules):
+        """Count the facts and rules removed by a retraction
+
+        Args:
+            fact_rule (Fact|Rule): what was retracted
+            facts (int): facts removed
+            rules (int): rules removed
+        """
+        self.retractions += 1
+        self.cascade_facts += facts
+        self.cascade_rules += rules
+        self.cascade_max = max(self.cascade_max, facts + rules)
+        if self.subscribers['retract']:
+            self.emit('retract', fact_rule, facts, rules)
+
+    def phase(self, name, seconds):
+        """Add the time of a call to a phase
+
+        Args:
+            name (str): 'saturate', 'ask' or 'retract'
+            seconds (float): time the call took
+        """
+        calls = self.phases.get(name)
+        if calls is None:
+            calls = self.phases[name] = [0, 0.0]
+        calls[0] += 1
+        calls[1] += seconds
+        if self.subscribers['phase']:
+            self.emit('phase', name, seconds)
+
+    def top_rules(self, n=10, by='seconds'):
+        """Asserted rules with the highest counter
+
+        Args:
+            n (int): number of rules
+            by (str): attribute of RuleStats to sort on
+
+        Returns:
+            listof RuleStats
+        """
+        return sorted(self.rules.values(), key=lambda stats: getattr(stats, by), reverse=True)[:n]
+
+    def as_dict(self):
+        """Counters, timers and rule counters as a dict, e.g. for json.dumps
+        """
+        return {'attempts': self.attempts, 'matches': self.matches, 'firings': self.firings,
+                'facts_derived': self.facts_derived, 'rules_derived': self.rules_derived,
+                'duplicates': self.duplicates, 'retractions': self.retractions,
+                'cascade_facts': self.cascade_facts, 'cascade_rules': self.cascade_rules,
+                'cascade_max': self.cascade_max,
+                'phases': dict((name, {'calls': calls, 'seconds': seconds})
+                               for name, (calls, seconds) in self.phases.items()),
+                'rules': [stats.as_dict() for stats in self.top_rules(len(self.rules), 'firings')]}
@@ -0,0 +1,196 @@
+"""Append-only write-ahead journal of the asserts and retracts of a KB.
+
+The file starts with MAGIC and holds one record per operation. A record is
+a header (payload length, CRC32 of op and payload, op) followed by its
+payload. SYMBOL records hold a symbol in UTF-8 and give it the next journal
+symbol id; ASSERT, RETRACT and RETRACT_RULES records hold a fact or rule as
+int32 codes: the number of LHS statements (0 for a fact), then predicate,
+arity and terms of each LHS statement and of the RHS, as journal symbol ids.
+
+Records are buffered and written together when the KB call that made them
+returns (group commit), so a crash of the process loses nothing that was
+acknowledged. fsync is batched: it runs every sync_every records and/or
+every sync_interval seconds, so a power loss can lose at most that window.
+A record cut short by a crash fails its length or CRC check and is dropped,
+along with anything after it, when the journal is opened again.
+"""
+import os, struct, time, zlib
+from array import array
+from logical_classes import *
+
+MAGIC = b'KBJRNL\x00\x01'
+
+RECORD = struct.Struct('<IIB')
+
+SYMBOL, ASSERT, RETRACT, RETRACT_RULES = range(4)
+
+class Journal(object):
+    """Write-ahead journal file of a KB, see the module docstring
+
+    Attributes:
+        path (str): journal file
+        sync_every (int): fsync once this many records were written since
+            the last fsync, 0 to leave flushing to the OS
+        sync_interval (float|None): also fsync when the last one is older
+            than this many seconds
+        file (file): the journal, opened for appending
+        ids (dictof int): journal symbol id of each process symbol id
+        buffer (bytearray): records not written yet
+        unsynced (int): records written since the last fsync
+        synced_at (float): time of the last fsync
+    """
+    def __init__(self, path, sync_every=1, sync_interval=None):
+        """Constructor for Journal, creating the file if needed. Records
+            already in it must be read with records() before appending.
+
+        Args:
+            path (str): journal file
+            sync_every (int): fsync every this many records, 0 for never
+            sync_interval (float|None): fsync at least this often, in seconds
+        """
+        super(Journal, self).__init__()
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        if not os.path.exists(path) or not os.path.getsize(path):
+            with open(path, 'wb') as f:
+                f.write(MAGIC)
+        self.file = open(path, 'r+b')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise ValueError("{!r} is not a KB journal".format(path))
+        self.ids = {}
+        self.buffer = bytearray()
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Journal({!r}, {!r} symbols)'.format(self.path, len(self.ids))
+
+    def records(self):
+        """Read the records of the file, dropping a torn tail, and leave the
+            file positioned for appending
+
+        Yields:
+            (int, Fact|Rule): op and fact or rule of each record
+        """
+        f = self.file
+        f.seek(len(MAGIC))
+        names = []
+        terms = []
+        good = f.tell()
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            length, crc, op = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(header[8:] + payload) != crc:
+                break
+            good = f.tell()
+            if op == SYMBOL:
+                name = payload.decode('utf-8')
+                self.ids[symbols.intern(name)] = len(names)
+                names.append(name)
+                terms.append(symbols.term(name))
+            else:
+                yield op, decode(array('i', payload), names, terms)
+        f.seek(good)
+        f.truncate()
+
+    def log(self, op, fact_rule):
+        """Buffer a record, until commit
+
+        Args:
+            op (int): ASSERT, RETRACT or RETRACT_RULES
+            fact_rule (Fact|Rule): fact or rule the operation is about
+        """
+        codes = array('i', [len(fact_rule.lhs) if isinstance(fact_rule, Rule) else 0])
+        statements = fact_rule.lhs + [fact_rule.rhs] if isinstance(fact_rule, Rule) else [fact_rule.statement]
+        for statement in statements:
+            codes.append(self.symbol(symbols.intern(statement.predicate)))
+            codes.append(len(statement.terms))
+            codes.extend(self.symbol(term.term.id) for term in statement.terms)
+        self.append(op, codes.tobytes())
+
+    def symbol(self, symbol):
+        """Journal symbol id of a process symbol id, buffering a SYMBOL record
+            the first time it is used
+        """
+        number = self.ids.get(symbol)
+        if number is None:
+            number = self.ids[symbol] = len(self.ids)
+            self.append(SYMBOL, symbols.name_of(symbol).encode('utf-8'))
+        return number
+
+    def append(self, op, payload):
+        """Buffer a record with its header
+        """
+        body = bytes([op]) + payload
+        self.buffer += struct.pack('<II', len(payload), zlib.crc32(body)) + body
+        self.unsynced += 1
+
+    def commit(self):
+        """Write the buffered records, and fsync if the policy says so
+        """
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+        if not self.unsynced:
+            return
+        if ((self.sync_every and self.unsynced >= self.sync_every) or
+                (self.sync_interval is not None
+                 and time.time() - self.synced_at >= self.sync_interval)):
+            self.sync()
+
+    def sync(self):
+        """Write the buffered records and fsync now
+        """
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def reset(self):
+        """Drop every record, once a snapshot holds what they did
+        """
+        self.buffer = bytearray()
+        self.ids = {}
+        self.file.seek(len(MAGIC))
+        self.file.truncate()
+        self.sync()
+
+    def close(self):
+        """Write and fsync the buffered records and close the file
+        """
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+def decode(codes, names, terms):
+    """Fact or rule encoded by Journal.log
+
+    Args:
+        codes (array): codes of the record
+        names (listof str): symbol of each journal symbol id
+        terms (listof Term): shared term of each journal symbol id
+
+    Returns:
+        Fact|Rule
+    """
+    statements = []
+    position = 1
+    for _ in range(codes[0] + 1):
+        end = position + 2 + codes[position + 1]
+        statements.append(Statement([names[codes[position]]] +
+                                    [terms[symbol] for symbol in codes[position + 2:end]]))
+        position = end
+    if codes[0]:
+        return Rule([statements[:-1], statements[-1]])
+    return Fact(statements[0])
@@ -0,0 +1,95 @@
+"""Load generator for server.py: runs concurrent clients issuing a mix of
+asserts, asks and retracts and reports throughput and latency percentiles
+as JSON.
+
+Usage:
+    python loadgen.py [--clients N] [--requests N] [--asks FRACTION]
+                      [--retracts FRACTION] [--host HOST] [--port PORT]
+                      [--unix PATH] [--load FILE]
+
+Without --port or --unix, a server is started in this process on a free port
+and loaded with --load (statements_kb.txt by default).
+"""
+import argparse, asyncio, json, random, time
+from server import KBServer, KBClient
+
+CLASSES = ['cube', 'pyramid', 'sphere', 'block', 'box']
+
+def percentile_ms(values, fraction):
+    """Value in milliseconds below which the given fraction of the sorted
+        latencies fall, None without latencies
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+async def client(args, number, latencies, errors):
+    """One client issuing args.requests requests one after the other
+    """
+    connection = await KBClient.connect(args.host, args.port, args.unix)
+    rng = random.Random(number)
+    asserted = []
+    try:
+        for i in range(args.requests):
+            roll = rng.random()
+            if roll < args.asks:
+                op, item = 'ask', "fact: (inst ?X {})".format(rng.choice(CLASSES))
+            elif roll < args.asks + args.retracts and asserted:
+                # retract one of this client's own asserts
+                op, item = 'retract', asserted.pop(rng.randrange(len(asserted)))
+            else:
+                op = 'assert'
+                item = "fact: (inst c{}_{} {})".format(number, i, rng.choice(CLASSES))
+                asserted.append(item)
+            start = time.perf_counter()
+            response = await connection.request(op, item)
+            latencies[op].append(time.perf_counter() - start)
+            if not response['ok']:
+                errors.append(response['error'])
+    finally:
+        await connection.close()
+
+async def run(args):
+    """Start the server if needed, run the clients and summarize
+    """
+    server = listener = None
+    if args.port is None and args.unix is None:
+        server = KBServer()
+        server.kb.kb_load(args.load)
+        listener = await server.start(args.host, 0)
+        args.port = listener.sockets[0].getsockname()[1]
+    latencies = {'assert': [], 'ask': [], 'retract': []}
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, number, latencies, errors)
+                           for number in range(args.clients)])
+    elapsed = time.perf_counter() - start
+    if listener is not None:
+        listener.close()
+        await listener.wait_closed()
+        server.close()
+    total = sum(len(values) for values in latencies.values())
+    summary = {'clients': args.clients, 'requests': total, 'seconds': elapsed,
+               'throughput': total / elapsed if elapsed else None,
+               'errors': len(errors)}
+    for op, values in latencies.items():
+        values.sort()
+        summary[op] = {'count': len(values),
+                       'p50_ms': percentile_ms(values, 0.5),
+                       'p95_ms': percentile_ms(values, 0.95),
+                       'p99_ms': percentile_ms(values, 0.99)}
+    if server is not None:
+        summary['server'] = server.stats
+    print(json.dumps(summary, indent=2))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200, help='requests per client')
+    parser.add_argument('--asks', type=float, default=0.8, help='fraction of asks')
+    parser.add_argument('--retracts', type=float, default=0.05, help='fraction of retracts')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--unix')
+    parser.add_argument('--load', default='statements_kb.txt')
+    asyncio.run(run(parser.parse_args()))
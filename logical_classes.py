@@ -1,4 +1,48 @@
-from util import is_var
+import threading
+from array import array
+from collections import OrderedDict
+from util import is_var, Matcher
+
+# shared read-only empty container and factory of each lazy slot
+EMPTY = {}
+FACTORIES = {}
+
+def lazy_slot(slot, factory):
+    """Property reading a slot that holds None until something is added to it
+        through writable. Reading it while it is None gives the shared,
+        read-only empty container in EMPTY, so reads never allocate.
+
+    Args:
+        slot (str): name of the slot
+        factory (callable): builds the container when writable first needs it
+
+    Returns:
+        property
+    """
+    FACTORIES[slot] = factory
+    def get(self):
+        value = getattr(self, slot)
+        if value is None:
+            return EMPTY[slot]
+        return value
+    return property(get)
+
+def writable(fact_rule, name):
+    """Support container of a fact or rule for adding to, created on first use
+
+    Args:
+        fact_rule (Fact|Rule): owner of the container
+        name (str): 'supported_by', 'supports_facts' or 'supports_rules'
+
+    Returns:
+        Justifications|SupportSet
+    """
+    slot = '_' + name
+    value = getattr(fact_rule, slot)
+    if value is None:
+        value = FACTORIES[slot]()
+        setattr(fact_rule, slot, value)
+    return value
 
 class Fact(object):
     """Represents a fact in our knowledge base. Has a statement containing the
@@ -10,11 +54,19 @@ class Fact(object):
         statement (Statement): statement of this fact, basically what the fact actually says
         asserted (bool): boolean flag indicating if fact was asserted instead of
             inferred from other rules/facts in the KB
-        supported_by (listof Fact|Rule): Facts/Rules that allow inference of
+        supported_by (Justifications): (Fact, Rule) pairs that allow inference of
             the statement
-        supports_facts (listof Fact): Facts that this fact supports
-        supports_rules (listof Rule): Rules that this fact supports
+        supports_facts (SupportSet): Facts that this fact supports
+        supports_rules (SupportSet): Rules that this fact supports
+
+    The support containers are created when something is first added to them
+    (see writable), so facts that support nothing and are supported by nothing
+    do not carry empty containers.
     """
+    __slots__ = ('statement', 'asserted', '_supported_by', '_supports_facts',
+                 '_supports_rules')
+    name = "fact"
+
     def __init__(self, statement, supported_by=[]):
         """Constructor for Fact setting up useful flags and generating appropriate statement
 
@@ -22,18 +74,19 @@ class Fact(object):
             statement (str|Statement): The statement of this fact, basically what the
                 fact actually says
             supported_by (listof Fact|Rule): Facts/Rules that allow inference of
-                the statement
+                the statement, either (Fact, Rule) pairs or a flat list
+                alternating Fact and Rule
         """
         super(Fact, self).__init__()
-        self.name = "fact"
         self.statement = statement if isinstance(statement, Statement) else Statement(statement)
         self.asserted = not supported_by
-        #self.supported_by = supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
-        for pair in supported_by:
-           self.supported_by.append(pair)
+        self._supported_by = Justifications(supported_by) if supported_by else None
+        self._supports_facts = None
+        self._supports_rules = None
+
+    supported_by = lazy_slot('_supported_by', lambda: Justifications())
+    supports_facts = lazy_slot('_supports_facts', lambda: SupportSet())
+    supports_rules = lazy_slot('_supports_rules', lambda: SupportSet())
 
     def __repr__(self):
         """Define internal string representation
@@ -49,15 +102,15 @@ class Fact(object):
         string = self.name + ":\n"
         string += "\t" + str(self.statement) + "\n"
         string += "\t Asserted:       " + str(self.asserted) + "\n"
-        if self.supported_by != []:
+        if self.supported_by:
             name_strings = [str(x.name) for y in self.supported_by for x in y]
             supported_by_str = ", ".join(name_strings)
             string += "\t Supported by:   [" + supported_by_str + "]\n"
-        if self.supports_facts != []:
+        if self.supports_facts:
             name_strings = [str(x.name) for x in self.supports_facts]
             supports_f_str = ", ".join(name_strings)
             string += "\t Supports facts: [" + supports_f_str + "]\n"
-        if self.supports_rules != []:
+        if self.supports_rules:
             name_strings = [str(x.name) for x in self.supports_rules]
             supports_r_str = ", ".join(name_strings)
             string += "\t Supports rules: [" + supports_r_str + "]\n"
@@ -73,6 +126,11 @@ class Fact(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==, so facts can key dicts and sets
+        """
+        return hash(self.statement)
+
 class Rule(object):
     """Represents a rule in our knowledge base. Has a list of statements (the LHS)
         containing the statements that need to be in our KB for us to infer the
@@ -85,11 +143,18 @@ class Rule(object):
         rhs (Statement): RHS statment of this rule
         asserted (bool): boolean flag indicating if rule was asserted instead of
             inferred from other rules/facts in the KB
-        supported_by (listof Fact|Rule): Facts/Rules that allow inference of
+        supported_by (Justifications): (Fact, Rule) pairs that allow inference of
             the statement
-        supports_facts (listof Fact): Facts that this rule supports
-        supports_rules (listof Rule): Rules that this rule supports
+        supports_facts (SupportSet): Facts that this rule supports
+        supports_rules (SupportSet): Rules that this rule supports
+
+    The support containers are created when something is first added to them,
+    as for Fact.
     """
+    __slots__ = ('lhs', 'rhs', 'asserted', '_supported_by', '_supports_facts',
+                 '_supports_rules')
+    name = "rule"
+
     def __init__(self, rule, supported_by=[]):
         """Constructor for Rule setting up useful flags and generating appropriate LHS & RHS
 
@@ -97,18 +162,20 @@ class Rule(object):
             rule (listof list): Raw representation of statements making up LHS and
                 RHS of this rule
             supported_by (listof Fact|Rule): Facts/Rules that allow inference of
-                the statement
+                the statement, either (Fact, Rule) pairs or a flat list
+                alternating Fact and Rule
         """
         super(Rule, self).__init__()
-        self.name = "rule"
         self.lhs = [statement if isinstance(statement, Statement) else Statement(statement) for statement in rule[0]]
         self.rhs = rule[1] if isinstance(rule[1], Statement) else Statement(rule[1])
         self.asserted = not supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
-        for pair in supported_by:
-            self.supported_by.append(pair)
+        self._supported_by = Justifications(supported_by) if supported_by else None
+        self._supports_facts = None
+        self._supports_rules = None
+
+    supported_by = lazy_slot('_supported_by', lambda: Justifications())
+    supports_facts = lazy_slot('_supports_facts', lambda: SupportSet())
+    supports_rules = lazy_slot('_supports_rules', lambda: SupportSet())
 
     def __repr__(self):
         """Define internal string representation
@@ -127,15 +194,15 @@ class Rule(object):
             string += "\t\t" + str(statement) + "\n"
         string += "\t Right hand:\n\t\t" + str(self.rhs) + "\n"
         string += "\t Asserted:       " + str(self.asserted) + "\n"
-        if self.supported_by != []:
+        if self.supported_by:
             name_strings = [str(x.name) for y in self.supported_by for x in y ]
             supported_by_str = ", ".join(name_strings)
             string += "\t Supported by:   [" + supported_by_str + "]\n"
-        if self.supports_facts != []:
+        if self.supports_facts:
             name_strings = [str(x.name) for x in self.supports_facts]
             supports_f_str = ", ".join(name_strings)
             string += "\t Supports facts: [" + supports_f_str + "]\n"
-        if self.supports_rules != []:
+        if self.supports_rules:
             name_strings = [str(x.name) for x in self.supports_rules]
             supports_r_str = ", ".join(name_strings)
             string += "\t Supports rules: [" + supports_r_str + "]\n"
@@ -152,6 +219,11 @@ class Rule(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==, so rules can key dicts and sets
+        """
+        return hash((tuple(self.lhs), self.rhs))
+
 class Statement(object):
     """Represents a statement in our knowledge base, e.g. (attacked Ai Nosliw),
         (diamonds Loot), (isa Sorceress Wizard), etc. These statements show up
@@ -161,7 +233,11 @@ class Statement(object):
         terms (listof Term): List of terms (Variable or Constant) in the
             statement, e.g. 'Nosliw' or '?d'
         predicate (str): The predicate of the statement, e.g. isa, hero, needs
+        compiled (Matcher|None): matcher compiled from this statement, see matcher()
+        hashed (int|None): hash of this statement, computed on first use
     """
+    __slots__ = ('terms', 'predicate', 'compiled', 'hashed')
+
     def __init__(self, statement_list=[]):
         """Constructor for Statements with optional list of Statements that are
             converted to appropriate terms (and one predicate)
@@ -175,16 +251,28 @@ class Statement(object):
         super(Statement, self).__init__()
         self.terms = []
         self.predicate = ""
+        self.compiled = None
+        self.hashed = None
 
         if statement_list:
-            self.predicate = statement_list[0]
-            self.terms = [t if isinstance(t, Term) else Term(t) for t in statement_list[1:]]
+            self.predicate = symbols.name_of(symbols.intern(statement_list[0]))
+            self.terms = [t if isinstance(t, Term) else symbols.term(t) for t in statement_list[1:]]
 
     def __repr__(self):
         """Define internal string representation
         """
         return 'Statement({!r}, {!r})'.format(self.predicate, self.terms)
 
+    def matcher(self):
+        """Get the Matcher compiled from this statement, compiling it on first use
+
+        Returns:
+            Matcher
+        """
+        if self.compiled is None:
+            self.compiled = Matcher(self)
+        return self.compiled
+
     def __str__(self):
         """Define external representation when printed
         """
@@ -193,7 +281,9 @@ class Statement(object):
     def __eq__(self, other):
         """Define behavior of == when applied to this object
         """
-        if self.predicate != other.predicate:
+        if not isinstance(other, Statement):
+            return False
+        if self.predicate != other.predicate or len(self.terms) != len(other.terms):
             return False
 
         for self_term, other_term in zip(self.terms, other.terms):
@@ -207,6 +297,15 @@ class Statement(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==, built from the predicate and the
+            symbols of the terms. Statements are not changed once built, so
+            the hash is computed once.
+        """
+        if self.hashed is None:
+            self.hashed = hash((self.predicate, tuple(t.term.id for t in self.terms)))
+        return self.hashed
+
 class Term(object):
     """Represents a term (a Variable or Constant) in our knowledge base. Can
         sorta be thought of as a super class of Variable and Constant, though
@@ -215,6 +314,8 @@ class Term(object):
     Attributes:
         term (Variable|Constant): The Variable or Constant that this term holds (represents)
     """
+    __slots__ = ('term',)
+
     def __init__(self, term):
         """Constructor for Term which converts term to appropriate form
 
@@ -240,21 +341,30 @@ class Term(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.term.id == other.term.id
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.term.id == other.id))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==, i.e. the hash of the held element
+        """
+        return hash(self.term.element)
+
 class Variable(object):
     """Represents a variable used in statements
 
     Attributes:
         element (str): The name of the variable, e.g. '?x'
+        id (int): symbol of element in the symbol table, equal elements have
+            equal ids
     """
+    __slots__ = ('element', 'id')
+
     def __init__(self, element):
         """Constructor for Variable
 
@@ -262,7 +372,13 @@ class Variable(object):
             element (str): The name of the variable, e.g. '?x'
         """
         super(Variable, self).__init__()
-        self.element = element
+        self.id = symbols.intern(element)
+        self.element = symbols.name_of(self.id)
+
+    def __reduce__(self):
+        """Pickle by element, since ids are only valid in this process
+        """
+        return (Variable, (self.element,))
 
     def __repr__(self):
         """Define internal string representation
@@ -278,21 +394,30 @@ class Variable(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.id == other.term.id
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.id == other.id))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==, i.e. the hash of the element
+        """
+        return hash(self.element)
+
 class Constant(object):
     """Represents a constant used in statements
 
     Attributes:
         element (str): The value of the constant, e.g. 'Nosliw'
+        id (int): symbol of element in the symbol table, equal elements have
+            equal ids
     """
+    __slots__ = ('element', 'id')
+
     def __init__(self, element):
         """Constructor for Constant
 
@@ -300,7 +425,13 @@ class Constant(object):
             element (str): The value of the constant, e.g. 'Nosliw'
         """
         super(Constant, self).__init__()
-        self.element = element
+        self.id = symbols.intern(element)
+        self.element = symbols.name_of(self.id)
+
+    def __reduce__(self):
+        """Pickle by element, since ids are only valid in this process
+        """
+        return (Constant, (self.element,))
 
     def __repr__(self):
         """Define internal string representation
@@ -316,15 +447,107 @@ class Constant(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.id == other.term.id
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.id == other.id))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==, i.e. the hash of the element
+        """
+        return hash(self.element)
+
+class SymbolTable(object):
+    """Interns predicates, constants and variable names to small integers, and
+        hands out one shared Term per symbol so statements built from strings
+        do not each carry their own Term and Constant objects. New symbols are
+        added under a lock, so threads may intern at the same time.
+
+        Symbols are never dropped, so the table grows with the number of
+        distinct symbols ever seen, not with the number of live facts. Ids
+        are held by live Terms and Matchers, and by the ask cache keys and
+        journal maps, none of which are told when a fact goes away. Reusing
+        an id could therefore silently change the meaning of one of them.
+
+    Attributes:
+        ids (dictof int): maps a symbol to its id
+        names (listof str): symbol of each id
+        terms (listof Term|None): shared Term of each id, built on first use
+        lock (threading.Lock): held while adding a symbol
+    """
+    __slots__ = ('ids', 'names', 'terms', 'lock')
+
+    def __init__(self):
+        """Constructor for SymbolTable creating an empty table
+        """
+        super(SymbolTable, self).__init__()
+        self.ids = {}
+        self.names = []
+        self.terms = []
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'SymbolTable({!r} symbols)'.format(len(self.names))
+
+    def __len__(self):
+        """Define behavior of len, i.e. the number of symbols
+        """
+        return len(self.names)
+
+    def intern(self, name):
+        """Get the id of a symbol, adding it to the table if needed
+
+        Args:
+            name (str): symbol to intern
+
+        Returns:
+            int
+        """
+        symbol = self.ids.get(name)
+        if symbol is None:
+            with self.lock:
+                symbol = self.ids.get(name)
+                if symbol is None:
+                    self.names.append(name)
+                    self.terms.append(None)
+                    symbol = self.ids[name] = len(self.names) - 1
+        return symbol
+
+    def name_of(self, symbol):
+        """Get the symbol of an id
+
+        Args:
+            symbol (int): id returned by intern
+
+        Returns:
+            str
+        """
+        return self.names[symbol]
+
+    def term(self, name):
+        """Get the shared Term of a symbol. Terms are never modified once
+            built, so statements can share them.
+
+        Args:
+            name (str): variable name or constant
+
+        Returns:
+            Term
+        """
+        symbol = self.intern(name)
+        term = self.terms[symbol]
+        if term is None:
+            term = self.terms[symbol] = Term(name)
+        return term
+
+symbols = SymbolTable()
+
 class Binding(object):
     """Represents a binding of a constant to a variable, e.g. 'Nosliw' might be
         bound to'?d'
@@ -333,6 +556,8 @@ class Binding(object):
         variable (Variable): The name of the variable associated with this binding
         constant (Constant): The value of the variable
     """
+    __slots__ = ('variable', 'constant')
+
     def __init__(self, variable, constant):
         """Constructor for Binding
 
@@ -355,19 +580,42 @@ class Binding(object):
         return self.variable.element.upper() + " : " + self.constant.element
 
 class Bindings(object):
-    """Represents Binding(s) used while matching two statements
+    """Represents Binding(s) used while matching two statements. Bound values
+        are kept in slots holding the Term that was matched, so matching and
+        instantiating reuse the terms of the statements involved; Binding
+        objects and strings are only built when asked for.
 
     Attributes:
-        bindings (listof Bindings): bindings involved in match
-        bindings_dict (dictof Bindings): bindings involved in match where key is
-            bound variable and value is bound value,
-            e.g. some_bindings.bindings_dict['?d'] => 'Nosliw'
+        slots (dictof int): slot of each bound variable, keyed by its name,
+            e.g. some_bindings.slots['?d'] => 0. Bindings made by one Matcher
+            share their slots and variables until one of them is extended
+        variables (listof Variable): variable bound in each slot
+        values (listof Term): value bound in each slot
+        shared (bool): whether slots and variables are shared and must be
+            copied before adding a binding
     """
-    def __init__(self):
-        """Constructor for Bindings creating initially empty instance
+    __slots__ = ('slots', 'variables', 'values', 'shared')
+
+    def __init__(self, slots=None, variables=None, values=None):
+        """Constructor for Bindings creating initially empty instance, or one
+            filling the given slots with the given values
+
+        Args:
+            slots (dictof int|None): slot of each variable name, not copied
+            variables (sequenceof Variable|None): variable of each slot, not copied
+            values (listof Term|None): value of each slot
         """
-        self.bindings = []
-        self.bindings_dict = {}
+        super(Bindings, self).__init__()
+        if slots is None:
+            self.slots = {}
+            self.variables = []
+            self.values = []
+            self.shared = False
+        else:
+            self.slots = slots
+            self.variables = variables
+            self.values = values
+            self.shared = True
 
     def __repr__(self):
         """Define internal string representation
@@ -377,18 +625,32 @@ class Bindings(object):
     def __str__(self):
         """Define external representation when printed
         """
-        if self.bindings == []:
+        if not self.values:
             return "No bindings"
-        return ", ".join((str(binding) for binding in self.bindings))
+        return ", ".join(variable.element.upper() + " : " + value.term.element
+                         for variable, value in zip(self.variables, self.values))
 
     def __getitem__(self,key):
-        """Define behavior for indexing, e.g. random_bindings[key] returns
-            random_bindings.bindings_dict[key] when the dictionary is not empty
-            and the key exists, otherwise None
+        """Define behavior for indexing, e.g. random_bindings[key] returns the
+            value bound to the variable named key when it exists, otherwise None
+        """
+        slot = self.slots.get(key)
+        return None if slot is None else self.values[slot].term.element
+
+    @property
+    def bindings(self):
+        """listof Binding: bindings involved in match, built on each access
         """
-        return (self.bindings_dict[key] 
-                if (self.bindings_dict and key in self.bindings_dict)
-                else None)
+        return [Binding(variable, value.term)
+                for variable, value in zip(self.variables, self.values)]
+
+    @property
+    def bindings_dict(self):
+        """dictof str: bound values keyed by bound variable, built on each
+            access, e.g. some_bindings.bindings_dict['?d'] => 'Nosliw'
+        """
+        return {variable.element: value.term.element
+                for variable, value in zip(self.variables, self.values)}
 
     def add_binding(self, variable, value):
         """Add a binding from a variable to a value
@@ -397,8 +659,35 @@ class Bindings(object):
             variable (Variable): the variable to bind to
             value (Constant): the value to bind to the variable
         """
-        self.bindings_dict[variable.element] = value.element
-        self.bindings.append(Binding(variable, value))
+        self.bind_term(variable, Term(value))
+
+    def bind_term(self, variable, term):
+        """Add a binding from a variable to the value held by a term, reusing
+            the term
+
+        Args:
+            variable (Variable): the variable to bind to
+            term (Term): term holding the value to bind to the variable
+        """
+        if self.shared:
+            self.slots = dict(self.slots)
+            self.variables = list(self.variables)
+            self.shared = False
+        self.slots[variable.element] = len(self.values)
+        self.variables.append(variable)
+        self.values.append(term)
+
+    def term_for(self, variable):
+        """Get the term bound to a variable
+
+        Args:
+            variable (Variable): variable to look up
+
+        Returns:
+            Term|None: bound term if variable is bound else None
+        """
+        slot = self.slots.get(variable.element)
+        return None if slot is None else self.values[slot]
 
     def bound_to(self, variable):
         """Check if variable is bound. If so return value bound to it, else False.
@@ -409,12 +698,8 @@ class Bindings(object):
         Returns:
             Variable|Constant|False: returns bound term if variable is bound else False
         """
-        if variable.element in self.bindings_dict.keys():
-            value = self.bindings_dict[variable.element]
-            if value:
-                return Variable(value) if is_var(value) else Constant(value)
-
-        return False
+        slot = self.slots.get(variable.element)
+        return False if slot is None else self.values[slot].term
 
     def test_and_bind(self, variable_term, value_term):
         """Check if variable_term already bound. If so return whether or not passed
@@ -429,11 +714,11 @@ class Bindings(object):
             bool: if variable bound returns whether or not bound value matches value_term,
                 else True
         """
-        bound = self.bound_to(variable_term.term)
-        if bound:
-            return value_term.term == bound
+        slot = self.slots.get(variable_term.term.element)
+        if slot is not None:
+            return value_term.term.element == self.values[slot].term.element
             
-        self.add_binding(variable_term.term, value_term.term)
+        self.bind_term(variable_term.term, value_term)
         return True
 
 
@@ -487,3 +772,723 @@ class ListOfBindings(object):
                 Nothing
         """
         self.list_of_bindings.append((bindings, facts_rules))
+
+
+class Justifications(object):
+    """Deduplicated (Fact, Rule) justifications of an inferred fact or rule.
+        Pairs are keyed by the ids of their members, so adding or removing a
+        pair is O(1) and removing every pair a given fact or rule takes part
+        in is proportional to the number of those pairs. Most facts and rules
+        have a handful of justifications, so the member index is only built
+        once there are more than SMALL of them and small stores are scanned.
+
+    Attributes:
+        pairs (dictof (Fact, Rule)): maps (id(fact), id(rule)) to the pair,
+            in insertion order
+        by_member (dictof set|None): maps the id of a fact or rule to the keys
+            of the pairs it takes part in, None while the store is small
+    """
+    __slots__ = ('pairs', 'by_member')
+    SMALL = 8
+
+    def __init__(self, supported_by=[]):
+        """Constructor for Justifications
+
+        Args:
+            supported_by (listof Fact|Rule): either (Fact, Rule) pairs or a flat
+                list alternating Fact and Rule
+        """
+        super(Justifications, self).__init__()
+        self.pairs = {}
+        self.by_member = None
+        items = list(supported_by)
+        if items and not isinstance(items[0], (tuple, list)):
+            items = zip(items[0::2], items[1::2])
+        for fact, rule in items:
+            self.add(fact, rule)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Justifications({!r})'.format(list(self.pairs.values()))
+
+    def __len__(self):
+        """Define behavior of len, i.e. the number of distinct pairs
+        """
+        return len(self.pairs)
+
+    def __iter__(self):
+        """Iterate over a snapshot of the (Fact, Rule) pairs in insertion order
+        """
+        return iter(list(self.pairs.values()))
+
+    def __contains__(self, pair):
+        """Define behavior of `in` for a (Fact, Rule) pair
+        """
+        return (id(pair[0]), id(pair[1])) in self.pairs
+
+    def add(self, fact, rule):
+        """Add the justification (fact, rule) unless it is already recorded
+
+        Args:
+            fact (Fact): supporting fact
+            rule (Rule): supporting rule
+
+        Returns:
+            bool: True if the pair was new
+        """
+        key = (id(fact), id(rule))
+        if key in self.pairs:
+            return False
+        self.pairs[key] = (fact, rule)
+        if self.by_member is not None:
+            self._link(key)
+        elif len(self.pairs) > self.SMALL:
+            self.by_member = {}
+            for key in self.pairs:
+                self._link(key)
+        return True
+
+    def remove(self, fact, rule):
+        """Remove the justification (fact, rule) if it is recorded
+
+        Args:
+            fact (Fact): supporting fact
+            rule (Rule): supporting rule
+        """
+        key = (id(fact), id(rule))
+        if self.pairs.pop(key, None) is not None and self.by_member is not None:
+            self._unlink(key)
+
+    def remove_member(self, fact_rule):
+        """Remove every justification fact_rule takes part in
+
+        Args:
+            fact_rule (Fact|Rule): supporting fact or rule going away
+
+        Returns:
+            listof (Fact, Rule): the removed pairs
+        """
+        member = id(fact_rule)
+        if self.by_member is None:
+            keys = [key for key in self.pairs if member in key]
+        else:
+            keys = list(self.by_member.get(member, ()))
+        removed = []
+        for key in keys:
+            removed.append(self.pairs.pop(key))
+            if self.by_member is not None:
+                self._unlink(key)
+        return removed
+
+    def involves(self, fact_rule):
+        """Tell whether fact_rule still takes part in a justification
+
+        Args:
+            fact_rule (Fact|Rule): supporting fact or rule
+
+        Returns:
+            bool: True if some recorded pair contains fact_rule
+        """
+        member = id(fact_rule)
+        if self.by_member is None:
+            return any(member in key for key in self.pairs)
+        return member in self.by_member
+
+    def _link(self, key):
+        """INTERNAL USE ONLY
+        Add a new pair key to the member index
+        """
+        for member in key:
+            self.by_member.setdefault(member, set()).add(key)
+
+    def _unlink(self, key):
+        """INTERNAL USE ONLY
+        Drop a removed pair key from the member index
+        """
+        for member in key:
+            keys = self.by_member[member]
+            keys.discard(key)
+            if not keys:
+                del self.by_member[member]
+
+class SupportSet(object):
+    """Insertion-ordered set of the Facts or Rules a fact or rule supports,
+        keyed by id so adding, removing and membership are O(1)
+
+    Attributes:
+        items (dictof Fact|Rule): maps id(element) to the element
+    """
+    __slots__ = ('items',)
+
+    def __init__(self, items=[]):
+        """Constructor for SupportSet
+
+        Args:
+            items (listof Fact|Rule): initial elements
+        """
+        super(SupportSet, self).__init__()
+        self.items = {}
+        for item in items:
+            self.add(item)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'SupportSet({!r})'.format(list(self.items.values()))
+
+    def __len__(self):
+        """Define behavior of len
+        """
+        return len(self.items)
+
+    def __iter__(self):
+        """Iterate over a snapshot of the elements in insertion order
+        """
+        return iter(list(self.items.values()))
+
+    def __contains__(self, item):
+        """Define behavior of `in`, by identity
+        """
+        return id(item) in self.items
+
+    def add(self, item):
+        """Add an element if it is not in the set yet
+
+        Args:
+            item (Fact|Rule): element to add
+        """
+        self.items[id(item)] = item
+
+    append = add  # list-style alias
+
+    def discard(self, item):
+        """Remove an element if it is in the set
+
+        Args:
+            item (Fact|Rule): element to remove
+        """
+        self.items.pop(id(item), None)
+
+class EmptyJustifications(Justifications):
+    """Read-only empty Justifications read from a Fact or Rule supported by
+        nothing, shared by all of them. Removing from it does nothing, adding
+        to it raises: add through writable instead.
+    """
+    __slots__ = ()
+
+    def add(self, fact, rule):
+        """Refuse to add to the shared empty container
+
+        Raises:
+            TypeError: always
+        """
+        raise TypeError("empty supported_by is shared, add through writable()")
+
+class EmptySupportSet(SupportSet):
+    """Read-only empty SupportSet read from a Fact or Rule supporting nothing,
+        shared by all of them, see EmptyJustifications
+    """
+    __slots__ = ()
+
+    def add(self, item):
+        """Refuse to add to the shared empty container
+
+        Raises:
+            TypeError: always
+        """
+        raise TypeError("empty supports set is shared, add through writable()")
+
+    append = add
+
+EMPTY['_supported_by'] = EmptyJustifications()
+EMPTY['_supports_facts'] = EMPTY['_supports_rules'] = EmptySupportSet()
+
+
+class OrderedStore(object):
+    """Insertion-ordered collection of Facts or Rules backed by a dict, so
+        membership, lookup of the stored (canonical) element and deletion are
+        O(1). Still supports the list operations callers used on the old
+        KnowledgeBase.facts/rules lists (iteration, len, indexing, index).
+
+    Attributes:
+        items (dictof Fact|Rule): maps each stored element to itself, so an
+            equal element can be used to fetch the instance held by the store
+    """
+    def __init__(self, items=[]):
+        """Constructor for OrderedStore
+
+        Args:
+            items (listof Fact|Rule): initial elements, duplicates are dropped
+        """
+        super(OrderedStore, self).__init__()
+        self.items = {}
+        for item in items:
+            self.append(item)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'OrderedStore({!r})'.format(list(self.items))
+
+    def __len__(self):
+        """Define behavior of len, e.g. len(OrderedStore([])) == 0
+        """
+        return len(self.items)
+
+    def __contains__(self, item):
+        """Define behavior of `in`, a hash lookup instead of a list scan
+        """
+        return item in self.items
+
+    def __iter__(self):
+        """Iterate over a snapshot of the stored elements in insertion order,
+            so the store may be changed while it is being iterated
+        """
+        return iter(list(self.items))
+
+    def __getitem__(self, key):
+        """Define behavior for positional indexing and slicing like a list.
+            This is O(n), prefer get() for lookups by value.
+        """
+        return list(self.items)[key]
+
+    def __delitem__(self, key):
+        """Delete the element at the given position like a list
+        """
+        del self.items[self[key]]
+
+    def get(self, item):
+        """Get the stored element equal to item
+
+        Args:
+            item (Fact|Rule): element to look up
+
+        Returns:
+            Fact|Rule|None: the stored element, or None if not stored
+        """
+        return self.items.get(item)
+
+    def append(self, item):
+        """Add an element at the end if no equal element is stored yet
+
+        Args:
+            item (Fact|Rule): element to add
+        """
+        self.items.setdefault(item, item)
+
+    def remove(self, item):
+        """Remove the stored element equal to item
+
+        Args:
+            item (Fact|Rule): element to remove
+
+        Raises:
+            ValueError: if no equal element is stored
+        """
+        if item not in self.items:
+            raise ValueError('{!r} is not in store'.format(item))
+        del self.items[item]
+
+    def index(self, item):
+        """Position of the stored element equal to item, like list.index
+
+        Raises:
+            ValueError: if no equal element is stored
+        """
+        for i, stored in enumerate(self.items):
+            if stored == item:
+                return i
+        raise ValueError('{!r} is not in store'.format(item))
+
+
+class FactTable(object):
+    """Columnar table of the facts of one (predicate, arity). Row r holds a
+        fact and, in column p, the symbol id of its term at position p; for
+        each column, postings map a symbol id to the rows holding it, in
+        insertion order. Removed rows are left empty and skipped until more
+        than half the table is empty, when it is compacted.
+
+        The table indexes the KB's Fact objects, it does not replace them:
+        the truth maintenance of the KB (asserted flags, support links, the
+        agenda and retraction) works on fact identity, so each fact stays an
+        object and the columns only serve lookups. The memory saved comes
+        from the shared interned Terms, not from dropping the facts.
+
+    Attributes:
+        facts (listof Fact|None): fact of each row, None once removed
+        row_of (dictof int): maps each fact in the table to its row
+        columns (listof array): symbol ids of each position, one per row
+        postings (listof dict): per position, maps a symbol id to an array of
+            the rows holding it there
+    """
+    __slots__ = ('facts', 'row_of', 'columns', 'postings')
+
+    def __init__(self, arity):
+        """Constructor for FactTable
+
+        Args:
+            arity (int): number of terms of the facts of this table
+        """
+        super(FactTable, self).__init__()
+        self.facts = []
+        self.row_of = {}
+        self.columns = [array('l') for _ in range(arity)]
+        self.postings = [{} for _ in range(arity)]
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'FactTable({!r} facts)'.format(len(self.row_of))
+
+    def __len__(self):
+        """Define behavior of len, i.e. the number of facts in the table
+        """
+        return len(self.row_of)
+
+    def add(self, fact):
+        """Add a fact as a new row, ignoring facts already in the table
+        """
+        if fact in self.row_of:
+            return
+        row = self.row_of[fact] = len(self.facts)
+        self.facts.append(fact)
+        for term, column, postings in zip(fact.statement.terms, self.columns, self.postings):
+            symbol = term.term.id
+            column.append(symbol)
+            rows = postings.get(symbol)
+            if rows is None:
+                rows = postings[symbol] = array('l')
+            rows.append(row)
+
+    def remove(self, fact):
+        """Empty the row of a fact
+
+        Returns:
+            bool: whether the fact was in the table
+        """
+        row = self.row_of.pop(fact, None)
+        if row is None:
+            return False
+        self.facts[row] = None
+        if len(self.facts) > 2 * len(self.row_of) + 16:
+            self.compact()
+        return True
+
+    def compact(self):
+        """Rebuild the table from its remaining facts, in order
+        """
+        facts = [fact for fact in self.facts if fact is not None]
+        self.__init__(len(self.columns))
+        for fact in facts:
+            self.add(fact)
+
+    def rows(self, constants):
+        """Facts holding the given symbols at the given positions, in order
+
+        Args:
+            constants (listof (int, int)): (position, symbol id) pairs
+
+        Returns:
+            iterator of Fact
+        """
+        facts = self.facts
+        if not constants:
+            return (fact for fact in facts if fact is not None)
+        best = None
+        for pos, symbol in constants:
+            rows = self.postings[pos].get(symbol)
+            if rows is None:
+                return iter(())
+            if best is None or len(rows) < len(best[1]):
+                best = (pos, rows)
+        others = [(self.columns[pos], symbol) for pos, symbol in constants if pos != best[0]]
+        return (facts[row] for row in best[1]
+                if facts[row] is not None
+                and all(column[row] == symbol for column, symbol in others))
+
+class FactIndex(object):
+    """Secondary index over the facts of a KB, kept as one columnar FactTable
+        per (predicate, arity), used to find the few facts that can possibly
+        match a statement without scanning every fact
+
+    Attributes:
+        tables (dictof FactTable): maps (predicate, arity) to the table of the
+            facts with that predicate and arity
+        nonground (dictof int): maps predicate to the number of its facts that
+            contain variables, which the symbol postings cannot narrow down
+    """
+    def __init__(self, facts=[]):
+        """Constructor for FactIndex
+
+        Args:
+            facts (listof Fact): facts to index initially
+        """
+        super(FactIndex, self).__init__()
+        self.tables = {}
+        self.nonground = {}
+        for fact in facts:
+            self.add(fact)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'FactIndex({!r})'.format(list(self.tables))
+
+    def add(self, fact):
+        """Index a fact
+
+        Args:
+            fact (Fact): fact to index
+        """
+        statement = fact.statement
+        predicate = statement.predicate
+        key = (predicate, len(statement.terms))
+        table = self.tables.get(key)
+        if table is None:
+            table = self.tables[key] = FactTable(key[1])
+        elif fact in table.row_of:
+            return
+        table.add(fact)
+        if any(is_var(term) for term in statement.terms):
+            self.nonground[predicate] = self.nonground.get(predicate, 0) + 1
+
+    def remove(self, fact):
+        """Drop a fact from the index, ignoring facts that are not indexed
+
+        Args:
+            fact (Fact): fact to drop
+        """
+        statement = fact.statement
+        predicate = statement.predicate
+        key = (predicate, len(statement.terms))
+        table = self.tables.get(key)
+        if table is None or not table.remove(fact):
+            return
+        if not table:
+            del self.tables[key]
+        if any(is_var(term) for term in statement.terms):
+            self.nonground[predicate] -= 1
+            if not self.nonground[predicate]:
+                del self.nonground[predicate]
+
+    def iter_candidates(self, statement):
+        """Facts that may match statement, in the order they were indexed, read
+            from the postings of the constant positions of statement. The
+            index must not change until iteration is done.
+
+        Args:
+            statement (Statement): statement (possibly with variables) to look up
+
+        Returns:
+            iterator of Fact
+        """
+        table = self.tables.get((statement.predicate, len(statement.terms)))
+        if table is None:
+            return iter(())
+        if statement.predicate in self.nonground:
+            return table.rows(())
+        return table.rows([(pos, term.term.id) for pos, term in enumerate(statement.terms)
+                           if not is_var(term)])
+
+    def candidates(self, statement):
+        """Like iter_candidates, but returns a list so the index may change
+            while it is used
+
+        Args:
+            statement (Statement): statement (possibly with variables) to look up
+
+        Returns:
+            listof Fact: superset of the facts matching statement
+        """
+        return list(self.iter_candidates(statement))
+
+class RuleIndex(object):
+    """Dispatch table from (predicate, arity) to the rules whose first LHS
+        statement has that predicate and arity, i.e. the only rules a new fact
+        can trigger. With by_rhs, rules are indexed by their RHS instead, i.e.
+        by the goals they can conclude.
+
+    Attributes:
+        by_rhs (bool): index rules by RHS rather than by first LHS statement
+        by_predicate (dictof dict): maps (predicate, arity) to an
+            insertion-ordered set (dict with None values) of rules
+    """
+    def __init__(self, rules=[], by_rhs=False):
+        """Constructor for RuleIndex
+
+        Args:
+            rules (listof Rule): rules to index initially
+            by_rhs (bool): index rules by RHS rather than by first LHS statement
+        """
+        super(RuleIndex, self).__init__()
+        self.by_rhs = by_rhs
+        self.by_predicate = {}
+        for rule in rules:
+            self.add(rule)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'RuleIndex({!r})'.format(list(self.by_predicate))
+
+    def _key(self, rule):
+        """INTERNAL USE ONLY
+        (predicate, arity) a rule is indexed under
+        """
+        statement = rule.rhs if self.by_rhs else rule.lhs[0]
+        return (statement.predicate, len(statement.terms))
+
+    def add(self, rule):
+        """Index a rule
+
+        Args:
+            rule (Rule): rule to index
+        """
+        self.by_predicate.setdefault(self._key(rule), {})[rule] = None
+
+    def remove(self, rule):
+        """Drop a rule from the index, ignoring rules that are not indexed
+
+        Args:
+            rule (Rule): rule to drop
+        """
+        key = self._key(rule)
+        bucket = self.by_predicate.get(key)
+        if bucket is not None and rule in bucket:
+            del bucket[rule]
+            if not bucket:
+                del self.by_predicate[key]
+
+    def candidates(self, statement):
+        """Rules indexed under the predicate and arity of statement, i.e. the
+            rules whose first LHS statement may match it (or with by_rhs, whose
+            RHS may conclude it), in the order they were indexed
+
+        Args:
+            statement (Statement): statement of a fact, or goal with by_rhs
+
+        Returns:
+            listof Rule
+        """
+        return list(self.by_predicate.get((statement.predicate, len(statement.terms)), ()))
+
+class AskCache(object):
+    """LRU cache of the answers to kb_ask, keyed by the canonical form of the
+        question (see key), so questions differing only in the names of their
+        variables share an entry. Each predicate has a generation counter,
+        bumped whenever a fact with that predicate is added to or removed from
+        the KB; an entry is only used while the generation it was filled at
+        is current, so no stale answer is ever returned.
+
+    Attributes:
+        size (int): most entries kept
+        entries (OrderedDict): maps a key to (generation, answers), least
+            recently used first; answers are (values, fact) pairs, values
+            holding the Term bound to each variable in order of first occurrence
+        generations (dictof int): generation of each predicate
+        base (int): generation of the predicates not in generations
+        hits (int): questions answered from the cache
+        misses (int): questions not in the cache, or with stale answers
+        lock (threading.Lock): guards the entries, asks may run in parallel
+    """
+    def __init__(self, size):
+        """Constructor for AskCache
+
+        Args:
+            size (int): most entries kept
+        """
+        super(AskCache, self).__init__()
+        self.size = size
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.base = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'AskCache({!r} entries, {!r} hits, {!r} misses)'.format(
+                len(self.entries), self.hits, self.misses)
+
+    def __len__(self):
+        """Define behavior of len, i.e. the number of entries
+        """
+        return len(self.entries)
+
+    def key(self, statement):
+        """Canonical form of a question: its predicate, then for each term the
+            symbol id of a constant, or -(n + 1) for the n-th distinct variable
+
+        Args:
+            statement (Statement): statement asked
+
+        Returns:
+            tuple
+        """
+        variables = {}
+        codes = [statement.predicate]
+        for term in statement.terms:
+            if is_var(term):
+                codes.append(-variables.setdefault(term.term.element, len(variables)) - 1)
+            else:
+                codes.append(term.term.id)
+        return tuple(codes)
+
+    def get(self, key):
+        """Answers cached for a key, if still current
+
+        Args:
+            key (tuple): key of the question
+
+        Returns:
+            listof (tupleof Term, Fact)|None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == self.generation(key[0]):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, answers):
+        """Cache the answers to a question, unless the predicate changed since
+            generation, evicting the least recently used entry if full
+
+        Args:
+            key (tuple): key of the question
+            generation (int): generation of the predicate when answering began
+            answers (listof (tupleof Term, Fact)): the answers
+        """
+        with self.lock:
+            if generation != self.generation(key[0]):
+                return
+            self.entries[key] = (generation, answers)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def generation(self, predicate):
+        """Current generation of a predicate
+        """
+        return self.generations.get(predicate, self.base)
+
+    def bump(self, predicate):
+        """Invalidate the cached answers of a predicate whose facts changed
+        """
+        self.generations[predicate] = self.generation(predicate) + 1
+
+    def clear(self):
+        """Drop every entry and start every predicate at a new generation,
+            e.g. when the facts were replaced wholesale
+        """
+        with self.lock:
+            self.entries.clear()
+            self.base = max([self.base] + list(self.generations.values())) + 1
+            self.generations = {}
@@ -1,7 +1,13 @@
 import unittest
-import read, copy
+import read, copy, threading, asyncio, io, os, tempfile
 from logical_classes import *
 from student_code import KnowledgeBase
+from rete import ReteInferenceEngine
+from batch import BatchInferenceEngine
+from parallel import ParallelInferenceEngine
+from server import KBServer, KBClient
+from instrument import Instrumentation
+from util import match, Matcher
 
 class KBTest(unittest.TestCase):
     
@@ -123,6 +129,759 @@ class KBTest(unittest.TestCase):
         self.assertFalse(answer)
         self.assertEqual(len(answer), 0)
 
+    def test7(self):
+        # Rete engine infers the same facts and rules as the default engine
+        KB = KnowledgeBase([], [], ReteInferenceEngine())
+        for item in self.data:
+            KB.kb_assert(item)
+        self.assertEqual(set(KB.facts), set(self.KB.facts))
+        self.assertEqual(set(KB.rules), set(self.KB.rules))
+
+        r1 = read.parse_input("fact: (sisters ada eva)")
+        print(' Retracting', r1)
+        KB.kb_retract(r1)
+        self.KB.kb_retract(r1)
+        self.assertEqual(set(KB.facts), set(self.KB.facts))
+
+    def test8(self):
+        # Long inference chains do not hit the recursion limit
+        KB = KnowledgeBase([], [])
+        data = [read.parse_input("fact: (isa c%d c%d)" % (i, i + 1)) for i in range(600)]
+        data.append(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+        KB.kb_assert_many(data)
+        KB.kb_assert(read.parse_input("fact: (inst box c0)"))
+        ask1 = read.parse_input("fact: (inst box c600)")
+        answer = KB.kb_ask(ask1)
+        self.assertEqual(str(answer[0]), "No bindings")
+        r1 = read.parse_input("fact: (inst box c0)")
+        self.assertEqual(KB.kb_retract(r1), (601, 601))
+
+    def test9(self):
+        # Bulk loading gives the same KB as asserting one by one
+        KB = KnowledgeBase([], [])
+        KB.kb_load('statements_kb5.txt')
+        self.assertEqual(set(KB.facts), set(self.KB.facts))
+        self.assertEqual(set(KB.rules), set(self.KB.rules))
+        for fact in KB.facts:
+            kbfact = self.KB._get_fact(fact)
+            self.assertEqual(fact.asserted, kbfact.asserted)
+            self.assertEqual(len(fact.supported_by), len(kbfact.supported_by))
+
+    def test10(self):
+        # retract reports what it removed and can retract asserted rules on request
+        r1 = read.parse_input("fact: (sisters ada eva)")
+        print(' Retracting', r1)
+        self.assertEqual(self.KB.kb_retract(r1), (4, 0))
+
+        r2 = read.parse_input("rule: ((motherof ?x ?y)) -> (parentof ?x ?y)")
+        print(' Retracting', r2)
+        self.assertEqual(self.KB.kb_retract(r2), (0, 0))
+        self.assertEqual(self.KB.kb_retract(r2, retract_rules=True), (5, 10))
+        ask1 = read.parse_input("fact: (parentof ada ?X)")
+        print(' Asking if', ask1)
+        self.assertFalse(self.KB.kb_ask(ask1))
+        ask2 = read.parse_input("fact: (grandmotherof ada ?X)")
+        print(' Asking if', ask2)
+        answer = self.KB.kb_ask(ask2)
+        self.assertEqual(len(answer), 1)
+        self.assertEqual(str(answer[0]), "?X : felix")
+
+    def test11(self):
+        # lazy and hybrid KBs answer by backward chaining, recursive rules included
+        for KB in (KnowledgeBase([], [], mode='lazy'),
+                   KnowledgeBase([], [], mode='hybrid', eager_predicates=['parentof'])):
+            KB.kb_load('statements_kb5.txt')
+            ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+            print(' Asking if', ask1)
+            answer = KB.kb_ask(ask1)
+            self.assertEqual(sorted(str(b) for b in answer), ["?X : chen", "?X : felix"])
+            ask2 = read.parse_input("fact: (cousins ?X eva)")
+            print(' Asking if', ask2)
+            self.assertEqual(len(KB.kb_ask(ask2)), 2)
+
+        KB = KnowledgeBase([], [], mode='lazy')
+        KB.kb_assert(read.parse_input("rule: ((isa ?x ?y)) -> (subclass ?x ?y)"))
+        KB.kb_assert(read.parse_input("rule: ((subclass ?x ?y) (subclass ?y ?z)) -> (subclass ?x ?z)"))
+        for fact in ("(isa cube block)", "(isa block thing)", "(isa thing block)"):
+            KB.kb_assert(read.parse_input("fact: " + fact))
+        ask3 = read.parse_input("fact: (subclass cube ?X)")
+        print(' Asking if', ask3)
+        self.assertEqual(sorted(str(b) for b in KB.kb_ask(ask3)), ["?X : block", "?X : thing"])
+
+    def test12(self):
+        # streaming asks stop early
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        answers = list(self.KB.kb_ask_iter(ask1, limit=1))
+        self.assertEqual(len(answers), 1)
+        self.assertEqual(str(answers[0][0]), "?X : felix")
+        self.assertEqual(len(list(self.KB.kb_ask_iter(ask1))), 2)
+        self.assertTrue(self.KB.kb_exists(ask1))
+        self.assertFalse(self.KB.kb_exists(read.parse_input("fact: (grandmotherof eva ?X)")))
+
+    def test13(self):
+        # bindings keep their printed and dict forms
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        binding = self.KB.kb_ask(ask1)[0]
+        self.assertEqual(str(binding), "?X : felix")
+        self.assertEqual(binding['?X'], "felix")
+        self.assertEqual(binding.bindings_dict, {'?X': 'felix'})
+        self.assertEqual(str(binding.bindings[0]), "?X : felix")
+
+    def test14(self):
+        # batch engine infers the same facts, rules and supports as the default engine
+        KB = KnowledgeBase([], [], BatchInferenceEngine())
+        KB.kb_load('statements_kb5.txt')
+        self.assertEqual(set(KB.facts), set(self.KB.facts))
+        self.assertEqual(set(KB.rules), set(self.KB.rules))
+        for fact in KB.facts:
+            self.assertEqual(len(fact.supported_by), len(self.KB._get_fact(fact).supported_by))
+
+        r1 = read.parse_input("fact: (sisters ada eva)")
+        print(' Retracting', r1)
+        KB.kb_retract(r1)
+        self.KB.kb_retract(r1)
+        self.assertEqual(set(KB.facts), set(self.KB.facts))
+
+    def test15(self):
+        # parallel saturation gives the same KB as the default engine
+        engine = ParallelInferenceEngine(2)
+        try:
+            KB = KnowledgeBase([], [], engine)
+            KB.kb_load('statements_kb5.txt')
+            self.assertEqual(set(KB.facts), set(self.KB.facts))
+            self.assertEqual(set(KB.rules), set(self.KB.rules))
+            for fact in KB.facts:
+                self.assertEqual(len(fact.supported_by), len(self.KB._get_fact(fact).supported_by))
+        finally:
+            engine.close()
+
+    def test16(self):
+        # many threads asking while one asserts and retracts always see a whole KB
+        KB = KnowledgeBase([], [], thread_safe=True)
+        KB.kb_load('statements_kb5.txt')
+        fact1 = "fact: (sisters ada eva)"
+        ask1 = read.parse_input("fact: (auntof eva ?X)")
+        ask2 = read.parse_input("fact: (cousins chen ?X)")
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            try:
+                while not done.is_set():
+                    with KB.lock.reading():
+                        aunts = [str(b) for b, facts in KB.kb_ask_iter(ask1)]
+                        cousins = [str(b) for b, facts in KB.kb_ask_iter(ask2)]
+                    self.assertIn(aunts, ([], ["?X : bing"]))
+                    self.assertEqual(bool(aunts), bool(cousins))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reader) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for _ in range(50):
+            KB.kb_retract(read.parse_input(fact1))
+            KB.kb_assert(read.parse_input(fact1))
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(str(KB.kb_ask(ask1)[0]), "?X : bing")
+
+    def test17(self):
+        # the server batches concurrent asserts and answers asks and retracts
+        async def run():
+            server = KBServer()
+            server.kb.kb_load('statements_kb5.txt')
+            listener = await server.start(port=0)
+            client = await KBClient.connect(port=listener.sockets[0].getsockname()[1])
+            try:
+                answers = await client.kb_ask("fact: (grandmotherof ada ?X)")
+                self.assertEqual(answers, [{'?X': 'felix'}, {'?X': 'chen'}])
+                responses = await asyncio.gather(*[client.kb_assert("fact: (motherof m%d ada)" % i)
+                                                   for i in range(20)])
+                self.assertTrue(all(response['ok'] for response in responses))
+                self.assertLess(server.stats['batches'], 20)
+                self.assertEqual(len(await client.kb_ask("fact: (grandmotherof ?X bing)")), 20)
+                self.assertEqual(await client.kb_retract("fact: (sisters ada eva)"), [4, 0])
+                self.assertEqual(await client.kb_ask("fact: (auntof eva ?X)"), [])
+                response = await client.request('ask', 'not a fact')
+                self.assertFalse(response['ok'])
+            finally:
+                await client.close()
+                listener.close()
+                await listener.wait_closed()
+                server.close()
+        asyncio.run(run())
+
+    def test18(self):
+        # a snapshot restores the KB without inference, support links included
+        path = os.path.join(tempfile.mkdtemp(), 'kb.snap')
+        self.KB.save_snapshot(path)
+        KB = KnowledgeBase([], [], ReteInferenceEngine())
+        KB.load_snapshot(path)
+        self.assertEqual(set(KB.facts), set(self.KB.facts))
+        self.assertEqual(set(KB.rules), set(self.KB.rules))
+        for fact in KB.facts:
+            self.assertEqual(fact.asserted, self.KB._get_fact(fact).asserted)
+            self.assertEqual(len(fact.supported_by), len(self.KB._get_fact(fact).supported_by))
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        self.assertEqual(str(KB.kb_ask(ask1)), str(self.KB.kb_ask(ask1)))
+        sisters = read.parse_input("fact: (sisters ada eva)")
+        self.assertEqual(KB.kb_retract(sisters), self.KB.kb_retract(sisters))
+        mother = read.parse_input("fact: (motherof bing zed)")
+        KB.kb_assert(mother)
+        self.assertEqual(len(KB.kb_ask(read.parse_input("fact: (grandmotherof ?X zed)"))), 1)
+        with self.assertRaises(ValueError):
+            KB.load_snapshot(path)
+        with self.assertRaises(ValueError):
+            KnowledgeBase([], []).load_snapshot('statements_kb5.txt')
+
+    def test19(self):
+        # the journal replays asserts and retracts on top of the last snapshot
+        directory = tempfile.mkdtemp()
+        log, snap = os.path.join(directory, 'kb.log'), os.path.join(directory, 'kb.snap')
+        KB = KnowledgeBase([], [])
+        self.assertEqual(KB.open_journal(log), 0)
+        KB.kb_assert_many(self.data[:6])
+        KB.save_snapshot(snap)
+        KB.kb_assert_many(self.data[6:])
+        KB.kb_retract(read.parse_input("fact: (sisters ada eva)"))
+        KB.kb_assert(read.parse_input("fact: (motherof bing zed)"))
+        # retracting an inferred fact or, by default, a rule changes nothing
+        self.assertEqual(KB.kb_retract(read.parse_input("fact: (grandmotherof ada chen)")), (0, 0))
+        self.assertEqual(KB.kb_retract(self.data[6]), (0, 0))
+        KB.journal.file.flush()
+        restored = KnowledgeBase([], [])
+        restored.load_snapshot(snap)
+        self.assertEqual(restored.open_journal(log), len(self.data[6:]) + 2)
+        self.assertEqual(set(restored.facts), set(KB.facts))
+        self.assertEqual(set(restored.rules), set(KB.rules))
+        for fact in restored.facts:
+            self.assertEqual(fact.asserted, KB._get_fact(fact).asserted)
+        restored.close_journal()
+        KB.close_journal()
+
+    def test20(self):
+        # streaming reader: multi-line entries, located errors, batched loads
+        self.assertEqual([str(x) for x in read.iter_statements('statements_kb5.txt')],
+                         [str(x) for x in self.data])
+        text = "# comment\nfact: (isa\n  cube block)\nrule: ((inst ?x ?y)\n   (isa ?y ?z)) -> (inst ?x ?z)\n"
+        parsed = list(read.iter_statements(io.StringIO(text)))
+        self.assertEqual(str(parsed[0].statement), "(isa cube block)")
+        self.assertEqual([str(s) for s in parsed[1].lhs], ["(inst ?x ?y)", "(isa ?y ?z)"])
+        with self.assertRaises(read.ParseError) as raised:
+            list(read.iter_statements(io.StringIO("fact: (isa a b)\nrule: ((inst ?x ?y)) (isa ?y)\n")))
+        self.assertEqual((raised.exception.line, raised.exception.column), (2, 1))
+        KB = KnowledgeBase([], [])
+        KB.kb_load('statements_kb5.txt', batch=3)
+        self.assertEqual(set(KB.facts), set(self.KB.facts))
+        self.assertEqual(set(KB.rules), set(self.KB.rules))
+
+    def test21(self):
+        # parallel chunked parsing gives read_tokenize's facts and rules, in order
+        expected = [str(x) for x in read.read_tokenize('statements_kb.txt')]
+        self.assertEqual([str(x) for x in read.read_parallel('statements_kb.txt', 2, chunk_size=64)],
+                         expected)
+        self.assertEqual([str(x) for x in read.read_parallel('statements_kb.txt', 1)], expected)
+
+    def test22(self):
+        # cached asks are shared across variable names and never stale
+        KB = KnowledgeBase([], [], cache_size=2)
+        KB.kb_load('statements_kb5.txt')
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        ask2 = read.parse_input("fact: (grandmotherof ada ?Y)")
+        self.assertEqual(str(KB.kb_ask(ask1)), str(self.KB.kb_ask(ask1)))
+        self.assertEqual([str(b) for b in KB.kb_ask(ask2)], ["?Y : felix", "?Y : chen"])
+        self.assertEqual((KB.cache.hits, KB.cache.misses), (1, 1))
+        KB.kb_assert(read.parse_input("fact: (motherof bing zed)"))
+        self.assertEqual(len(KB.kb_ask(ask1)), 3)
+        KB.kb_retract(read.parse_input("fact: (motherof bing zed)"))
+        self.assertEqual(len(KB.kb_ask(ask1)), 2)
+        self.assertEqual((KB.cache.hits, KB.cache.misses), (1, 3))
+        for i in range(3):
+            KB.kb_ask(read.parse_input("fact: (motherof ?X n%d)" % i))
+        self.assertEqual(len(KB.cache), 2)
+
+    def test23(self):
+        # the synthetic workloads saturate alike whatever the engine
+        import benchmarks.run
+        for name in ('taxonomy', 'family', 'wide'):
+            out = io.StringIO()
+            results = benchmarks.run.run([name], [60], ['classic', 'rete'], operations=5,
+                                         memory=False, output=out)
+            self.assertEqual(len(out.getvalue().splitlines()), 2)
+            self.assertEqual([(r['facts'], r['rules'], r['retract']['cascade']) for r in results[1:]],
+                             [(r['facts'], r['rules'], r['retract']['cascade']) for r in results[:1]])
+            self.assertGreater(results[0]['facts'] + results[0]['rules'], results[0]['statements'])
+
+    def test24(self):
+        # instrumentation counts the same inferences whatever the engine
+        counts = []
+        for engine in (None, ReteInferenceEngine()):
+            stats = Instrumentation(timers=True)
+            asserted, retracted = [], []
+            stats.subscribe('assert', asserted.append)
+            stats.subscribe('retract', lambda fact_rule, facts, rules: retracted.append(facts + rules))
+            KB = KnowledgeBase([], [], engine, stats=stats)
+            KB.kb_load('statements_kb5.txt')
+            self.assertEqual(len(asserted), 10)
+            self.assertEqual(stats.firings, stats.facts_derived + stats.rules_derived + stats.duplicates)
+            self.assertEqual(stats.facts_derived, len(KB.facts) - 6)
+            self.assertEqual(len(stats.rules), 4)
+            self.assertEqual(sum(rule.firings for rule in stats.rules.values()), stats.firings)
+            KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+            self.assertEqual(retracted, [stats.cascade_facts + stats.cascade_rules])
+            self.assertEqual(sorted(stats.phases), ['retract', 'saturate'])
+            counts.append(dict((k, v) for k, v in stats.as_dict().items() if k != 'phases'))
+        for rule in counts[0]['rules'] + counts[1]['rules']:
+            rule['seconds'] = 0
+        self.assertEqual(counts[0], counts[1])
+
+    def test25(self):
+        # a journal cut short by a crash replays the records before the cut
+        directory = tempfile.mkdtemp()
+        log = os.path.join(directory, 'kb.log')
+        KB = KnowledgeBase([], [])
+        KB.open_journal(log)
+        KB.kb_load('statements_kb5.txt')
+        KB.kb_assert("not a fact")
+        size = os.path.getsize(log)
+        KB.kb_retract(read.parse_input("fact: (motherof nobody else)"))
+        self.assertEqual(os.path.getsize(log), size)
+        KB.kb_assert(read.parse_input("fact: (motherof bing zed)"))
+        KB.close_journal()
+        full = os.path.getsize(log)
+        with open(log, 'r+b') as f:
+            f.truncate(full - 3)
+        restored = KnowledgeBase([], [])
+        self.assertEqual(restored.open_journal(log), 10)
+        # the torn assert is dropped, the symbol record before it is kept
+        self.assertEqual(os.path.getsize(log), size + 12)
+        self.assertEqual(set(restored.facts), set(self.KB.facts))
+        restored.kb_assert(read.parse_input("fact: (motherof bing zed)"))
+        restored.close_journal()
+        again = KnowledgeBase([], [])
+        self.assertEqual(again.open_journal(log), 11)
+        self.assertEqual(set(again.facts), set(KB.facts))
+        again.close_journal()
+        with open(log, 'r+b') as f:
+            f.seek(size + 12)
+            f.write(b'\xff')
+        self.assertEqual(KnowledgeBase([], []).open_journal(log), 10)
+
+    def test26(self):
+        # snapshots saved from several threads at once do not collide
+        directory = tempfile.mkdtemp()
+        snap = os.path.join(directory, 'kb.snap')
+        KB = KnowledgeBase([], [], thread_safe=True)
+        KB.open_journal(os.path.join(directory, 'kb.log'))
+        KB.kb_load('statements_kb5.txt')
+        errors = []
+        def save():
+            try:
+                for _ in range(5):
+                    KB.save_snapshot(snap)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=save) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        KB.close_journal()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(os.listdir(directory)), ['kb.log', 'kb.snap'])
+        restored = KnowledgeBase([], [])
+        restored.load_snapshot(snap)
+        self.assertEqual(set(restored.facts), set(KB.facts))
+
+    def test27(self):
+        # the server refuses a KB without a lock, and a failed write fails alone
+        with self.assertRaises(ValueError):
+            KBServer(KnowledgeBase([], []))
+        def refuse(fact_rule):
+            if isinstance(fact_rule, Fact) and str(fact_rule.statement) == "(motherof bad x)":
+                raise RuntimeError("refused")
+        stats = Instrumentation()
+        stats.subscribe('assert', refuse)
+        server = KBServer(KnowledgeBase([], [], thread_safe=True, stats=stats))
+        server.kb.kb_load('statements_kb5.txt')
+        items = ["fact: (motherof eva x)", "fact: (motherof bad x)", "fact: (motherof eva y)"]
+        batch = [('assert', read.parse_input(item), None) for item in items]
+        batch.append(('retract', read.parse_input("fact: (sisters ada eva)"), None))
+        results = server.apply(batch)
+        server.close()
+        self.assertEqual([result['ok'] for result in results], [True, False, True, True])
+        self.assertEqual(results[1]['error'], "RuntimeError: refused")
+        self.assertEqual(results[3]['removed'], [4, 0])
+        self.assertTrue(server.kb.kb_exists(read.parse_input("fact: (parentof eva y)")))
+        self.assertFalse(server.kb.kb_exists(read.parse_input("fact: (motherof bad x)")))
+        self.assertEqual(server.stats['errors'], 1)
+
+    def test28(self):
+        # reading empty support containers allocates nothing, adding needs writable
+        KB = KnowledgeBase([], [])
+        KB.kb_load('statements_kb5.txt')
+        cousins = [fact for fact in KB.facts if fact.statement.predicate == 'cousins']
+        self.assertTrue(cousins)
+        # retracting reads the supports of everything it visits
+        KB.kb_retract(read.parse_input("fact: (sisters ada eva)"))
+        for fact in cousins:
+            self.assertFalse(fact.supports_facts)
+            self.assertIsNone(fact._supports_facts)
+            self.assertIsNone(fact._supports_rules)
+        fact = read.parse_input("fact: (motherof x y)")
+        self.assertIsNone(fact._supported_by)
+        self.assertFalse(fact.supported_by)
+        self.assertIsNone(fact._supported_by)
+        with self.assertRaises(TypeError):
+            fact.supports_facts.add(cousins[0])
+        writable(fact, 'supports_facts').add(cousins[0])
+        self.assertEqual(list(fact.supports_facts), [cousins[0]])
+        self.assertFalse(read.parse_input("fact: (motherof x z)").supports_facts)
+
+    def test29(self):
+        # facts and rules stores keep one canonical instance, in insertion order
+        first = read.parse_input("fact: (isa cube block)")
+        second = read.parse_input("fact: (isa ball toy)")
+        store = OrderedStore([first, second, read.parse_input("fact: (isa cube block)")])
+        self.assertEqual(len(store), 2)
+        equal = read.parse_input("fact: (isa cube block)")
+        self.assertIn(equal, store)
+        self.assertIs(store.get(equal), first)
+        self.assertIsNone(store.get(read.parse_input("fact: (isa ball block)")))
+        self.assertEqual((store[0], store[-1], store.index(second)), (first, second, 1))
+        store.append(read.parse_input("fact: (isa cone toy)"))
+        for item in store:
+            store.remove(item)
+        self.assertEqual(len(store), 0)
+        with self.assertRaises(ValueError):
+            store.remove(first)
+        with self.assertRaises(ValueError):
+            store.index(first)
+        rule = read.parse_input("rule: ((isa ?x ?y)) -> (thing ?x)")
+        rules = OrderedStore([rule])
+        self.assertIs(rules.get(read.parse_input("rule: ((isa ?x ?y)) -> (thing ?x)")), rule)
+        del rules[0]
+        self.assertNotIn(rule, rules)
+
+    def test30(self):
+        # the fact index narrows asks to the facts sharing their constants
+        KB = KnowledgeBase([], [])
+        for item in ["fact: (isa cube block)", "fact: (isa ball toy)", "fact: (isa cone toy)",
+                     "fact: (isa cube toy)", "fact: (size cube big)", "fact: (isa cube)"]:
+            KB.kb_assert(read.parse_input(item))
+        def candidates(ask):
+            return [str(fact.statement) for fact in
+                    KB.fact_index.candidates(read.parse_input(ask).statement)]
+        self.assertEqual(candidates("fact: (isa ?x toy)"),
+                         ["(isa ball toy)", "(isa cone toy)", "(isa cube toy)"])
+        self.assertEqual(candidates("fact: (isa cube toy)"), ["(isa cube toy)"])
+        self.assertEqual(candidates("fact: (isa ?x ?y)"),
+                         ["(isa cube block)", "(isa ball toy)", "(isa cone toy)", "(isa cube toy)"])
+        self.assertEqual(candidates("fact: (isa ?x)"), ["(isa cube)"])
+        self.assertEqual(candidates("fact: (isa sphere ?y)"), [])
+        self.assertEqual(candidates("fact: (color ?x ?y)"), [])
+        # facts with variables cannot be narrowed down by constants
+        KB.kb_assert(read.parse_input("fact: (isa ?z toy)"))
+        self.assertEqual(KB.fact_index.nonground, {'isa': 1})
+        self.assertEqual(len(candidates("fact: (isa cube block)")), 5)
+        KB.kb_retract(read.parse_input("fact: (isa ?z toy)"))
+        self.assertEqual(KB.fact_index.nonground, {})
+        KB.kb_retract(read.parse_input("fact: (isa cube)"))
+        self.assertNotIn(('isa', 1), KB.fact_index.tables)
+        self.assertEqual(len(KB.kb_ask(read.parse_input("fact: (isa cube ?y)"))), 2)
+
+    def test31(self):
+        # new facts are only tried against rules on their predicate and arity
+        index = RuleIndex()
+        binary = read.parse_input("rule: ((isa ?x ?y) (isa ?y ?z)) -> (isa ?x ?z)")
+        unary = read.parse_input("rule: ((isa ?x)) -> (thing ?x)")
+        other = read.parse_input("rule: ((inst ?x ?y)) -> (thing ?x)")
+        for rule in (binary, unary, other):
+            index.add(rule)
+        self.assertEqual(index.candidates(read.parse_input("fact: (isa a b)").statement), [binary])
+        self.assertEqual(index.candidates(read.parse_input("fact: (isa a)").statement), [unary])
+        self.assertEqual(index.candidates(read.parse_input("fact: (size a b)").statement), [])
+        index.remove(other)
+        index.remove(other)
+        self.assertNotIn(('inst', 2), index.by_predicate)
+        by_rhs = RuleIndex([binary, unary, other], by_rhs=True)
+        self.assertEqual(by_rhs.candidates(read.parse_input("fact: (thing ?x)").statement),
+                         [unary, other])
+        stats = Instrumentation()
+        KB = KnowledgeBase([], [], stats=stats)
+        KB.kb_load('statements_kb5.txt')
+        attempts = stats.attempts
+        KB.kb_assert(read.parse_input("fact: (likes ada bing)"))
+        self.assertEqual(stats.attempts, attempts)
+        sisters = read.parse_input("fact: (sisters bing zed)")
+        tried = KB.rule_index.candidates(sisters.statement)
+        self.assertTrue(all(rule.lhs[0].predicate == 'sisters' for rule in tried))
+        self.assertLess(len(tried), len(KB.rules))
+        KB.kb_assert(sisters)
+        self.assertEqual(stats.attempts, attempts + len(tried))
+
+    def test32(self):
+        # compiled matchers agree with match() on repeated variables and constants
+        def statement(text):
+            return read.parse_input("fact: " + text).statement
+        pattern = statement("(likes ?x ?y ?x)")
+        matcher = Matcher(pattern)
+        self.assertEqual(matcher.repeats, ((2, 0),))
+        for text in ["(likes a b a)", "(likes a b b)", "(likes a a a)", "(likes a b)", "(hates a b a)"]:
+            expected = match(statement(text), pattern)
+            got = matcher.match(statement(text))
+            self.assertEqual(str(got), str(expected), text)
+        self.assertEqual(str(matcher.match(statement("(likes a b a)"))), "?X : a, ?Y : b")
+        constant = Matcher(statement("(likes ada ?y)"))
+        self.assertFalse(constant.match(statement("(likes bing chen)")))
+        self.assertEqual(constant.match(statement("(likes ada chen)")).bound_to(Variable('?y')),
+                         Constant('chen'))
+        # a fact with variables is matched with match(), not the matcher
+        KB = KnowledgeBase([], [])
+        KB.kb_assert(read.parse_input("rule: ((likes ?x ?x)) -> (vain ?x)"))
+        KB.kb_assert(read.parse_input("fact: (likes ?z ?z)"))
+        KB.kb_assert(read.parse_input("fact: (likes ada bing)"))
+        KB.kb_assert(read.parse_input("fact: (likes bing bing)"))
+        self.assertEqual([str(f.statement) for f in KB.facts if f.statement.predicate == 'vain'],
+                         ["(vain ?x)", "(vain bing)"])
+        answers = KB.kb_ask(read.parse_input("fact: (likes ?a ?a)"))
+        self.assertEqual([str(b) for b in answers], ["?A : ?z", "?A : bing"])
+
+    def test33(self):
+        # interning gives one id and one shared term per symbol, from any thread
+        name = 'symbol-%d' % id(self)
+        symbol = symbols.intern(name)
+        self.assertEqual(symbols.intern(name), symbol)
+        self.assertEqual(symbols.name_of(symbol), name)
+        self.assertNotEqual(symbols.intern(name + 'x'), symbol)
+        self.assertIs(symbols.term(name), symbols.term(name))
+        self.assertEqual(symbols.term(name).term.id, symbol)
+        ids = []
+        names = ['thread-%d-%d' % (id(self), i) for i in range(200)]
+        threads = [threading.Thread(target=lambda: ids.append([symbols.intern(n) for n in names]))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(found == ids[0] for found in ids))
+        self.assertEqual(len(set(ids[0])), len(names))
+
+    def test34(self):
+        # fact tables skip removed rows and compact once they are mostly empty
+        facts = [read.parse_input("fact: (edge n%d n%d)" % (i, i % 3)) for i in range(40)]
+        table = FactTable(2)
+        for fact in facts:
+            table.add(fact)
+        table.add(facts[0])
+        self.assertEqual(len(table), 40)
+        zero = symbols.intern('n0')
+        def rows():
+            return [str(fact.statement) for fact in table.rows([(1, zero)])]
+        for fact in facts[:20]:
+            table.remove(fact)
+        self.assertEqual(len(table.facts), 40)
+        self.assertEqual(rows(), ["(edge n%d n0)" % i for i in range(21, 40, 3)])
+        for fact in facts[20:30]:
+            self.assertTrue(table.remove(fact))
+        self.assertFalse(table.remove(facts[0]))
+        # compacted on the 29th removal, the 30th left one empty row
+        self.assertEqual(len(table), 10)
+        self.assertEqual(len(table.facts), 11)
+        self.assertEqual([table.row_of[fact] for fact in facts[30:]], list(range(1, 11)))
+        self.assertEqual(len(table.columns[1]), 11)
+        self.assertEqual(rows(), ["(edge n%d n0)" % i for i in (30, 33, 36, 39)])
+        self.assertEqual(list(table.rows([(0, symbols.intern('n35')), (1, symbols.intern('n2'))])),
+                         [facts[35]])
+        self.assertEqual(list(table.rows([(1, symbols.intern('n35'))])), [])
+
+    def test35(self):
+        # batch engine joins multi-premise rules and facts with variables like the default engine
+        items = ["fact: (isa cube block)", "fact: (isa ball toy)", "fact: (size cube big)",
+                 "fact: (size ball big)", "fact: (same block block)", "fact: (isa ?z toy)",
+                 "rule: ((isa ?x ?y) (same ?y ?z) (size ?x ?w)) -> (tri ?x ?z ?w)",
+                 "rule: ((isa ?x toy) (isa ?x ?y)) -> (toyis ?x ?y)"]
+        KB1 = KnowledgeBase([], [])
+        KB2 = KnowledgeBase([], [], BatchInferenceEngine())
+        for KB in (KB1, KB2):
+            KB.kb_assert_many([read.parse_input(item) for item in items[:4]])
+            for item in items[4:]:
+                KB.kb_assert(read.parse_input(item))
+        def supports(KB):
+            return dict((str(fact.statement), len(fact.supported_by)) for fact in KB.facts)
+        self.assertEqual(supports(KB2), supports(KB1))
+        self.assertEqual(set(KB2.rules), set(KB1.rules))
+        self.assertIn("(tri cube block big)", supports(KB2))
+        plan = KB2.ie.tokens_of[KB2._get_rule(read.parse_input(items[6]))].plan
+        self.assertEqual(plan.carried, [[], ['?x', '?y'], ['?x', '?z'], ['?x', '?z', '?w']])
+        self.assertEqual([len(tokens) for tokens in plan.levels], [1, 3, 1])
+
+        for KB in (KB1, KB2):
+            KB.kb_retract(read.parse_input("fact: (same block block)"))
+            KB.kb_retract(read.parse_input("fact: (isa ?z toy)"))
+        self.assertEqual(supports(KB2), supports(KB1))
+        self.assertEqual(set(KB2.rules), set(KB1.rules))
+        self.assertEqual([len(tokens) for tokens in plan.levels], [1, 2, 0])
+
+    def test36(self):
+        # parallel engine spreads groups without constants and keeps facts with variables local
+        engine = ParallelInferenceEngine(2)
+        try:
+            KB = KnowledgeBase([], [], engine)
+            KB.kb_load('statements_kb5.txt')
+            group = engine.group_of[KB.rules[0]]
+            self.assertEqual(group.positions, ())
+            self.assertEqual([list(engine.workers_of(group, (), number)) for number in range(4)],
+                             [[0], [1], [0], [1]])
+            self.assertEqual(list(engine.workers_of(group, ())), [0, 1])
+            item = read.parse_input("fact: (motherof ?z dot)")
+            KB.kb_assert(item)
+            self.KB.kb_assert(item)
+            self.assertEqual(set(KB.facts), set(self.KB.facts))
+            KB.kb_retract(item)
+            KB.kb_assert(read.parse_input("fact: (motherof bing dot)"))
+            self.assertIn(Fact(read.parse_input("fact: (grandmotherof ada dot)").statement), KB.facts)
+        finally:
+            engine.close()
+        import benchmarks.run
+        results = benchmarks.run.run(['family'], [60], ['parallel'], operations=5, memory=False,
+                                     output=io.StringIO(), processes=[1, 2])
+        self.assertEqual([r['processes'] for r in results], [1, 2])
+        self.assertEqual(results[0]['facts'], results[1]['facts'])
+
+    def test37(self):
+        # a partner keeps supporting a dependent while another justification still uses it
+        items = ["rule: ((p ?x)) -> (q c)", "fact: (p a)", "fact: (p b)"]
+        for engine in (None, ReteInferenceEngine(), BatchInferenceEngine()):
+            KB = KnowledgeBase([], [], engine) if engine else KnowledgeBase([], [])
+            for item in items:
+                KB.kb_assert(read.parse_input(item))
+            rule = KB._get_rule(read.parse_input(items[0]))
+            KB.kb_retract(read.parse_input("fact: (p a)"))
+            self.assertEqual(len(rule.supports_facts), 1)
+            KB.kb_retract(read.parse_input(items[0]), retract_rules=True)
+            self.assertEqual([str(fact.statement) for fact in KB.facts], ["(p b)"])
+
+        items = ["rule: ((r c) (r ?z) (q ?x ?y)) -> (q ?y ?z)",
+                 "rule: ((p ?x ?z) (r ?z) (p ?y a)) -> (q ?x b)",
+                 "fact: (p b a)", "fact: (r c)", "fact: (r a)"]
+        results = []
+        for engine in (None, ReteInferenceEngine(), BatchInferenceEngine()):
+            KB = KnowledgeBase([], [], engine) if engine else KnowledgeBase([], [])
+            for item in items:
+                KB.kb_assert(read.parse_input(item))
+            KB.kb_retract(read.parse_input("fact: (r a)"))
+            results.append((sorted(str(fact.statement) for fact in KB.facts),
+                            sorted(str(rule) for rule in KB.rules)))
+        self.assertEqual(results[0][0], ["(p b a)", "(q c c)", "(r c)"])
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test38(self):
+        # rete matches facts with variables against constants of the premises
+        fact = "fact: (p ?x b)"
+        rule = "rule: ((p a ?y)) -> (q ?y)"
+        for items in ([fact, rule], [rule, fact]):
+            engine = ReteInferenceEngine()
+            KB = KnowledgeBase([], [], engine)
+            for item in items:
+                KB.kb_assert(read.parse_input(item))
+            self.assertIn("(q b)", [str(f.statement) for f in KB.facts])
+            self.assertEqual(engine.alpha_memories[("p", 2, ((0, "a"),), ())].facts, {})
+            KB.kb_retract(read.parse_input(fact))
+            self.assertEqual([str(f.statement) for f in KB.facts], [])
+
+        items = ["fact: (r ?z c)", "rule: ((r a ?x) (s ?x ?y)) -> (t ?y)", "fact: (s c d)", "fact: (s e f)"]
+        engine = ReteInferenceEngine()
+        KB = KnowledgeBase([], [], engine)
+        for item in items:
+            KB.kb_assert(read.parse_input(item))
+        self.assertEqual(sorted(str(f.statement) for f in KB.facts),
+                         ["(r ?z c)", "(s c d)", "(s e f)", "(t d)"])
+        self.assertEqual([len(rules) for rules in engine.wild.values()], [1])
+
+    def test39(self):
+        # batch keeps rules curried from facts with variables apart and matches them like the default engine
+        cases = [(["rule: ((q ?z ?x) (r ?y ?x)) -> (q ?x ?x)", "fact: (q ?y a)", "fact: (q ?z a)"],
+                  "rule: ((q ?z ?x) (r ?y ?x)) -> (q ?x ?x)"),
+                 (["rule: ((r ?y c) (r ?x ?z) (q a ?x)) -> (r ?y ?y)", "fact: (r c ?x)", "fact: (r a b)"],
+                  "fact: (r c ?x)")]
+        def state(KB):
+            return (sorted((str(f.statement), len(f.supported_by), len(f.supports_facts),
+                            len(f.supports_rules)) for f in KB.facts),
+                    sorted((str(r), len(r.supported_by)) for r in KB.rules))
+        for items, retracted in cases:
+            KB1 = KnowledgeBase([], [])
+            KB2 = KnowledgeBase([], [], BatchInferenceEngine())
+            for KB in (KB1, KB2):
+                for item in items:
+                    KB.kb_assert(read.parse_input(item))
+            self.assertEqual(state(KB2), state(KB1))
+            for KB in (KB1, KB2):
+                KB.kb_retract(read.parse_input(retracted), retract_rules=True)
+            self.assertEqual(state(KB2), state(KB1))
+            self.assertEqual(set(KB2.ie.tokens_of), set(KB2.rules))
+
+    def test40(self):
+        # restarted parallel workers only join what is new, like the default engine
+        firings = []
+        for engine in (None, ParallelInferenceEngine(2)):
+            stats = Instrumentation()
+            KB = KnowledgeBase([], [], engine, stats=stats) if engine else KnowledgeBase([], [], stats=stats)
+            try:
+                KB.kb_load('statements_kb5.txt')
+                if engine:
+                    engine.close()
+                before = stats.firings
+                KB.kb_assert(read.parse_input("fact: (motherof dot ada)"))
+                KB.kb_retract(read.parse_input("fact: (motherof dot ada)"))
+                if engine:
+                    engine.close()
+                KB.kb_assert(read.parse_input("fact: (motherof dot ada)"))
+                firings.append((stats.firings - before, sorted(str(fact.statement) for fact in KB.facts)))
+            finally:
+                if engine:
+                    engine.close()
+        self.assertEqual(firings[1], firings[0])
+        self.assertIn("(grandmotherof dot bing)", firings[0][1])
+
+    def test41(self):
+        # a loaded snapshot answers from the mapped file and builds the KB on first use
+        KB0 = KnowledgeBase([], [])
+        KB0.kb_load('statements_kb5.txt')
+        KB0.kb_assert(read.parse_input("fact: (motherof ?z zed)"))
+        path = os.path.join(tempfile.mkdtemp(), 'kb.snap')
+        KB0.save_snapshot(path)
+        KB = KnowledgeBase([], [], ReteInferenceEngine())
+        KB.load_snapshot(path)
+        self.assertIsNotNone(KB.mapped)
+        self.assertNotIn('facts', vars(KB))
+        for question in ["(grandmotherof ada ?X)", "(motherof ?X chen)", "(motherof dot zed)",
+                         "(motherof ?X ?Y)", "(motherof ?X ?X)", "(nosuch ?X)", "(motherof nobody ?X)"]:
+            ask = read.parse_input("fact: " + question)
+            self.assertEqual(str(KB.kb_ask(ask)), str(KB0.kb_ask(ask)))
+        self.assertIsNotNone(KB.mapped)
+        answers = KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        fact = answers.list_of_bindings[0][1][0]
+        self.assertEqual(len(fact.supported_by), len(KB0._get_fact(fact).supported_by))
+
+        self.assertEqual(len(KB.facts), len(KB0.facts))
+        self.assertIsNone(KB.mapped)
+        self.assertIs(KB._get_fact(fact), fact)
+        for fact in KB.facts:
+            fact0 = KB0._get_fact(fact)
+            self.assertEqual((fact.asserted, len(fact.supported_by), len(fact.supports_facts),
+                              len(fact.supports_rules)),
+                             (fact0.asserted, len(fact0.supported_by), len(fact0.supports_facts),
+                              len(fact0.supports_rules)))
+        for K in (KB, KB0):
+            K.kb_assert(read.parse_input("fact: (motherof bing zed)"))
+        ask = read.parse_input("fact: (grandmotherof ?X zed)")
+        self.assertEqual(str(KB.kb_ask(ask)), str(KB0.kb_ask(ask)))
+
 
     
     
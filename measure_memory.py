@@ -0,0 +1,77 @@
+"""Reports the memory used per fact and per rule of a saturated KnowledgeBase,
+    for the statements_kb*.txt files, a synthetic KB of an isa chain and the
+    facts of that chain alone.
+
+Usage:
+    python measure_memory.py [chain length, default 2000]
+"""
+import glob, gc, sys, tracemalloc
+import read
+from logical_classes import *
+from student_code import KnowledgeBase
+
+def measure(build):
+    """Measure the memory still allocated by what build() returns
+
+    Args:
+        build (callable): returns the object to measure
+
+    Returns:
+        (any, int): the built object and the bytes it holds on to
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, after - before
+
+def chain(length):
+    """Facts and rules of a synthetic KB: an isa chain of the given length,
+        an inst fact at its start and the rule walking inst down the chain
+    """
+    data = [read.parse_input("fact: (isa c%d c%d)" % (i, i + 1)) for i in range(length)]
+    data.append(read.parse_input("fact: (inst box c0)"))
+    data.append(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+    return data
+
+def isa_facts(length):
+    """Facts of the isa chain alone, to measure a KB holding no rules
+    """
+    return [read.parse_input("fact: (isa c%d c%d)" % (i, i + 1)) for i in range(length)]
+
+def report(name, data):
+    """Print bytes per parsed fact and per parsed rule, and per fact or rule of
+        the saturated KB built from data
+    """
+    fact_lines = ["fact: " + source(item) for item in data if isinstance(item, Fact)]
+    rule_lines = ["rule: " + source(item) for item in data if isinstance(item, Rule)]
+    facts, fact_bytes = measure(lambda: [read.parse_input(line) for line in fact_lines])
+    rules, rule_bytes = measure(lambda: [read.parse_input(line) for line in rule_lines])
+    KB, kb_bytes = measure(lambda: load(fact_lines + rule_lines))
+    print('{:<20} fact {:>5.0f} B  rule {:>5.0f} B  KB of {:>5} facts, {:>5} rules {:>6.0f} B each'.format(
+        name, fact_bytes / max(len(facts), 1), rule_bytes / max(len(rules), 1),
+        len(KB.facts), len(KB.rules), kb_bytes / max(len(KB.facts) + len(KB.rules), 1)))
+
+def load(lines):
+    """Saturated KB of the facts and rules parsed from the given lines
+    """
+    KB = KnowledgeBase([], [])
+    KB.kb_assert_many([read.parse_input(line) for line in lines])
+    return KB
+
+def source(item):
+    """Text form of a parsed fact or rule, as read.parse_input expects it
+    """
+    if isinstance(item, Fact):
+        return str(item.statement)
+    return "(" + " ".join(str(s) for s in item.lhs) + ") -> " + str(item.rhs)
+
+if __name__ == '__main__':
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for file in sorted(glob.glob('statements_kb*.txt')):
+        report(file, read.read_tokenize(file))
+    report('chain %d' % length, chain(length))
+    report('facts %d' % length, isa_facts(length))
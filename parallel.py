@@ -0,0 +1,468 @@
+import multiprocessing, os
+from util import *
+from logical_classes import *
+from batch import BatchInferenceEngine
+
+class PremiseGroup(object):
+    """Rules whose first LHS statement has the same shape: predicate, arity,
+        positions holding constants and positions repeating a variable. The
+        rules of a group only differ by the constants at those positions, so
+        the workers partition them, and the facts of the predicate, by the
+        constants at those positions.
+
+    Attributes:
+        predicate (str): predicate of the first LHS statements
+        arity (int): number of terms of the first LHS statements
+        positions (tupleof int): positions holding constants
+        repeats (tupleof (int, int)): positions repeating a variable, with the
+            position of its first occurrence
+        rules (dictof Rule): maps the slot of each rule of the group to the
+            rule, slots being numbered in the order rules joined the group
+        keys (dictof tupleof int): symbol ids of the constants of each slot
+        slot_of (dictof int): maps each rule of the group to its slot
+        next_slot (int): slot the next rule will get
+    """
+    def __init__(self, key):
+        """Constructor for PremiseGroup
+
+        Args:
+            key (tuple): shape of the statement, see group_key
+        """
+        super(PremiseGroup, self).__init__()
+        self.predicate, self.arity, self.positions, self.repeats = key
+        self.rules = {}
+        self.keys = {}
+        self.slot_of = {}
+        self.next_slot = 0
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'PremiseGroup({!r}, {!r}, {!r} rules)'.format(
+                self.predicate, self.positions, len(self.slot_of))
+
+    def add(self, rule):
+        """Add a rule at the end of the group
+        """
+        terms = rule.lhs[0].terms
+        slot = self.slot_of[rule] = self.next_slot
+        self.next_slot += 1
+        self.rules[slot] = rule
+        self.keys[slot] = tuple(terms[pos].term.id for pos in self.positions)
+
+    def remove(self, rule):
+        """Remove a rule from the group, if present
+        """
+        slot = self.slot_of.pop(rule, None)
+        if slot is not None:
+            del self.rules[slot]
+            del self.keys[slot]
+
+def group_key(statement):
+    """Shape of a first LHS statement used to group rules: predicate, arity,
+        positions holding constants and positions repeating a variable
+
+    Args:
+        statement (Statement): first LHS statement of a rule
+
+    Returns:
+        tuple: (predicate, arity, positions, repeats)
+    """
+    positions = []
+    repeats = []
+    first_seen = {}
+    for pos, term in enumerate(statement.terms):
+        element = term.term.element
+        if not is_var(term):
+            positions.append(pos)
+        elif element in first_seen:
+            repeats.append((pos, first_seen[element]))
+        else:
+            first_seen[element] = pos
+    return (statement.predicate, len(statement.terms), tuple(positions), tuple(repeats))
+
+def encode(statement):
+    """Encode a statement as a tuple of ints: the symbol id of the predicate,
+        then the symbol id of each constant and -(id + 1) for each variable
+
+    Args:
+        statement (Statement): statement to encode
+
+    Returns:
+        tupleof int
+    """
+    codes = [symbols.intern(statement.predicate)]
+    for term in statement.terms:
+        codes.append(-term.term.id - 1 if is_var(term) else term.term.id)
+    return tuple(codes)
+
+def decode(codes):
+    """Statement encoded by encode, built from the shared terms of the symbols
+
+    Args:
+        codes (tupleof int): encoded statement
+
+    Returns:
+        Statement
+    """
+    terms = [symbols.term(symbols.name_of(code if code >= 0 else -code - 1))
+             for code in codes[1:]]
+    return Statement([symbols.name_of(codes[0])] + terms)
+
+def substitute(codes, binding):
+    """Replace the variables of an encoded statement bound in binding
+    """
+    return tuple(binding.get(code, code) if code < 0 else code for code in codes)
+
+def worker_main(conn):
+    """Loop of a worker process. A worker holds, for every rule group, the
+        part of the facts and rules whose constants at the group's positions
+        hash to it, and joins each round's new facts and rules with them
+        (partitioned symmetric hash join). Facts travel as (number, encoded
+        statement), rules as (slot, encoded LHS statements, encoded RHS).
+
+        Each message is (drops, deltas, report): drops lists (group key,
+        constants, 'fact'|'rule', number or slot) to forget, deltas lists
+        (group key, new facts, new rules, joined). The reply lists (group
+        key, phase, fact number, slot, encoded remaining LHS, encoded RHS)
+        for every match, phase 0 for new facts with older rules and 1 for
+        new rules with all facts. Deltas are only stored, not joined, when
+        report or their joined flag is False; the reply is then empty for
+        them. A None message stops the worker.
+    """
+    groups = {}
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        drops, deltas, report = message
+        for key, constants, kind, number in drops:
+            group = groups.get(key)
+            if group is not None:
+                group[0 if kind == 'fact' else 1].get(constants, {}).pop(number, None)
+        results = []
+        for key, facts, rules, joined in deltas:
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = ({}, {})
+            positions, repeats = key[2], key[3]
+            joined = joined and report
+            by_fact, by_rule = group
+            for number, codes in facts:
+                if any(codes[pos + 1] != codes[first + 1] for pos, first in repeats):
+                    continue
+                constants = tuple(codes[pos + 1] for pos in positions)
+                if joined:
+                    for slot, (lhs, rhs) in by_rule.get(constants, {}).items():
+                        results.append(fire(key, 0, number, codes, slot, lhs, rhs))
+                by_fact.setdefault(constants, {})[number] = codes
+            for slot, lhs, rhs in rules:
+                constants = tuple(lhs[0][pos + 1] for pos in positions)
+                by_rule.setdefault(constants, {})[slot] = (lhs, rhs)
+                if joined:
+                    for number, codes in by_fact.get(constants, {}).items():
+                        results.append(fire(key, 1, number, codes, slot, lhs, rhs))
+        conn.send(results)
+    conn.close()
+
+def fire(key, phase, number, codes, slot, lhs, rhs):
+    """Result of a worker for a fact matching the first LHS statement of a rule
+    """
+    binding = {}
+    for code, value in zip(lhs[0][1:], codes[1:]):
+        if code < 0:
+            binding[code] = value
+    return (key, phase, number, slot,
+            tuple(substitute(statement, binding) for statement in lhs[1:]),
+            substitute(rhs, binding))
+
+class ParallelInferenceEngine(BatchInferenceEngine):
+    """Inference engine saturating a KB in rounds like BatchInferenceEngine,
+        with the joins and instantiation of each round spread over a pool of
+        worker processes (see worker_main). Rules are grouped by the shape of
+        their first LHS statement (see PremiseGroup) and joined one premise at
+        a time, curried rules going through the next round, as InferenceEngine
+        does. Facts and rules are partitioned between workers by a hash of
+        their constants at the join positions of each rule group. Groups
+        without constants have nothing to hash, so their facts are dealt out by
+        fact number and their rules are sent to every worker. Workers are only
+        sent what is new every round, and groups of predicates with facts
+        holding variables are stored by the workers but matched in the calling
+        process. The results are fired in the KB in a fixed order, so the
+        facts, rules and support links are the same as with InferenceEngine
+        whatever the number of workers. Creating the inferred facts, rules and
+        support links stays in the calling process.
+
+    Attributes:
+        processes (int): number of worker processes
+        groups (dictof PremiseGroup): rule groups by shape
+        group_of (dictof PremiseGroup): the group each rule sits in
+        workers (listof (Process, Connection)): worker processes, started on
+            first use
+        sent (dictof int): number of rules of each group sent to the workers
+        numbers (dictof int): number each fact sent to the workers has
+        facts_by_number (dictof Fact): maps a fact number back to the fact
+        next_number (int): number the next fact sent will get
+        drops (listof tuple): facts and rules removed since the last round,
+            for the workers to forget
+    """
+    def __init__(self, processes=None):
+        """Constructor for ParallelInferenceEngine
+
+        Args:
+            processes (int|None): number of worker processes, defaults to the
+                number of CPUs
+        """
+        super(ParallelInferenceEngine, self).__init__()
+        self.processes = processes or os.cpu_count() or 1
+        self.groups = {}
+        self.group_of = {}
+        self.workers = []
+        self.sent = {}
+        self.numbers = {}
+        self.facts_by_number = {}
+        self.next_number = 0
+        self.drops = []
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'ParallelInferenceEngine({!r} processes, {!r} groups, {!r} rules)'.format(
+                self.processes, len(self.groups), len(self.group_of))
+
+    def start(self):
+        """Start the worker processes if they are not running
+        """
+        if self.workers:
+            return
+        for _ in range(self.processes):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=worker_main, args=(child,))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.workers.append((process, parent))
+
+    def close(self):
+        """Stop the worker processes. They are started again if the KB needs
+            them and handed the facts and rules already joined, see resync.
+        """
+        for process, conn in self.workers:
+            conn.send(None)
+            conn.close()
+            process.join()
+        self.workers = []
+        self.drops = []
+
+    def resync(self, kb):
+        """Start the workers if they are not running, and hand them every fact
+            and rule of the groups without joining them: those pairs were
+            matched before, so only what comes next is joined
+
+        Args:
+            kb (KnowledgeBase) - The KnowledgeBase of the facts and rules
+        """
+        if not self.workers:
+            self.start()
+            # new workers hold nothing, everything is sent again
+            self.sent = {}
+            self.drops = []
+        self.send(self.deltas({}, kb)[0], False)
+        for process, conn in self.workers:
+            conn.recv()
+
+    def workers_of(self, group, constants, number=None):
+        """Indexes of the workers holding a fact or rule of a group: the one
+            the constants at the join positions hash to, or for groups
+            without constants, the one the fact number falls to and every
+            worker for a rule
+
+        Args:
+            group (PremiseGroup): group of the fact or rule
+            constants (tupleof int): symbol ids at the group's positions
+            number (int|None): number of the fact, None for a rule
+
+        Returns:
+            range: worker indexes
+        """
+        if group.positions:
+            worker = hash(constants) % self.processes
+        elif number is not None:
+            worker = number % self.processes
+        else:
+            return range(self.processes)
+        return range(worker, worker + 1)
+
+    def run_round(self, new_facts, new_rules, kb):
+        """Send the facts and rules of one round to the workers, then fire the
+            matches they report
+
+        Args:
+            new_facts (dictof listof Fact): new facts by (predicate, arity)
+            new_rules (listof Rule): new rules
+            kb (KnowledgeBase) - The KnowledgeBase they were added to
+        """
+        if not self.workers:
+            self.resync(kb)
+        for rule in new_rules:
+            key = group_key(rule.lhs[0])
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = PremiseGroup(key)
+            group.add(rule)
+            self.group_of[rule] = group
+        deltas, order, local = self.deltas(new_facts, kb)
+        self.send(deltas, True)
+        results = []
+        for process, conn in self.workers:
+            results.extend(conn.recv())
+        results.sort(key=lambda result: (order[result[0]], result[1], result[2], result[3]))
+        stats = kb.stats
+        for key, phase, number, slot, lhs, rhs in results:
+            group = self.groups[key]
+            fact, rule = self.facts_by_number.get(number), group.rules.get(slot)
+            if fact is None or rule is None:
+                continue
+            if stats is not None:
+                stats.joined(rule)
+            self.fc_assert(fact, rule, [decode(codes) for codes in lhs], decode(rhs), kb)
+        for table, group, pairs in local:
+            for row, slot in pairs:
+                fact, rule = table.facts[row], group.rules.get(slot)
+                if fact is not None and rule is not None:
+                    self.fc_infer(fact, rule, kb)
+
+    def deltas(self, new_facts, kb):
+        """What each worker has to be sent for a round: for every group, the
+            facts and rules it has not seen yet
+
+        Args:
+            new_facts (dictof listof Fact): new facts by (predicate, arity)
+            kb (KnowledgeBase) - The KnowledgeBase of the facts
+
+        Returns:
+            (listof list, dictof int, listof tuple): the deltas of each
+                worker, the position of each group key, and (table, group,
+                (row, slot) pairs) to match locally for groups of facts
+                with variables
+        """
+        deltas = [[] for _ in self.workers]
+        order = {}
+        local = []
+        for index, (key, group) in enumerate(self.groups.items()):
+            order[key] = index
+            table = kb.fact_index.tables.get((group.predicate, group.arity))
+            sent = self.sent.get(key, 0)
+            if table is None:
+                facts = ()
+            elif key not in self.sent:
+                # a group new to the workers needs every fact of its predicate
+                facts = [fact for fact in table.facts if fact is not None]
+            else:
+                facts = new_facts.get((group.predicate, group.arity), ())
+            joined = table is None or group.predicate not in kb.fact_index.nonground
+            if not joined:
+                # facts with variables cannot be joined on symbol ids, match
+                # them here as BatchInferenceEngine does
+                rows = [table.row_of[fact] for fact in new_facts.get((group.predicate, group.arity), ())
+                        if fact in table.row_of]
+                pairs = [(row, slot) for row in rows for slot in group.rules if slot < sent]
+                pairs += [(row, slot) for row, fact in enumerate(table.facts) if fact is not None
+                          for slot in group.rules if slot >= sent]
+                local.append((table, group, pairs))
+            facts_of = [[] for _ in self.workers]
+            for fact in facts:
+                codes = self.encode_fact(fact)
+                number = self.numbers[fact]
+                for worker in self.workers_of(group, tuple(codes[pos + 1] for pos in group.positions),
+                                              number):
+                    facts_of[worker].append((number, codes))
+            rules_of = [[] for _ in self.workers]
+            for slot in range(sent, group.next_slot):
+                rule = group.rules.get(slot)
+                if rule is None:
+                    continue
+                lhs = tuple(encode(statement) for statement in rule.lhs)
+                for worker in self.workers_of(group, group.keys[slot]):
+                    rules_of[worker].append((slot, lhs, encode(rule.rhs)))
+            self.sent[key] = group.next_slot
+            for worker in range(len(self.workers)):
+                if facts_of[worker] or rules_of[worker]:
+                    deltas[worker].append((key, facts_of[worker], rules_of[worker], joined))
+        return deltas, order, local
+
+    def send(self, deltas, report):
+        """Send the pending drops and the deltas of a round to the workers
+
+        Args:
+            deltas (listof list): deltas of each worker
+            report (bool): whether the workers join the deltas and reply
+                with the matches, or only store them
+        """
+        drops = [[] for _ in self.workers]
+        for key, constants, kind, number in self.drops:
+            group = self.groups[key]
+            for worker in self.workers_of(group, constants, number if kind == 'fact' else None):
+                drops[worker].append((key, constants, kind, number))
+        self.drops = []
+        for (process, conn), worker_drops, worker_deltas in zip(self.workers, drops, deltas):
+            conn.send((worker_drops, worker_deltas, report))
+
+    def restored(self, kb):
+        """Group the forward-chained rules of a KB restored from a snapshot
+            and hand the workers every fact and rule without joining them, so
+            the next round only joins what is new
+
+        Args:
+            kb (KnowledgeBase) - The restored KnowledgeBase
+        """
+        for rule in kb.rules:
+            if kb._forward_chained(rule) and rule not in self.group_of:
+                key = group_key(rule.lhs[0])
+                group = self.groups.get(key)
+                if group is None:
+                    group = self.groups[key] = PremiseGroup(key)
+                group.add(rule)
+                self.group_of[rule] = group
+        self.resync(kb)
+
+    def encode_fact(self, fact):
+        """Encode a fact to send to the workers, numbering it on first use
+        """
+        if fact not in self.numbers:
+            number = self.numbers[fact] = self.next_number
+            self.facts_by_number[number] = fact
+            self.next_number += 1
+        return encode(fact.statement)
+
+    def fact_removed(self, fact, kb):
+        """Have the workers forget a removed fact on the next round
+
+        Args:
+            fact (Fact) - The removed fact
+            kb (KnowledgeBase) - The KnowledgeBase it was removed from
+        """
+        number = self.numbers.pop(fact, None)
+        if number is None:
+            return
+        del self.facts_by_number[number]
+        statement = fact.statement
+        codes = encode(statement)
+        for key, group in self.groups.items():
+            if (group.predicate, group.arity) == (statement.predicate, len(statement.terms)):
+                constants = tuple(codes[pos + 1] for pos in group.positions)
+                self.drops.append((key, constants, 'fact', number))
+
+    def rule_removed(self, rule, kb):
+        """Drop a removed rule from its group and have the workers forget it
+            on the next round
+
+        Args:
+            rule (Rule) - The removed rule
+            kb (KnowledgeBase) - The KnowledgeBase it was removed from
+        """
+        group = self.group_of.pop(rule, None)
+        if group is not None:
+            slot = group.slot_of.get(rule)
+            self.drops.append((group_key(rule.lhs[0]), group.keys[slot], 'rule', slot))
+            group.remove(rule)
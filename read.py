@@ -1,3 +1,5 @@
+import io, multiprocessing, os, re
+from array import array
 from logical_classes import *
 
 # read_tokenize takes the name of a file, reads it in and tokenizes the
@@ -17,23 +19,374 @@ def read_tokenize(file):
         A list of Facts and Rules.
     """
     file = open(file, "r")
-    elements = []
-    current = ""
-    for line in file:
-        if line[0:5] in ("fact:", "rule:"):
-            elements.append(current)
-            current = line.rstrip()
-        else:
-            current = current + " " + line.rstrip().strip()
-    elements.append(current)
     output = []
-    for e in elements:
+    for e in split_entries(file):
         parsed = parse_input(e)
         if isinstance(parsed, Fact) or isinstance(parsed, Rule):
             output.append(parsed)
     file.close()
     return output
 
+def split_entries(lines):
+    """Join the lines of a statements file into one string per entry, an
+        entry starting at each line beginning with "fact:" or "rule:". The
+        first string holds whatever comes before the first entry.
+
+    Args:
+        lines (iterable of str): lines of the file
+
+    Yields:
+        str: text of each entry, for parse_input
+    """
+    current = ""
+    for line in lines:
+        if line[0:5] in ("fact:", "rule:"):
+            yield current
+            current = line.rstrip()
+        else:
+            current = current + " " + line.rstrip().strip()
+    yield current
+
+def read_parallel(file, processes=None, chunk_size=1 << 22):
+    """Read a statements file like read_tokenize, parsing it in a pool of
+        worker processes. The file is split into chunks of about chunk_size
+        bytes at lines starting with "fact:" or "rule:", so every entry sits
+        in one chunk. Workers send each chunk back as symbol ids (see
+        parse_chunk) rather than pickled Facts and Rules, and the facts and
+        rules are built from the shared terms of the symbols here. Gives the
+        same facts and rules as read_tokenize, in the same order.
+
+    Args:
+        file (str): name of a statements file
+        processes (int|None): number of worker processes, defaults to the
+            number of CPUs
+        chunk_size (int): approximate size of a chunk in bytes
+
+    Returns:
+        listof Fact|Rule
+    """
+    bounds = chunk_bounds(file, chunk_size)
+    tasks = [(file, start, end) for start, end in zip(bounds, bounds[1:])]
+    if len(tasks) < 2 or processes == 1:
+        chunks = map(parse_chunk, tasks)
+        return [fact_rule for chunk in chunks for fact_rule in decode_chunk(*chunk)]
+    with multiprocessing.Pool(processes) as pool:
+        return [fact_rule for chunk in pool.imap(parse_chunk, tasks)
+                for fact_rule in decode_chunk(*chunk)]
+
+def chunk_bounds(file, chunk_size):
+    """Byte offsets splitting a statements file into chunks of about
+        chunk_size bytes, each but the first starting at a line that begins
+        with "fact:" or "rule:"
+
+    Returns:
+        listof int: offsets from 0 to the size of the file
+    """
+    size = os.path.getsize(file)
+    bounds = [0]
+    with open(file, "rb") as f:
+        while bounds[-1] + chunk_size < size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            while True:
+                start = f.tell()
+                line = f.readline()
+                if not line or line[0:5] in (b"fact:", b"rule:"):
+                    break
+            if not line:
+                break
+            bounds.append(start)
+    bounds.append(size)
+    return bounds
+
+def parse_chunk(task):
+    """Parse a chunk of a statements file in a worker process, as
+        read_tokenize would, into symbol ids
+
+    Args:
+        task (str, int, int): file name and byte offsets of the chunk
+
+    Returns:
+        (listof str, bytes): the symbols of the chunk, and an int32 array
+            holding for each entry -1 for a fact or the number of LHS
+            statements of a rule, then each statement (the LHS, then the RHS)
+            as its length followed by the ids of its predicate and terms
+    """
+    file, start, end = task
+    with open(file, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode()
+    ids = {}
+    codes = array('i')
+    for e in split_entries(io.StringIO(text, newline=None)):
+        if e[0:5] == "fact:":
+            codes.append(-1)
+            statements = [fact_terms(e)]
+        elif e[0:5] == "rule:":
+            lhs, rhs = rule_terms(e)
+            codes.append(len(lhs))
+            statements = lhs + [rhs]
+        else:
+            # comments, blank text and errors, reported as read_tokenize does
+            parse_input(e)
+            continue
+        for statement in statements:
+            codes.append(len(statement))
+            for name in statement:
+                number = ids.get(name)
+                if number is None:
+                    number = ids[name] = len(ids)
+                codes.append(number)
+    return list(ids), codes.tobytes()
+
+def decode_chunk(names, data):
+    """Facts and rules of a chunk parsed by parse_chunk
+
+    Args:
+        names (listof str): symbols of the chunk
+        data (bytes): int32 codes of the chunk
+
+    Yields:
+        Fact|Rule
+    """
+    terms = [symbols.term(name) for name in names]
+    codes = array('i')
+    codes.frombytes(data)
+    codes = codes.tolist()
+    def statement(start, end):
+        if start == end:
+            return Statement([])
+        return Statement([names[codes[start]]] + [terms[i] for i in codes[start + 1:end]])
+    position = 0
+    while position < len(codes):
+        kind = codes[position]
+        if kind < 0:
+            end = position + 2 + codes[position + 1]
+            yield Fact(statement(position + 2, end))
+            position = end
+            continue
+        position += 1
+        statements = []
+        for _ in range(kind + 1):
+            end = position + 1 + codes[position]
+            statements.append(statement(position + 1, end))
+            position = end
+        yield Rule([statements[:-1], statements[-1]])
+
+
+# tokens of a statements file: a whole statement when it sits on one line,
+# parentheses, the rule arrow and anything else up to a space or parenthesis
+# (headers, and predicates and terms of statements spanning lines)
+TOKEN = re.compile(r'\([^()]*\)|[()]|->|[^\s()]+')
+
+HEADERS = ('fact:', 'rule:')
+
+class ParseError(ValueError):
+    """Error in a statements file, at a given line and column (both from 1)
+
+    Attributes:
+        line (int): line of the error
+        column (int): column of the error
+        reason (str): what is wrong
+    """
+    def __init__(self, reason, line, column):
+        """Constructor for ParseError
+
+        Args:
+            reason (str): what is wrong
+            line (int): line of the error
+            column (int): column of the error
+        """
+        super(ParseError, self).__init__("line {}, column {}: {}".format(line, column, reason))
+        self.reason = reason
+        self.line = line
+        self.column = column
+
+def iter_statements(source, strict=True):
+    """Lazily read the facts and rules of a statements file, in one pass over
+        its lines, so only the entry being read is held in memory and each
+        fact or rule can be used (e.g. by kb_assert_many) before the rest of
+        the file is read. Entries start with "fact:" or "rule:" and may span
+        lines; rules may also put the arrow inside the outer parentheses, as
+        in "rule: ((a ?x) -> (b ?x))". Lines starting with "#" are comments.
+        Gives the same facts and rules as read_tokenize on well-formed files.
+
+    Args:
+        source (str|file): name of a statements file, or an open text file
+        strict (bool): raise ParseError on the first malformed entry, rather
+            than printing it with its location and skipping it
+
+    Yields:
+        Fact|Rule
+
+    Raises:
+        ParseError: on a malformed entry, if strict
+    """
+    if isinstance(source, str):
+        with open(source, "r") as file:
+            yield from iter_statements(file, strict)
+        return
+    entry = None
+    for number, line in enumerate(source, 1):
+        if line.lstrip().startswith('#'):
+            continue
+        for token in TOKEN.finditer(line):
+            text = token.group()
+            column = token.start() + 1
+            if text in HEADERS and (entry is None or entry.depth == 0 or column == 1):
+                done, entry = entry, Entry(text, number, column)
+                if done is not None and not done.failed:
+                    fact_rule = finish(done, strict)
+                    if fact_rule is not None:
+                        yield fact_rule
+                continue
+            try:
+                if entry is None:
+                    entry = Entry(None, number, column)
+                    raise ParseError("expected fact: or rule:, found {!r}".format(text),
+                                     number, column)
+                if not entry.failed:
+                    entry.feed(text, number, column)
+            except ParseError as e:
+                # skip the rest of the entry
+                entry.failed = True
+                report(e, strict)
+    if entry is not None and not entry.failed:
+        fact_rule = finish(entry, strict)
+        if fact_rule is not None:
+            yield fact_rule
+
+def finish(entry, strict):
+    """Fact or rule of an entry fed all its tokens, None if it is malformed
+        and not strict
+    """
+    try:
+        return entry.finish()
+    except ParseError as e:
+        report(e, strict)
+
+def report(error, strict):
+    """Raise a parse error if strict, else print it
+    """
+    if strict:
+        raise error
+    print("PARSE ERROR:", error)
+
+class Entry(object):
+    """Fact or rule being read by iter_statements, fed one token at a time
+
+    Attributes:
+        header (str|None): 'fact:' or 'rule:'
+        line (int): line of the header
+        column (int): column of the header
+        depth (int): number of open parentheses
+        statements (listof listof str): statements read so far, each a
+            predicate and terms
+        current (listof str|None): statement being read
+        opened (bool): whether the last token was "("
+        arrow (int|None): number of statements before the arrow, once read
+        position (tuple): line and column of the last token
+        failed (bool): whether the entry is malformed, its remaining tokens
+            are then skipped
+    """
+    def __init__(self, header, line, column):
+        """Constructor for Entry
+
+        Args:
+            header (str|None): 'fact:' or 'rule:', None for text that does
+                not start with either
+            line (int): line of the header
+            column (int): column of the header
+        """
+        super(Entry, self).__init__()
+        self.header = header
+        self.line = line
+        self.column = column
+        self.depth = 0
+        self.statements = []
+        self.current = None
+        self.opened = False
+        self.arrow = None
+        self.position = (line, column)
+        self.failed = False
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Entry({!r}, line {!r}, {!r} statements)'.format(
+                self.header, self.line, len(self.statements))
+
+    def feed(self, text, line, column):
+        """Read the next token of the entry
+
+        Raises:
+            ParseError: if the token cannot come next
+        """
+        self.position = (line, column)
+        opened, self.opened = self.opened, False
+        if text[0] == '(' and len(text) > 1:
+            if self.current is not None:
+                raise ParseError("'(' inside a statement", line, column)
+            statement = text[1:-1].split()
+            if not statement:
+                raise ParseError("empty statement", line, column)
+            if '->' in statement:
+                raise ParseError("'->' inside a statement", line, column)
+            self.statements.append(statement)
+        elif text == '(':
+            if self.current is not None:
+                raise ParseError("'(' inside a statement", line, column)
+            self.depth += 1
+            self.opened = True
+        elif text == ')':
+            if self.depth == 0:
+                raise ParseError("unbalanced ')'", line, column)
+            if opened:
+                raise ParseError("empty statement", line, column)
+            self.depth -= 1
+            if self.current is not None:
+                self.statements.append(self.current)
+                self.current = None
+        elif text == '->':
+            if self.header != 'rule:':
+                raise ParseError("'->' in a fact", line, column)
+            if self.arrow is not None:
+                raise ParseError("second '->' in a rule", line, column)
+            if self.current is not None:
+                raise ParseError("'->' inside a statement", line, column)
+            self.arrow = len(self.statements)
+        elif self.current is not None:
+            self.current.append(text)
+        elif opened:
+            self.current = [text]
+        else:
+            raise ParseError("{!r} outside a statement".format(text), line, column)
+
+    def finish(self):
+        """Fact or rule read, once every token was fed
+
+        Returns:
+            Fact|Rule
+
+        Raises:
+            ParseError: if the entry is incomplete
+        """
+        line, column = self.position
+        if self.depth:
+            raise ParseError("{} opened at line {}, column {} is missing ')'".format(
+                    self.header, self.line, self.column), line, column)
+        if self.header == 'fact:':
+            if len(self.statements) != 1:
+                raise ParseError("a fact needs one statement, found {}".format(
+                        len(self.statements)), self.line, self.column)
+            return Fact(self.statements[0])
+        if self.arrow is None:
+            raise ParseError("rule without '->'", self.line, self.column)
+        lhs, rhs = self.statements[:self.arrow], self.statements[self.arrow:]
+        if not lhs or len(rhs) != 1:
+            raise ParseError("a rule needs statements before '->' and one after",
+                             self.line, self.column)
+        return Rule([lhs, rhs[0]])
 
 def parse_input(e):
     """Parses input, assigning labels and splitting rules into LHS & RHS
@@ -51,19 +404,41 @@ def parse_input(e):
         #return (COMMENT, e)
         return e[1:]
     elif e[0:5] == "fact:":
-        e = e[5:].replace(")", "").replace("(", "").rstrip().strip().split()
         #return (FACT, e)
-        return Fact(e)
+        return Fact(fact_terms(e))
     elif e[0:5] == "rule:":
-        e = e[5:].split("->")
-        rhs = e[1].replace(")", "").replace("(", "").rstrip().strip().split()
-        lhs = e[0].rstrip(") ").strip("( ").replace("(", "").split(")")
-        lhs = map(lambda x: x.rstrip().strip().split(), lhs)
         #return (RULE, [lhs, rhs])
-        return Rule([lhs, rhs])
+        return Rule(rule_terms(e))
     else:
         print("PARSE ERROR: input header", e[0:5], "not recognized.")
 
+def fact_terms(e):
+    """Predicate and terms of a "fact:" entry
+
+    Args:
+        e (str): entry text, starting with "fact:"
+
+    Returns:
+        listof str
+    """
+    return e[5:].replace(")", "").replace("(", "").rstrip().strip().split()
+
+def rule_terms(e):
+    """LHS statements and RHS of a "rule:" entry, each as its predicate and
+        terms
+
+    Args:
+        e (str): entry text, starting with "rule:"
+
+    Returns:
+        [listof listof str, listof str]
+    """
+    e = e[5:].split("->")
+    rhs = e[1].replace(")", "").replace("(", "").rstrip().strip().split()
+    lhs = e[0].rstrip(") ").strip("( ").replace("(", "").split(")")
+    lhs = [x.rstrip().strip().split() for x in lhs]
+    return [lhs, rhs]
+
 def get_new_fact_or_rule():
     """Creates a new fact or rule. (instead of args, we use command line input
     via the read_from_input() function)
@@ -0,0 +1,420 @@
+from util import *
+from logical_classes import *
+from student_code import InferenceEngine
+
+class AlphaMemory(object):
+    """Facts passing the intra-statement tests of a rule premise: its predicate,
+        arity, constants and repeated variables. Premises with the same shape,
+        e.g. (inst ?x ?y) and (inst ?a ?b), share one AlphaMemory.
+
+    Attributes:
+        key (tuple): (predicate, arity, constants, equalities) shape of the premise
+        constants (tupleof (int, str)): positions that must hold a given constant
+        equalities (tupleof (int, int)): pairs of positions that must hold the
+            same element because the premise repeats a variable there
+        facts (dictof Fact): insertion-ordered set of the facts in this memory
+        indexes (dictof dict): maps a tuple of positions to a dict from the
+            elements at those positions to an insertion-ordered set of facts
+        successors (listof JoinNode): join nodes fed by this memory
+    """
+    def __init__(self, key):
+        """Constructor for AlphaMemory
+
+        Args:
+            key (tuple): shape of the premise, see alpha_key
+        """
+        super(AlphaMemory, self).__init__()
+        self.key = key
+        self.constants = key[2]
+        self.equalities = key[3]
+        self.facts = {}
+        self.indexes = {}
+        self.successors = []
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'AlphaMemory({!r}, {!r})'.format(self.key, len(self.facts))
+
+    def test(self, statement):
+        """Check whether a statement of the right predicate and arity passes
+            the constant and repeated variable tests of this memory
+        """
+        terms = statement.terms
+        for pos, element in self.constants:
+            if terms[pos].term.element != element:
+                return False
+        for pos, first in self.equalities:
+            if terms[pos].term.element != terms[first].term.element:
+                return False
+        return True
+
+    def add(self, fact):
+        """Add a fact to this memory and its indexes
+        """
+        self.facts[fact] = None
+        for positions, index in self.indexes.items():
+            index.setdefault(elements_at(fact.statement, positions), {})[fact] = None
+
+    def remove(self, fact):
+        """Remove a fact from this memory and its indexes, if present
+        """
+        if self.facts.pop(fact, False) is False:
+            return
+        for positions, index in self.indexes.items():
+            key = elements_at(fact.statement, positions)
+            bucket = index[key]
+            del bucket[fact]
+            if not bucket:
+                del index[key]
+
+    def lookup(self, positions, elements):
+        """Facts of this memory holding the given elements at the given positions
+
+        Args:
+            positions (tupleof int): positions to look at
+            elements (tupleof str): required element at each position
+
+        Returns:
+            listof Fact: matching facts in the order they were added
+        """
+        if not positions:
+            return list(self.facts)
+        index = self.indexes.get(positions)
+        if index is None:
+            index = {}
+            for fact in self.facts:
+                index.setdefault(elements_at(fact.statement, positions), {})[fact] = None
+            self.indexes[positions] = index
+        return list(index.get(elements, ()))
+
+class JoinNode(object):
+    """Joins the rules (tokens) waiting on one premise of a compiled rule with
+        the facts of that premise's AlphaMemory. A token at level k is the
+        curried rule left after matching premises 0..k-1, so its first LHS
+        statement is premise k with the join positions already bound.
+
+    Attributes:
+        alpha (AlphaMemory): memory of facts that can match the premise
+        positions (tupleof int): positions of the premise holding variables that
+            earlier premises have already bound
+        matcher (Matcher): matcher compiled from the premise, its bindings
+            cover the variables of every rule waiting at this node
+        child (JoinNode|None): node for the next premise, None for the last one
+        tokens (dictof dict): beta memory, maps the elements at positions to an
+            insertion-ordered set of the rules waiting on those elements
+    """
+    def __init__(self, alpha, positions, premise):
+        """Constructor for JoinNode
+
+        Args:
+            alpha (AlphaMemory): memory of facts that can match the premise
+            positions (tupleof int): join positions of the premise
+            premise (Statement): the premise itself
+        """
+        super(JoinNode, self).__init__()
+        self.alpha = alpha
+        self.positions = positions
+        self.matcher = premise.matcher()
+        self.child = None
+        self.tokens = {}
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'JoinNode({!r}, {!r})'.format(self.alpha, self.positions)
+
+    def add_token(self, rule):
+        """Add a rule to the beta memory of this node
+        """
+        key = elements_at(rule.lhs[0], self.positions)
+        self.tokens.setdefault(key, {})[rule] = None
+
+    def remove_token(self, rule):
+        """Remove a rule from the beta memory of this node, if present
+        """
+        key = elements_at(rule.lhs[0], self.positions)
+        bucket = self.tokens.get(key)
+        if bucket and rule in bucket:
+            del bucket[rule]
+            if not bucket:
+                del self.tokens[key]
+
+    def tokens_for(self, fact):
+        """Rules of the beta memory whose first LHS statement can match fact,
+            assuming fact already passed the alpha memory tests
+        """
+        return list(self.tokens.get(elements_at(fact.statement, self.positions), ()))
+
+    def facts_for(self, rule):
+        """Facts of the alpha memory that can match the first LHS statement of rule
+        """
+        return self.alpha.lookup(self.positions, elements_at(rule.lhs[0], self.positions))
+
+def elements_at(statement, positions):
+    """Elements held by the terms of statement at the given positions
+
+    Args:
+        statement (Statement): statement to read from
+        positions (tupleof int): positions to read
+
+    Returns:
+        tupleof str
+    """
+    terms = statement.terms
+    return tuple(terms[pos].term.element for pos in positions)
+
+def is_ground(statement):
+    """Check whether a statement holds no variables
+
+    Args:
+        statement (Statement): statement to check
+
+    Returns:
+        bool
+    """
+    return not any(is_var(term) for term in statement.terms)
+
+def alpha_key(statement):
+    """Shape of a premise used to share alpha memories: predicate, arity,
+        positions holding constants and positions repeating a variable
+
+    Args:
+        statement (Statement): premise of a rule
+
+    Returns:
+        tuple: (predicate, arity, constants, equalities)
+    """
+    constants = []
+    equalities = []
+    first_seen = {}
+    for pos, term in enumerate(statement.terms):
+        element = term.term.element
+        if not is_var(term):
+            constants.append((pos, element))
+        elif element in first_seen:
+            equalities.append((pos, first_seen[element]))
+        else:
+            first_seen[element] = pos
+    return (statement.predicate, len(statement.terms),
+            tuple(constants), tuple(equalities))
+
+class ReteInferenceEngine(InferenceEngine):
+    """Inference engine compiling asserted rules into a Rete network, usable by
+        KnowledgeBase in place of InferenceEngine. Each premise of a compiled
+        rule gets a JoinNode whose beta memory holds the curried rules waiting
+        on it, fed by an AlphaMemory shared between premises of the same shape.
+        New facts are only joined with rules whose bound elements they carry,
+        and new rules only with facts carrying those elements, so no match is
+        attempted that can fail. Facts with variables stay out of the alpha
+        memories, since their variables can stand for any constant the tests
+        compare against, and rules curried from them do not follow the
+        premises of their chain: both are matched with fc_infer like
+        InferenceEngine does. Inferred facts, curried rules and support links
+        are the same as with InferenceEngine.
+
+    Attributes:
+        alpha_memories (dictof AlphaMemory): alpha memories by shape
+        alpha_by_predicate (dictof listof AlphaMemory): alpha memories by
+            (predicate, arity), the ones a new fact has to be tested against
+        node_of (dictof JoinNode): the join node each rule in the network sits at
+        wild (dictof dict): maps (predicate, arity) of the first LHS statement
+            to an insertion-ordered set of the rules matched with fc_infer
+            instead of the network
+    """
+    def __init__(self):
+        """Constructor for ReteInferenceEngine
+        """
+        super(ReteInferenceEngine, self).__init__()
+        self.alpha_memories = {}
+        self.alpha_by_predicate = {}
+        self.node_of = {}
+        self.wild = {}
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'ReteInferenceEngine({!r} alpha memories, {!r} rules)'.format(
+                len(self.alpha_memories), len(self.node_of))
+
+    def alpha_memory(self, statement, kb):
+        """Get the alpha memory for the shape of statement, creating and filling
+            it from the facts of kb if needed
+        """
+        key = alpha_key(statement)
+        alpha = self.alpha_memories.get(key)
+        if alpha is None:
+            alpha = AlphaMemory(key)
+            for fact in kb.fact_index.candidates(statement):
+                if fact in kb.pending or not is_ground(fact.statement):
+                    continue
+                if len(fact.statement.terms) == key[1] and alpha.test(fact.statement):
+                    alpha.add(fact)
+            self.alpha_memories[key] = alpha
+            self.alpha_by_predicate.setdefault(key[:2], []).append(alpha)
+        return alpha
+
+    def compile(self, rule, kb):
+        """Compile the premises of a rule into a chain of join nodes
+
+        Args:
+            rule (Rule): rule to compile
+            kb (KnowledgeBase): KB used to fill new alpha memories
+
+        Returns:
+            JoinNode: node for the first premise
+        """
+        bound = set()
+        first = parent = None
+        for premise in rule.lhs:
+            positions = tuple(pos for pos, term in enumerate(premise.terms)
+                              if is_var(term) and term.term.element in bound)
+            bound.update(t.term.element for t in premise.terms if is_var(t))
+            alpha = self.alpha_memory(premise, kb)
+            node = JoinNode(alpha, positions, premise)
+            alpha.successors.append(node)
+            if parent is None:
+                first = node
+            else:
+                parent.child = node
+            parent = node
+        return first
+
+    def node_for(self, rule, kb):
+        """Find the join node a rule new to the network belongs to: the child of
+            the node of the rule it was curried from with a fact without
+            variables, or the first node of a freshly compiled chain for rules
+            that were not curried. Rules curried from a fact with variables or
+            from a wild rule get None, they are wild as well.
+        """
+        curried = False
+        for fact, parent in rule.supported_by:
+            node = self.node_of.get(parent)
+            if node is not None and is_ground(fact.statement):
+                return node.child
+            curried = curried or node is not None or self.is_wild(parent)
+        return None if curried else self.compile(rule, kb)
+
+    def is_wild(self, rule):
+        """Check whether a rule is matched with fc_infer instead of the network
+        """
+        statement = rule.lhs[0]
+        return rule in self.wild.get((statement.predicate, len(statement.terms)), ())
+
+    def place(self, rule, kb):
+        """Put a rule new to the network in the beta memory of its join node,
+            or with the wild rules
+
+        Returns:
+            JoinNode|None: the node of the rule, None for a wild rule
+        """
+        node = self.node_for(rule, kb)
+        if node is None:
+            statement = rule.lhs[0]
+            self.wild.setdefault((statement.predicate, len(statement.terms)), {})[rule] = None
+        else:
+            self.node_of[rule] = node
+            node.add_token(rule)
+        return node
+
+    def fact_added(self, fact, kb):
+        """Put a new fact in the alpha memories it passes and join it with the
+            rules waiting on it and the wild rules. A fact with variables is
+            matched with every candidate rule instead.
+
+        Args:
+            fact (Fact) - The new fact
+            kb (KnowledgeBase) - The KnowledgeBase it was added to
+        """
+        statement = fact.statement
+        if not is_ground(statement):
+            super(ReteInferenceEngine, self).fact_added(fact, kb)
+            return
+        key = (statement.predicate, len(statement.terms))
+        pairs = []
+        for alpha in self.alpha_by_predicate.get(key, ()):
+            if alpha.test(statement):
+                alpha.add(fact)
+                for node in alpha.successors:
+                    tokens = node.tokens_for(fact)
+                    if tokens:
+                        pairs.append((node.matcher.match(statement), tokens))
+        stats = kb.stats
+        for binding, tokens in pairs:
+            for rule in tokens:
+                if stats is not None:
+                    stats.joined(rule)
+                self.fc_fire(fact, rule, binding, kb)
+        for rule in list(self.wild.get(key, ())):
+            self.fc_infer(fact, rule, kb)
+
+    def rule_added(self, rule, kb):
+        """Put a new rule in the beta memory of its join node and join it with
+            the facts it is waiting on and the facts with variables. A wild
+            rule is matched with every candidate fact instead.
+
+        Args:
+            rule (Rule) - The new rule
+            kb (KnowledgeBase) - The KnowledgeBase it was added to
+        """
+        node = self.node_of.get(rule)
+        if node is None:
+            if self.is_wild(rule) or self.place(rule, kb) is None:
+                super(ReteInferenceEngine, self).rule_added(rule, kb)
+                return
+            node = self.node_of[rule]
+        else:
+            node.add_token(rule)
+        facts = node.facts_for(rule)
+        if kb.stats is not None and facts:
+            kb.stats.joined(rule, len(facts))
+        for fact in facts:
+            self.fc_fire(fact, rule, node.matcher.match(fact.statement), kb)
+        # facts with variables are not in the alpha memories
+        if rule.lhs[0].predicate in kb.fact_index.nonground:
+            for fact in kb.fact_index.candidates(rule.lhs[0]):
+                if fact not in kb.pending and not is_ground(fact.statement):
+                    self.fc_infer(fact, rule, kb)
+
+    def restored(self, kb):
+        """Compile the forward-chained rules of a KB restored from a snapshot
+            into the network, without firing: the new alpha memories are
+            filled from the KB and each rule goes in the beta memory of its
+            join node, curried rules after the rules they came from
+
+        Args:
+            kb (KnowledgeBase) - The restored KnowledgeBase
+        """
+        for rule in kb.rules:
+            if kb._forward_chained(rule) and rule not in self.node_of and not self.is_wild(rule):
+                self.place(rule, kb)
+
+    def fact_removed(self, fact, kb):
+        """Drop a removed fact from the alpha memories
+
+        Args:
+            fact (Fact) - The removed fact
+            kb (KnowledgeBase) - The KnowledgeBase it was removed from
+        """
+        statement = fact.statement
+        for alpha in self.alpha_by_predicate.get((statement.predicate, len(statement.terms)), ()):
+            alpha.remove(fact)
+
+    def rule_removed(self, rule, kb):
+        """Drop a removed rule from the beta memory of its join node
+
+        Args:
+            rule (Rule) - The removed rule
+            kb (KnowledgeBase) - The KnowledgeBase it was removed from
+        """
+        node = self.node_of.pop(rule, None)
+        if node is not None:
+            node.remove_token(rule)
+            return
+        statement = rule.lhs[0]
+        key = (statement.predicate, len(statement.terms))
+        wild = self.wild.get(key)
+        if wild and rule in wild:
+            del wild[rule]
+            if not wild:
+                del self.wild[key]
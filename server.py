@@ -0,0 +1,360 @@
+"""asyncio server and client for a KnowledgeBase.
+
+The protocol is line-delimited JSON over TCP or a Unix socket. Each request
+is an object with an "id" echoed in the response, an "op" ("assert", "ask"
+or "retract") and an "item" in the text syntax of read.parse_input, e.g.
+
+    {"id": 1, "op": "assert", "item": "fact: (isa cube block)"}
+    {"id": 2, "op": "ask", "item": "fact: (isa ?X block)"}
+
+Responses are {"id": ..., "ok": true} plus "answers" (a list of
+{variable: value} objects) for asks and "removed" ([facts, rules]) for
+retracts, or {"id": ..., "ok": false, "error": "..."}. Requests on one
+connection are handled concurrently and answered as they complete; an assert
+is visible to every ask sent after its response came back.
+
+Usage:
+    python server.py [--host HOST] [--port PORT] [--unix PATH] [--load FILE]
+"""
+import argparse, asyncio, json
+from concurrent.futures import ThreadPoolExecutor
+import read
+from logical_classes import *
+from student_code import KnowledgeBase
+from util import NoLock
+
+OPS = ('assert', 'ask', 'retract')
+
+class KBServer(object):
+    """Serves a thread safe KnowledgeBase. Asserts and retracts are queued
+        and applied by a single writer thread: every assert waiting when the
+        writer gets to them is applied with one kb_assert_many, so concurrent
+        asserts saturate once. Asks run in a thread pool under the KB's read
+        lock, so each one sees the KB between two batches.
+
+    Attributes:
+        kb (KnowledgeBase): the served KB
+        max_batch (int): most writes applied in one batch
+        writes (asyncio.Queue|None): queued (op, item, future) writes
+        writing (asyncio.Task|None): task running write_loop
+        writer (ThreadPoolExecutor): single thread applying writes
+        readers (ThreadPoolExecutor): threads answering asks
+        stats (dictof int): counts of requests, batches and errors
+    """
+    def __init__(self, kb=None, max_batch=10000, readers=8):
+        """Constructor for KBServer
+
+        Args:
+            kb (KnowledgeBase|None): KB to serve, created thread safe if None
+            max_batch (int): most writes applied in one batch
+            readers (int): number of threads answering asks
+
+        Raises:
+            ValueError: if kb was not created with thread_safe=True
+        """
+        super(KBServer, self).__init__()
+        if kb is not None and isinstance(kb.lock, NoLock):
+            # asks run in parallel with the writer thread
+            raise ValueError("KBServer needs a KnowledgeBase created with thread_safe=True")
+        self.kb = kb if kb is not None else KnowledgeBase([], [], thread_safe=True)
+        self.max_batch = max_batch
+        self.writes = None
+        self.writing = None
+        self.writer = ThreadPoolExecutor(1)
+        self.readers = ThreadPoolExecutor(readers)
+        self.stats = dict.fromkeys(('requests', 'asserts', 'asks', 'retracts',
+                                    'batches', 'errors'), 0)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'KBServer({!r})'.format(self.stats)
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """Start serving on a TCP port, or on a Unix socket if path is given
+
+        Args:
+            host (str): interface to listen on
+            port (int): TCP port, 0 for any free port
+            path (str|None): Unix socket path
+
+        Returns:
+            asyncio.Server
+        """
+        self.writes = asyncio.Queue()
+        self.writing = asyncio.ensure_future(self.write_loop())
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path=path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        """Serve one connection until the client closes it
+        """
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self.respond(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+
+    async def respond(self, line, writer):
+        """Answer one request line
+        """
+        self.stats['requests'] += 1
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            response = await self.request(request.get('op'), request.get('item'))
+        except Exception as e:
+            self.stats['errors'] += 1
+            response = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+        response['id'] = request_id
+        writer.write((json.dumps(response) + '\n').encode())
+        await writer.drain()
+
+    async def request(self, op, item):
+        """Run one operation
+
+        Args:
+            op (str): 'assert', 'ask' or 'retract'
+            item (str): fact or rule in read.parse_input syntax
+
+        Returns:
+            dict: response without its id
+        """
+        if op not in OPS:
+            raise ValueError("op must be one of {!r}, not {!r}".format(OPS, op))
+        fact_rule = read.parse_input(item or '')
+        if not (isinstance(fact_rule, Fact) or isinstance(fact_rule, Rule)):
+            raise ValueError("not a fact or rule: {!r}".format(item))
+        if op == 'ask':
+            self.stats['asks'] += 1
+            loop = asyncio.get_running_loop()
+            answers = await loop.run_in_executor(self.readers, self.ask, fact_rule)
+            return {'ok': True, 'answers': answers}
+        future = asyncio.get_running_loop().create_future()
+        await self.writes.put((op, fact_rule, future))
+        return await future
+
+    def ask(self, fact):
+        """Answers of an ask as {variable: value} dicts, run in a reader thread
+        """
+        return [binding.bindings_dict for binding, facts in self.kb.kb_ask_iter(fact)]
+
+    async def write_loop(self):
+        """Apply queued writes in batches, forever
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.writes.get()]
+            while len(batch) < self.max_batch and not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            try:
+                results = await loop.run_in_executor(self.writer, self.apply, batch)
+            except Exception as e:
+                for op, fact_rule, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (op, fact_rule, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def close(self):
+        """Stop applying writes and shut the thread pools down
+        """
+        if self.writing is not None:
+            self.writing.cancel()
+            self.writing = None
+        self.writer.shutdown()
+        self.readers.shutdown()
+
+    def apply(self, batch):
+        """Apply a batch of writes in the writer thread, in order. Runs of
+            asserts are applied with one kb_assert_many. A write that fails
+            only fails its own request.
+
+        Args:
+            batch (listof (str, Fact|Rule, Future)): queued writes
+
+        Returns:
+            listof dict: response of each write
+        """
+        self.stats['batches'] += 1
+        results = []
+        asserts = []
+        for op, fact_rule, future in batch:
+            if op == 'assert':
+                asserts.append(fact_rule)
+                continue
+            if asserts:
+                results += self.apply_asserts(asserts)
+                asserts = []
+            self.stats['retracts'] += 1
+            try:
+                removed = self.kb.kb_retract(fact_rule)
+                results.append({'ok': True, 'removed': list(removed)})
+            except Exception as e:
+                results.append(self.failure(e))
+        if asserts:
+            results += self.apply_asserts(asserts)
+        return results
+
+    def apply_asserts(self, asserts):
+        """Assert a run of facts and rules with one kb_assert_many. If that
+            raises, the ones it did not get to are told apart by asserting
+            them one by one, which is harmless for those already asserted.
+
+        Args:
+            asserts (listof Fact|Rule): facts and rules to assert
+
+        Returns:
+            listof dict: response of each assert
+        """
+        self.stats['asserts'] += len(asserts)
+        try:
+            self.kb.kb_assert_many(asserts)
+            return [{'ok': True} for fact_rule in asserts]
+        except Exception:
+            pass
+        results = []
+        for fact_rule in asserts:
+            try:
+                self.kb.kb_assert(fact_rule)
+                results.append({'ok': True})
+            except Exception as e:
+                results.append(self.failure(e))
+        return results
+
+    def failure(self, error):
+        """Response to a write that raised error
+        """
+        self.stats['errors'] += 1
+        return {'ok': False, 'error': '{}: {}'.format(type(error).__name__, error)}
+
+class KBClient(object):
+    """asyncio client for KBServer. Requests may be issued concurrently on
+        one connection, responses are matched to them by id.
+
+    Attributes:
+        reader (asyncio.StreamReader): connection to the server
+        writer (asyncio.StreamWriter): connection to the server
+        waiting (dictof Future): responses not yet received, by request id
+        next_id (int): id of the next request
+        receiving (asyncio.Task): task reading the responses
+    """
+    def __init__(self, reader, writer):
+        """Constructor for KBClient, see connect
+        """
+        super(KBClient, self).__init__()
+        self.reader = reader
+        self.writer = writer
+        self.waiting = {}
+        self.next_id = 0
+        self.receiving = asyncio.ensure_future(self.receive())
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'KBClient({!r} waiting)'.format(len(self.waiting))
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=None, path=None):
+        """Connect to a server over TCP, or over a Unix socket if path is given
+
+        Returns:
+            KBClient
+        """
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def receive(self):
+        """Hand the responses read from the server to the requests waiting on them
+        """
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = self.waiting.pop(response.get('id'), None)
+            if future is not None and not future.done():
+                future.set_result(response)
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError("connection closed"))
+
+    async def request(self, op, item):
+        """Send a request and wait for its response
+
+        Args:
+            op (str): 'assert', 'ask' or 'retract'
+            item (str): fact or rule in read.parse_input syntax
+
+        Returns:
+            dict: the response
+        """
+        request_id = self.next_id
+        self.next_id += 1
+        future = self.waiting[request_id] = asyncio.get_running_loop().create_future()
+        line = json.dumps({'id': request_id, 'op': op, 'item': item}) + '\n'
+        self.writer.write(line.encode())
+        await self.writer.drain()
+        return await future
+
+    async def kb_assert(self, item):
+        """Assert a fact or rule, e.g. "fact: (isa cube block)"
+        """
+        return await self.request('assert', item)
+
+    async def kb_ask(self, item):
+        """Ask a fact, returns the list of {variable: value} answers
+        """
+        response = await self.request('ask', item)
+        if not response['ok']:
+            raise ValueError(response['error'])
+        return response['answers']
+
+    async def kb_retract(self, item):
+        """Retract a fact, returns the [facts, rules] removed
+        """
+        response = await self.request('retract', item)
+        if not response['ok']:
+            raise ValueError(response['error'])
+        return response['removed']
+
+    async def close(self):
+        """Close the connection
+        """
+        self.writer.close()
+        await self.receiving
+
+async def serve(args):
+    """Run a server until interrupted
+    """
+    server = KBServer()
+    if args.load:
+        server.kb.kb_load(args.load)
+    listener = await server.start(args.host, args.port, args.unix)
+    for sock in listener.sockets:
+        print("Serving on", sock.getsockname())
+    async with listener:
+        await listener.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8348)
+    parser.add_argument('--unix', help='serve on this Unix socket path instead of TCP')
+    parser.add_argument('--load', help='statements file to load first')
+    asyncio.run(serve(parser.parse_args()))
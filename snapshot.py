@@ -0,0 +1,447 @@
+"""Binary snapshots of a KnowledgeBase.
+
+A snapshot holds everything forward chaining produced, so a KB restored from
+one answers kb_ask at once, without parsing statements files or running
+inference again. The file is a fixed header followed by flat arrays of
+integers, each section 8-byte aligned:
+
+    symbol_offsets, symbol_bytes   the symbols used, as UTF-8 strings
+    eager                          symbol ids of the eager predicates
+    fact_codes, fact_starts        statement of each fact: predicate then
+                                   terms, as symbol ids
+    fact_asserted                  asserted flag of each fact
+    rule_codes, rule_starts        each rule: number of LHS statements, then
+                                   predicate, arity and terms of every LHS
+                                   statement and of the RHS
+    rule_asserted                  asserted flag of each rule
+    fact_support_starts,           supported_by of each fact as (fact number,
+    fact_supports                  rule number) pairs
+    rule_support_starts,           supported_by of each rule, likewise
+    rule_supports
+    fact_dependent_starts,         supports_facts then supports_rules of each
+    fact_dependents                fact, as fact and rule numbers
+    rule_dependent_starts,         supports_facts then supports_rules of each
+    rule_dependents                rule, likewise
+    predicate_starts,              fact numbers grouped by the symbol id of
+    predicate_facts                their predicate
+    nonground                      symbol ids of the predicates with facts
+                                   holding variables
+
+Facts and rules are numbered in KB order. The header records the byte order
+the arrays were written in. load maps the file and leaves the KB holding a
+MappedSnapshot instead of its facts and rules: kb_ask is answered from the
+mapped arrays, building only the facts it returns, and everything is built
+the first time the KB needs its facts or rules (see MappedSnapshot.restore).
+"""
+import mmap, os, struct, sys, tempfile, threading
+from array import array
+from logical_classes import *
+from util import is_var, match
+
+MAGIC = b'KBSNAP\x00\x02'
+
+SECTIONS = (('symbol_offsets', 'q'), ('symbol_bytes', 'B'), ('eager', 'i'),
+            ('fact_codes', 'i'), ('fact_starts', 'q'), ('fact_asserted', 'B'),
+            ('rule_codes', 'i'), ('rule_starts', 'q'), ('rule_asserted', 'B'),
+            ('fact_support_starts', 'q'), ('fact_supports', 'i'),
+            ('rule_support_starts', 'q'), ('rule_supports', 'i'),
+            ('fact_dependent_starts', 'q'), ('fact_dependents', 'i'),
+            ('rule_dependent_starts', 'q'), ('rule_dependents', 'i'),
+            ('predicate_starts', 'q'), ('predicate_facts', 'i'), ('nonground', 'i'))
+
+# KnowledgeBase attributes a mapped KB goes without until it is restored
+DEFERRED = ('facts', 'rules', 'fact_index', 'rule_index', 'backward_rules')
+
+# magic, byte order, mode name, then the offset and length of each section
+HEADER = struct.Struct('<8s8s8s' + 'qq' * len(SECTIONS))
+
+def save(kb, path):
+    """Write a snapshot of a saturated KB
+
+    Args:
+        kb (KnowledgeBase): KB to save
+        path (str): file to write
+    """
+    local = {}
+    def code(symbol):
+        number = local.get(symbol)
+        if number is None:
+            number = local[symbol] = len(local)
+        return number
+
+    sections = dict((name, array(typecode)) for name, typecode in SECTIONS)
+    fact_number = {}
+    by_predicate = {}
+    codes, starts = sections['fact_codes'], sections['fact_starts']
+    for fact in kb.facts:
+        by_predicate.setdefault(code(symbols.intern(fact.statement.predicate)), []).append(len(fact_number))
+        fact_number[id(fact)] = len(fact_number)
+        statement = fact.statement
+        starts.append(len(codes))
+        codes.append(code(symbols.intern(statement.predicate)))
+        codes.extend(code(term.term.id) for term in statement.terms)
+        sections['fact_asserted'].append(fact.asserted)
+    starts.append(len(codes))
+    rule_number = {}
+    codes, starts = sections['rule_codes'], sections['rule_starts']
+    for rule in kb.rules:
+        rule_number[id(rule)] = len(rule_number)
+        starts.append(len(codes))
+        codes.append(len(rule.lhs))
+        for statement in rule.lhs + [rule.rhs]:
+            codes.append(code(symbols.intern(statement.predicate)))
+            codes.append(len(statement.terms))
+            codes.extend(code(term.term.id) for term in statement.terms)
+        sections['rule_asserted'].append(rule.asserted)
+    starts.append(len(codes))
+    for kind, store in (('fact', kb.facts), ('rule', kb.rules)):
+        starts, pairs = sections[kind + '_support_starts'], sections[kind + '_supports']
+        for fact_rule in store:
+            starts.append(len(pairs) // 2)
+            for fact, rule in fact_rule.supported_by:
+                pairs.append(fact_number[id(fact)])
+                pairs.append(rule_number[id(rule)])
+        starts.append(len(pairs) // 2)
+        starts, dependents = sections[kind + '_dependent_starts'], sections[kind + '_dependents']
+        for fact_rule in store:
+            starts.append(len(dependents))
+            dependents.extend(fact_number[id(fact)] for fact in fact_rule.supports_facts)
+            starts.append(len(dependents))
+            dependents.extend(rule_number[id(rule)] for rule in fact_rule.supports_rules)
+        starts.append(len(dependents))
+    sections['eager'].extend(code(symbols.intern(predicate))
+                             for predicate in sorted(kb.eager_predicates))
+    sections['nonground'].extend(code(symbols.intern(predicate))
+                                 for predicate in sorted(kb.fact_index.nonground))
+    starts, numbers = sections['predicate_starts'], sections['predicate_facts']
+    for symbol in range(len(local)):
+        starts.append(len(numbers))
+        numbers.extend(by_predicate.get(symbol, ()))
+    starts.append(len(numbers))
+    offsets = sections['symbol_offsets']
+    blob = sections['symbol_bytes']
+    for symbol in local:
+        offsets.append(len(blob))
+        blob.frombytes(symbols.name_of(symbol).encode('utf-8'))
+    offsets.append(len(blob))
+
+    fields = []
+    position = HEADER.size
+    for name, typecode in SECTIONS:
+        position += -position % 8
+        fields += [position, len(sections[name])]
+        position += len(sections[name]) * sections[name].itemsize
+    # written aside and moved in place, so a crash leaves the old snapshot
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                         prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, sys.byteorder.encode(), kb.mode.encode(), *fields))
+            for (name, typecode), offset in zip(SECTIONS, fields[0::2]):
+                f.write(b'\0' * (offset - f.tell()))
+                sections[name].tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def load(kb, path):
+    """Map a snapshot for an empty KB. The KB takes the mode and eager
+        predicates it was saved with and holds a MappedSnapshot in place of
+        its facts and rules until it needs them.
+
+    Args:
+        kb (KnowledgeBase): empty KB to fill
+        path (str): file written by save
+
+    Raises:
+        ValueError: if the KB is not empty or the file is not a snapshot
+    """
+    if len(kb.facts) or len(kb.rules):
+        raise ValueError("can only load a snapshot into an empty KB")
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError("{!r} is not a KB snapshot".format(path))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = HEADER.unpack_from(mapped)
+    if header[0] != MAGIC:
+        mapped.close()
+        raise ValueError("{!r} is not a KB snapshot".format(path))
+    swap = header[1].rstrip(b'\0').decode() != sys.byteorder
+    view = memoryview(mapped)
+    sections = {}
+    for (name, typecode), offset, length in zip(SECTIONS, header[3::2], header[4::2]):
+        data = view[offset:offset + length * array(typecode).itemsize]
+        if swap:
+            # the arrays of another byte order are copied, once, to swap them
+            sections[name] = array(typecode, data.tobytes())
+            sections[name].byteswap()
+        else:
+            sections[name] = data.cast(typecode)
+    snapshot = MappedSnapshot(sections)
+    kb.mode = header[2].rstrip(b'\0').decode()
+    kb.eager_predicates = frozenset(snapshot.names[symbol] for symbol in sections['eager'])
+    kb.incomplete = None
+    for name in DEFERRED:
+        delattr(kb, name)
+    kb.mapped = snapshot
+    if kb.cache is not None:
+        kb.cache.clear()
+
+class MappedSnapshot(object):
+    """Snapshot mapped by load for a KB that has not needed its facts and
+        rules yet. Questions are answered from the mapped arrays: the facts
+        with the predicate asked are read from predicate_facts and only those
+        holding the constants asked are built, with their support links. The
+        facts and rules these links point to are built without links of
+        their own, which they get when the KB is restored. Every object built
+        is kept, so the restored KB holds the same ones.
+
+    Attributes:
+        sections (dictof memoryview|array): arrays of the snapshot by name,
+            views of the mapped file unless it had the other byte order
+        names (listof str): symbol of each snapshot symbol id
+        terms (listof Term): shared term of each snapshot symbol id
+        code_of (dictof int): maps a symbol to its snapshot symbol id
+        variable (listof bool): whether each snapshot symbol is a variable
+        nonground (frozenset): snapshot symbol ids of the predicates with
+            facts holding variables
+        facts (dictof Fact): facts built so far, by number
+        rules (dictof Rule): rules built so far, by number
+        linked (set): numbers of the facts built with their support links
+        shared (dictof Statement): rule statements built so far, by codes
+        lock (Lock): held while restoring and building answers, so a KB is
+            restored once and answers share its objects
+    """
+    def __init__(self, sections):
+        """Constructor for MappedSnapshot
+
+        Args:
+            sections (dictof memoryview|array): arrays of the snapshot by name
+        """
+        super(MappedSnapshot, self).__init__()
+        self.sections = sections
+        offsets, blob = sections['symbol_offsets'].tolist(), bytes(sections['symbol_bytes'])
+        self.names = [blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+                      for i in range(len(offsets) - 1)]
+        self.terms = [symbols.term(name) for name in self.names]
+        self.code_of = dict((name, symbol) for symbol, name in enumerate(self.names))
+        self.variable = [is_var(term) for term in self.terms]
+        self.nonground = frozenset(sections['nonground'])
+        self.facts = {}
+        self.rules = {}
+        self.linked = set()
+        self.shared = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'MappedSnapshot({!r} facts, {!r} rules)'.format(
+                len(self.sections['fact_asserted']), len(self.sections['rule_asserted']))
+
+    def answers(self, statement):
+        """Answers to a question read from the mapped arrays, in KB order
+
+        Args:
+            statement (Statement): statement asked
+
+        Yields:
+            (Bindings, listof Fact)
+        """
+        predicate = self.code_of.get(statement.predicate)
+        if predicate is None:
+            return
+        # a constant missing from the snapshot only matches variables
+        constants = [(pos + 1, self.code_of.get(term.term.element, -1))
+                     for pos, term in enumerate(statement.terms) if not is_var(term)]
+        # like kb_ask, match every fact of a predicate with facts holding variables
+        matcher = None if predicate in self.nonground else statement.matcher()
+        size = len(statement.terms) + 1
+        starts = self.sections['predicate_starts']
+        numbers = self.sections['predicate_facts'][starts[predicate]:starts[predicate + 1]].tolist()
+        codes, fact_starts = self.sections['fact_codes'], self.sections['fact_starts']
+        variable, facts, linked = self.variable, self.facts, self.linked
+        for number in numbers:
+            start = fact_starts[number]
+            if fact_starts[number + 1] - start != size:
+                continue
+            held = True
+            for pos, symbol in constants:
+                code = codes[start + pos]
+                if code != symbol and not variable[code]:
+                    held = False
+                    break
+            if not held:
+                continue
+            if number in linked:
+                fact = facts[number]
+            else:
+                # a KB restored meanwhile holds the facts built by then
+                with self.lock:
+                    fact = self.fact(number, True)
+            if matcher is None:
+                binding = match(statement, fact.statement)
+            else:
+                binding = matcher.match(fact.statement)
+            if binding:
+                yield binding, [fact]
+
+    def fact(self, number, linked=False):
+        """The fact of a number, built on first use
+
+        Args:
+            number (int): number of the fact
+            linked (bool): also set its support links
+
+        Returns:
+            Fact
+        """
+        fact = self.facts.get(number)
+        if fact is None:
+            codes, starts = self.sections['fact_codes'], self.sections['fact_starts']
+            start, end = starts[number], starts[number + 1]
+            fact = self.facts[number] = Fact(Statement(
+                [self.names[codes[start]]] + [self.terms[symbol] for symbol in codes[start + 1:end]]))
+            fact.asserted = bool(self.sections['fact_asserted'][number])
+        if linked and number not in self.linked:
+            self.linked.add(number)
+            self.link(fact, 'fact', number)
+        return fact
+
+    def rule(self, number):
+        """The rule of a number, built on first use, without support links
+
+        Args:
+            number (int): number of the rule
+
+        Returns:
+            Rule
+        """
+        rule = self.rules.get(number)
+        if rule is None:
+            codes, start = self.sections['rule_codes'], self.sections['rule_starts'][number]
+            position = start + 1
+            statements = []
+            for _ in range(codes[start] + 1):
+                end = position + 2 + codes[position + 1]
+                statements.append(self.statement(codes[position:end]))
+                position = end
+            rule = self.rules[number] = Rule([statements[:-1], statements[-1]])
+            rule.asserted = bool(self.sections['rule_asserted'][number])
+        return rule
+
+    def statement(self, codes):
+        """Statement of a rule given as predicate, arity and terms, shared
+            with the rules that repeat it as curried rules do
+
+        Args:
+            codes (sequence of int): snapshot symbol ids and arity
+
+        Returns:
+            Statement
+        """
+        key = tuple(codes)
+        statement = self.shared.get(key)
+        if statement is None:
+            statement = self.shared[key] = Statement(
+                [self.names[key[0]]] + [self.terms[symbol] for symbol in key[2:]])
+        return statement
+
+    def link(self, fact_rule, kind, number):
+        """Set the support links of a fact or rule from the mapped arrays,
+            building the facts and rules they point to
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to link
+            kind (str): 'fact' or 'rule'
+            number (int): its number
+        """
+        sections = self.sections
+        starts, pairs = sections[kind + '_support_starts'], sections[kind + '_supports']
+        for pair in range(starts[number], starts[number + 1]):
+            writable(fact_rule, 'supported_by').add(self.fact(pairs[2 * pair]),
+                                                    self.rule(pairs[2 * pair + 1]))
+        starts, dependents = sections[kind + '_dependent_starts'], sections[kind + '_dependents']
+        for index in range(starts[2 * number], starts[2 * number + 1]):
+            writable(fact_rule, 'supports_facts').add(self.fact(dependents[index]))
+        for index in range(starts[2 * number + 1], starts[2 * number + 2]):
+            writable(fact_rule, 'supports_rules').add(self.rule(dependents[index]))
+
+    def restore(self, kb):
+        """Build every fact, rule and support link of the snapshot in the KB
+            holding it, reusing the ones already built, and index them. The
+            KB stops holding the snapshot, and its inference engine rebuilds
+            its own state through InferenceEngine.restored.
+
+        Args:
+            kb (KnowledgeBase): KB the snapshot was loaded into
+        """
+        with self.lock:
+            if kb.mapped is not self:
+                return
+            # indexing lists is much cheaper than indexing the mapped arrays
+            sections = dict((name, data.tolist()) for name, data in self.sections.items()
+                            if name != 'symbol_bytes')
+            names, terms = self.names, self.terms
+            facts = []
+            codes, starts = sections['fact_codes'], sections['fact_starts']
+            for number, asserted in enumerate(sections['fact_asserted']):
+                fact = self.facts.get(number)
+                if fact is None:
+                    start, end = starts[number], starts[number + 1]
+                    fact = Fact(Statement([names[codes[start]]] +
+                                          [terms[symbol] for symbol in codes[start + 1:end]]))
+                    fact.asserted = bool(asserted)
+                facts.append(fact)
+            rules = []
+            codes, starts = sections['rule_codes'], sections['rule_starts']
+            for number, asserted in enumerate(sections['rule_asserted']):
+                rule = self.rules.get(number)
+                if rule is None:
+                    position = starts[number] + 1
+                    statements = []
+                    for _ in range(codes[starts[number]] + 1):
+                        end = position + 2 + codes[position + 1]
+                        statements.append(self.statement(codes[position:end]))
+                        position = end
+                    rule = Rule([statements[:-1], statements[-1]])
+                    rule.asserted = bool(asserted)
+                rules.append(rule)
+
+            for kind, items in (('fact', facts), ('rule', rules)):
+                starts, pairs = sections[kind + '_support_starts'], sections[kind + '_supports']
+                for number, fact_rule in enumerate(items):
+                    for pair in range(starts[number], starts[number + 1]):
+                        writable(fact_rule, 'supported_by').add(facts[pairs[2 * pair]],
+                                                                rules[pairs[2 * pair + 1]])
+                starts, dependents = sections[kind + '_dependent_starts'], sections[kind + '_dependents']
+                for number, fact_rule in enumerate(items):
+                    for index in range(starts[2 * number], starts[2 * number + 1]):
+                        writable(fact_rule, 'supports_facts').add(facts[dependents[index]])
+                    for index in range(starts[2 * number + 1], starts[2 * number + 2]):
+                        writable(fact_rule, 'supports_rules').add(rules[dependents[index]])
+
+            fact_store, fact_index = OrderedStore(), FactIndex()
+            for fact in facts:
+                fact_store.append(fact)
+                fact_index.add(fact)
+            rule_store, rule_index, backward_rules = OrderedStore(), RuleIndex(), RuleIndex(by_rhs=True)
+            for rule in rules:
+                rule_store.append(rule)
+                if kb.mode != 'eager' and not rule.supported_by:
+                    backward_rules.add(rule)
+                if kb._forward_chained(rule):
+                    rule_index.add(rule)
+            # the KB gets whole containers, other threads never see them filling
+            kb.facts, kb.rules, kb.fact_index = fact_store, rule_store, fact_index
+            kb.rule_index, kb.backward_rules = rule_index, backward_rules
+            kb.incomplete = None
+            kb.ie.restored(kb)
+            kb.mapped = None
+            # questions still being answered from the arrays get these objects
+            self.facts, self.rules = dict(enumerate(facts)), dict(enumerate(rules))
+            self.linked = set(self.facts)
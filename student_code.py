@@ -1,14 +1,70 @@
-import read, copy
+import read, copy, snapshot, journal, threading, time
+from collections import deque
+from contextlib import closing
+from itertools import islice
 from util import *
 from logical_classes import *
 
-verbose = 0
+MODES = ('eager', 'lazy', 'hybrid')
 
 class KnowledgeBase(object):
-    def __init__(self, facts=[], rules=[]):
-        self.facts = facts
-        self.rules = rules
-        self.ie = InferenceEngine()
+    def __init__(self, facts=[], rules=[], engine=None, mode='eager', eager_predicates=(),
+                 thread_safe=False, cache_size=0, stats=None):
+        """Constructor for KnowledgeBase
+
+        Args:
+            facts (listof Fact) - initial facts, not used for inference
+            rules (listof Rule) - initial rules, not used for inference
+            engine (InferenceEngine|None) - forward-chaining engine, defaults to
+                InferenceEngine
+            mode (str) - 'eager' forward chains every rule when facts and rules
+                are asserted; 'lazy' forward chains nothing and kb_ask derives
+                answers by backward chaining; 'hybrid' forward chains the rules
+                concluding one of eager_predicates and backward chains the rest
+            eager_predicates (iterable of str) - predicates materialized in
+                hybrid mode
+            thread_safe (bool) - guard the KB with a readers-writer lock, so
+                asks from many threads run in parallel with one thread
+                asserting and retracting, and each ask sees the KB between
+                two asserts or retracts
+            cache_size (int) - keep the answers to up to this many distinct
+                questions (see AskCache), 0 for no cache
+            stats (Instrumentation|None) - counters, timers and event hooks of
+                inference (see instrument.py), None for no instrumentation
+        """
+        if mode not in MODES:
+            raise ValueError("mode must be one of {!r}, not {!r}".format(MODES, mode))
+        self.mode = mode
+        self.eager_predicates = frozenset(eager_predicates)
+        self.facts = OrderedStore(facts)
+        self.rules = OrderedStore(rules)
+        self.fact_index = FactIndex(self.facts)
+        self.rule_index = RuleIndex()
+        self.backward_rules = RuleIndex(by_rhs=True)
+        self.incomplete = None
+        for rule in self.rules:
+            self._index_rule(rule)
+        self.ie = engine if engine is not None else InferenceEngine()
+        self.agenda = deque()
+        self.pending = set()
+        self.saturating = False
+        self.lock = ReadWriteLock() if thread_safe else NoLock()
+        self.snapshot_lock = threading.Lock()
+        self.journal = None
+        self.cache = AskCache(cache_size) if cache_size else None
+        self.stats = stats
+        self.mapped = None
+
+    def __getattr__(self, name):
+        """Restore a snapshot mapped by load_snapshot the first time one of the
+            containers it stands for is used (see snapshot.MappedSnapshot).
+            Only called for attributes the KB does not have.
+        """
+        mapped = self.__dict__.get('mapped')
+        if mapped is None or name not in snapshot.DEFERRED:
+            raise AttributeError(name)
+        mapped.restore(self)
+        return getattr(self, name)
 
     def __repr__(self):
         return 'KnowledgeBase({!r}, {!r})'.format(self.facts, self.rules)
@@ -29,9 +85,7 @@ class KnowledgeBase(object):
         Returns:
             Fact: matching fact
         """
-        for kbfact in self.facts:
-            if fact == kbfact:
-                return kbfact
+        return self.facts.get(fact)
 
     def _get_rule(self, rule):
         """INTERNAL USE ONLY
@@ -43,9 +97,64 @@ class KnowledgeBase(object):
         Returns:
             Rule: matching rule
         """
-        for kbrule in self.rules:
-            if rule == kbrule:
-                return kbrule
+        return self.rules.get(rule)
+
+    def _forward_chained(self, rule):
+        """INTERNAL USE ONLY
+        Check whether a rule is used in forward chaining under the KB's mode
+
+        Args:
+            rule (Rule): Rule to check
+
+        Returns:
+            bool
+        """
+        return self.mode == 'eager' or (self.mode == 'hybrid'
+                and rule.rhs.predicate in self.eager_predicates)
+
+    def _index_rule(self, rule):
+        """INTERNAL USE ONLY
+        Index a rule new to the KB: forward-chained rules go in rule_index and
+        asserted rules of a lazy or hybrid KB in backward_rules, for kb_ask
+
+        Args:
+            rule (Rule): Rule to index
+
+        Returns:
+            bool: whether the rule is used in forward chaining
+        """
+        if self.mode != 'eager' and not rule.supported_by:
+            self.backward_rules.add(rule)
+            self.incomplete = None
+        if self._forward_chained(rule):
+            self.rule_index.add(rule)
+            return True
+        return False
+
+    def _incomplete_predicates(self):
+        """INTERNAL USE ONLY
+        Predicates whose facts are not all materialized: those concluded by a
+        rule that is not forward chained, and those concluded by a rule using
+        an incomplete predicate. kb_ask backward chains for these.
+
+        Returns:
+            set: incomplete predicates
+        """
+        if self.incomplete is None:
+            rules = [rule for bucket in self.backward_rules.by_predicate.values()
+                     for rule in bucket]
+            incomplete = set(rule.rhs.predicate for rule in rules
+                             if not self._forward_chained(rule))
+            changed = True
+            while changed:
+                changed = False
+                for rule in rules:
+                    if (rule.rhs.predicate not in incomplete
+                            and any(s.predicate in incomplete for s in rule.lhs)):
+                        incomplete.add(rule.rhs.predicate)
+                        changed = True
+            self.incomplete = incomplete
+        return self.incomplete
 
     def kb_add(self, fact_rule):
         """Add a fact or rule to the KB
@@ -54,33 +163,34 @@ class KnowledgeBase(object):
         Returns:
             None
         """
-        printv("Adding {!r}", 1, verbose, [fact_rule])
         if isinstance(fact_rule, Fact):
-            if fact_rule not in self.facts:
+            kbfact = self._get_fact(fact_rule)
+            if kbfact is None:
                 self.facts.append(fact_rule)
-                for rule in self.rules:
-                    self.ie.fc_infer(fact_rule, rule, self)
+                self.fact_index.add(fact_rule)
+                if self.cache is not None:
+                    self.cache.bump(fact_rule.statement.predicate)
+                self.agenda.append(fact_rule)
+                self.pending.add(fact_rule)
             else:
                 if fact_rule.supported_by:
-                    ind = self.facts.index(fact_rule)
-                    for f in fact_rule.supported_by:
-                        self.facts[ind].supported_by.append(f)
+                    for fact, rule in fact_rule.supported_by:
+                        writable(kbfact, 'supported_by').add(fact, rule)
                 else:
-                    ind = self.facts.index(fact_rule)
-                    self.facts[ind].asserted = True
+                    kbfact.asserted = True
         elif isinstance(fact_rule, Rule):
-            if fact_rule not in self.rules:
+            kbrule = self._get_rule(fact_rule)
+            if kbrule is None:
                 self.rules.append(fact_rule)
-                for fact in self.facts:
-                    self.ie.fc_infer(fact, fact_rule, self)
+                if self._index_rule(fact_rule):
+                    self.agenda.append(fact_rule)
+                    self.pending.add(fact_rule)
             else:
                 if fact_rule.supported_by:
-                    ind = self.rules.index(fact_rule)
-                    for f in fact_rule.supported_by:
-                        self.rules[ind].supported_by.append(f)
+                    for fact, rule in fact_rule.supported_by:
+                        writable(kbrule, 'supported_by').add(fact, rule)
                 else:
-                    ind = self.rules.index(fact_rule)
-                    self.rules[ind].asserted = True
+                    kbrule.asserted = True
 
     def kb_assert(self, fact_rule):
         """Assert a fact or rule into the KB
@@ -88,8 +198,162 @@ class KnowledgeBase(object):
         Args:
             fact_rule (Fact or Rule): Fact or Rule we're asserting
         """
-        printv("Asserting {!r}", 0, verbose, [fact_rule])
-        self.kb_add(fact_rule)
+        with self.lock.writing():
+            if self.stats is not None and not self.saturating and self.stats.subscribers['assert']:
+                self.stats.emit('assert', fact_rule)
+            # facts and rules inferred while saturating are not journaled, and
+            # kb_add ignores anything that is not a fact or rule
+            logged = (self.journal is not None and not self.saturating
+                      and isinstance(fact_rule, (Fact, Rule)))
+            if logged:
+                self.journal.log(journal.ASSERT, fact_rule)
+            self.kb_add(fact_rule)
+            self.kb_saturate()
+            if logged:
+                self.journal.commit()
+
+    def kb_assert_many(self, facts_rules):
+        """Assert a batch of facts and rules into the KB, running inference
+            once for the whole batch
+
+        Args:
+            facts_rules (iterable of Fact|Rule): Facts and Rules we're asserting,
+                anything else (e.g. comments from read_tokenize) is skipped
+        """
+        with self.lock.writing():
+            announce = self.stats is not None and self.stats.subscribers['assert']
+            for fact_rule in facts_rules:
+                if isinstance(fact_rule, Fact) or isinstance(fact_rule, Rule):
+                    if announce:
+                        self.stats.emit('assert', fact_rule)
+                    if self.journal is not None:
+                        self.journal.log(journal.ASSERT, fact_rule)
+                    self.kb_add(fact_rule)
+            self.kb_saturate()
+            if self.journal is not None:
+                self.journal.commit()
+
+    def kb_load(self, file, batch=None):
+        """Bulk load a statements file into the KB. All facts and rules of the
+            file are stored first and inference runs once over the whole lot:
+            each fact/rule pair is joined a single time, when the later of the
+            two leaves the agenda, i.e. every round only joins what is new
+            against what was already there (semi-naive evaluation). The facts,
+            rules and supports are the same as when asserting one by one.
+            The file is read as a stream (read.iter_statements); malformed
+            entries are reported with their line and column and skipped.
+
+        Args:
+            file (str|file): name of a statements file, or an open text file
+            batch (int|None): run inference after every batch of this many
+                facts and rules, so it overlaps with reading a large file,
+                instead of once at the end
+        """
+        statements = read.iter_statements(file, strict=False)
+        if batch is None:
+            self.kb_assert_many(statements)
+            return
+        while True:
+            chunk = list(islice(statements, batch))
+            if not chunk:
+                break
+            self.kb_assert_many(chunk)
+
+    def save_snapshot(self, path):
+        """Write the facts, rules, asserted flags and support links of the KB
+            to a binary snapshot file (see snapshot.py), to be restored with
+            load_snapshot without running inference again
+
+        Args:
+            path (str): file to write
+        """
+        # one snapshot at a time, the reading lock keeps writers out until the
+        # journal is reset
+        with self.snapshot_lock, self.lock.reading():
+            snapshot.save(self, path)
+            if self.journal is not None:
+                # the snapshot now holds everything the journal did
+                self.journal.reset()
+
+    def load_snapshot(self, path):
+        """Restore a snapshot written by save_snapshot into this KB, which
+            must be empty. The file is mapped and no statement is parsed and
+            no inference runs. kb_ask is answered from the mapped arrays
+            until something needs the facts or rules of the KB, which are
+            then built all at once. The KB takes the mode it was saved with.
+
+        Args:
+            path (str): file written by save_snapshot
+
+        Raises:
+            ValueError: if the KB is not empty or the file is not a snapshot
+        """
+        with self.lock.writing():
+            snapshot.load(self, path)
+
+    def open_journal(self, path, sync_every=1, sync_interval=None):
+        """Replay a write-ahead journal (see journal.py) into the KB and keep
+            journaling asserts and retracts to it. Meant to be called at
+            startup, after load_snapshot of the last snapshot if there is one;
+            save_snapshot then empties the journal. The journaled facts and
+            rules are all added before inference runs once, with retracts
+            applied in between, which gives the same KB as running them one
+            by one.
+
+        Args:
+            path (str): journal file, created if missing
+            sync_every (int): fsync every this many records, 1 to make every
+                write durable before it returns, 0 to leave it to the OS
+            sync_interval (float|None): fsync at least this often, in seconds,
+                checked when writing
+
+        Returns:
+            int - number of operations replayed
+        """
+        with self.lock.writing():
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            log = journal.Journal(path, sync_every, sync_interval)
+            replayed = 0
+            for op, fact_rule in log.records():
+                replayed += 1
+                if op == journal.ASSERT:
+                    self.kb_add(fact_rule)
+                elif self._get_fact(fact_rule) or self._get_rule(fact_rule):
+                    self.kb_retract(fact_rule, op == journal.RETRACT_RULES)
+            self.kb_saturate()
+            self.journal = log
+            return replayed
+
+    def close_journal(self):
+        """Flush the journal to disk and stop journaling
+        """
+        with self.lock.writing():
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def kb_saturate(self):
+        """Run forward chaining until the agenda of facts and rules added to the
+            KB but not yet used for inference is empty. Inferred facts and rules
+            are added to the back of the agenda instead of being processed
+            recursively, so the depth of inference does not use the stack.
+            Calls made while already saturating return at once, the running
+            loop picks up what they added.
+        """
+        if self.saturating:
+            return
+        self.saturating = True
+        timed = self.stats is not None and self.stats.timers
+        if timed:
+            start = time.perf_counter()
+        try:
+            self.ie.saturate(self)
+        finally:
+            self.saturating = False
+            if timed:
+                self.stats.phase('saturate', time.perf_counter() - start)
 
     def kb_ask(self, fact):
         """Ask if a fact is in the KB
@@ -102,129 +366,295 @@ class KnowledgeBase(object):
         """
         print("Asking {!r}".format(fact))
         if factq(fact):
-            f = Fact(fact.statement)
+            timed = self.stats is not None and self.stats.timers
+            if timed:
+                start = time.perf_counter()
             bindings_lst = ListOfBindings()
-            # ask matched facts
-            for fact in self.facts:
-                binding = match(f.statement, fact.statement)
-                if binding:
-                    bindings_lst.add_bindings(binding, [fact])
-
+            with closing(self.kb_ask_iter(fact)) as answers:
+                for binding, facts in answers:
+                    bindings_lst.add_bindings(binding, facts)
+            if timed:
+                self.stats.phase('ask', time.perf_counter() - start)
             return bindings_lst if bindings_lst.list_of_bindings else []
 
         else:
             print("Invalid ask:", fact.statement)
             return []
 
-            # Make sure to write edge case that if the retracted fact 
-            # is supported by something -  exit?
-    def kb_retract(self, fact_or_rule):
-        """Retract a fact from the KB
+    def kb_ask_iter(self, fact, limit=None):
+        """Lazily find the answers to a question, without printing anything.
+            Answers are produced one at a time, so stopping early (or a limit)
+            saves looking at the remaining candidate facts. The KB must not be
+            changed while iterating, use kb_ask for a snapshot instead. A
+            thread safe KB is held for reading until the iterator is
+            exhausted or closed.
 
         Args:
-            fact (Fact) - Fact to be retracted
+            fact (Fact) - Statement to be asked
+            limit (int|None) - maximum number of answers, None for all of them
 
         Returns:
-            None
+            iterator of (Bindings, listof Fact) - bindings of each answer with
+                the fact that answers it
         """
+        return self._reading(islice(self._answers(fact.statement), limit)
+                             if factq(fact) else iter(()))
 
+    def _reading(self, answers):
+        """INTERNAL USE ONLY
+        Iterate over answers holding the lock for reading
+        """
+        with self.lock.reading():
+            for answer in answers:
+                yield answer
 
+    def kb_exists(self, fact):
+        """Check whether a question has any answer, stopping at the first one
 
-        printv("Retracting {!r}", 0, verbose, [fact_or_rule])
-        ####################################################
-        # Student code goes here
-        if fact_or_rule in self.facts:
-            ind = self.facts.index(fact_or_rule)
-            f_r = self.facts[ind]
-        elif fact_or_rule in self.rules:
-            ind = self.rules.index(fact_or_rule)
-            f_r = self.rules[ind]
-        else:
-            print("Fact/Rule not found???????")
+        Args:
+            fact (Fact) - Statement to be asked
+
+        Returns:
+            bool
+        """
+        with closing(self.kb_ask_iter(fact, 1)) as answers:
+            return next(answers, None) is not None
+
+    def _answers(self, statement):
+        """INTERNAL USE ONLY
+        Generate the answers to statement for kb_ask_iter
+
+        Args:
+            statement (Statement): statement asked
+
+        Yields:
+            (Bindings, listof Fact)
+        """
+        if self.mode != 'eager' and statement.predicate in self._incomplete_predicates():
+            # derive answers at query time from the rules kept for kb_ask
+            for answer in BackwardChainer(self).ask(statement):
+                fact = self._get_fact(Fact(answer))
+                if fact is None:
+                    fact = Fact(answer)
+                    fact.asserted = False
+                yield match(statement, answer), [fact]
             return
 
-        if isinstance(f_r, Rule) and len(f_r.supported_by) == 0:
+        if self.mapped is not None:
+            # a snapshot not restored yet answers from its arrays
+            yield from self.mapped.answers(statement)
             return
-        if len(f_r.supported_by) > 0:
+
+        # ask matched facts, only looking at indexed candidates
+        if statement.predicate in self.fact_index.nonground:
+            matcher = None
+        else:
+            matcher = statement.matcher()
+        if matcher is not None and self.cache is not None:
+            yield from self._cached_answers(statement, matcher)
             return
+        for fact in self.fact_index.iter_candidates(statement):
+            if matcher is None:
+                binding = match(statement, fact.statement)
+            else:
+                binding = matcher.match(fact.statement)
+            if binding:
+                yield binding, [fact]
+
+    def _cached_answers(self, statement, matcher):
+        """INTERNAL USE ONLY
+        Answers to statement from the cache, or matched and then cached once
+        every answer was produced
+
+        Args:
+            statement (Statement): statement asked
+            matcher (Matcher): matcher compiled from statement
 
-        self.kb_retract_helper(fact_or_rule)
+        Yields:
+            (Bindings, listof Fact)
+        """
+        key = self.cache.key(statement)
+        answers = self.cache.get(key)
+        if answers is not None:
+            for values, fact in answers:
+                yield Bindings(matcher.slots, matcher.variables, list(values)), [fact]
+            return
+        generation = self.cache.generation(statement.predicate)
+        answers = []
+        for fact in self.fact_index.iter_candidates(statement):
+            binding = matcher.match(fact.statement)
+            if binding:
+                answers.append((tuple(binding.values), fact))
+                yield binding, [fact]
+        self.cache.put(key, generation, answers)
+
+    def kb_retract(self, fact_or_rule, retract_rules=False):
+        """Retract a fact from the KB. The fact is no longer asserted and, unless
+            it is still supported by other facts and rules, it is removed along
+            with everything inferred from it.
 
+        Args:
+            fact_or_rule (Fact|Rule) - Fact (or Rule) to be retracted
+            retract_rules (bool) - also retract asserted rules; off by default
+                since asserted rules are the laws of the KB and stay put
 
+        Returns:
+            (int, int) - number of facts and of rules removed from the KB
+        """
+        with self.lock.writing():
+            f_r = self._get_fact(fact_or_rule) or self._get_rule(fact_or_rule)
+            if f_r is None:
+                print("Fact/Rule not found:", fact_or_rule)
+                return 0, 0
+            if isinstance(f_r, Rule) and not retract_rules:
+                return 0, 0
+            # inferred facts and rules go away with their support, not on request
+            if not f_r.asserted:
+                return 0, 0
+
+            # only retracts that change the KB are journaled; dropping the
+            # asserted flag is a change even while other support keeps f_r
+            f_r.asserted = False
+            if self.journal is not None:
+                self.journal.log(journal.RETRACT_RULES if retract_rules else journal.RETRACT, f_r)
+                self.journal.commit()
+            if f_r.supported_by:
+                return 0, 0
+            if self.stats is None:
+                return self.kb_retract_helper(f_r)
+            start = time.perf_counter()
+            removed = self.kb_retract_helper(f_r)
+            if self.stats.timers:
+                self.stats.phase('retract', time.perf_counter() - start)
+            self.stats.retracted(f_r, *removed)
+            return removed
 
     def kb_retract_helper(self, fact_or_rule):
+        """Remove an unsupported, unasserted fact or rule and everything left
+            without support because of it. Works through the dependents with a
+            stack instead of recursion: every removal drops the justifications
+            it takes part in, and a dependent is removed as soon as its last
+            justification is gone, so each fact and rule is visited once.
 
-        if fact_or_rule in self.facts:
-            ind = self.facts.index(fact_or_rule)
-            f_r = self.facts[ind]
-        elif fact_or_rule in self.rules:
-            ind = self.rules.index(fact_or_rule)
-            f_r = self.rules[ind]
-        else:
-            print("Fact/Rule not found???????")
-            return
-        
-        
-        """ THIS IS NECESSSAERY BUT MAYBE MAKE HELPER SO THAT IT IS
-        ONLY CALLED ON THE FIRST fact_OR_rule instead of all
-        if isinstance(f_r, Rule) and len(f_r.supported_by) == 0:
-            return
-        if len(f_r.supported_by) > 0:
-            return
+        Args:
+            fact_or_rule (Fact|Rule) - Fact or Rule to remove
+
+        Returns:
+            (int, int) - number of facts and of rules removed from the KB
         """
+        removed_facts = removed_rules = 0
+        stack = [fact_or_rule]
+        while stack:
+            f_r = stack.pop()
+            if isinstance(f_r, Fact):
+                if self._get_fact(f_r) is not f_r:
+                    continue
+                self.facts.remove(f_r)
+                self.fact_index.remove(f_r)
+                if self.cache is not None:
+                    self.cache.bump(f_r.statement.predicate)
+                self.pending.discard(f_r)
+                self.ie.fact_removed(f_r, self)
+                removed_facts += 1
+            else:
+                if self._get_rule(f_r) is not f_r:
+                    continue
+                self.rules.remove(f_r)
+                self.rule_index.remove(f_r)
+                self.backward_rules.remove(f_r)
+                self.incomplete = None
+                self.pending.discard(f_r)
+                self.ie.rule_removed(f_r, self)
+                removed_rules += 1
+
+            # the partner of a removed pair keeps supporting the dependent
+            # while another of its justifications still uses that partner
+            for f in f_r.supports_facts:
+                for fact, rule in f.supported_by.remove_member(f_r):
+                    for partner in (fact, rule):
+                        if not f.supported_by.involves(partner):
+                            partner.supports_facts.discard(f)
+                if not f.supported_by and not f.asserted:
+                    stack.append(f)
+            for r in f_r.supports_rules:
+                for fact, rule in r.supported_by.remove_member(f_r):
+                    for partner in (fact, rule):
+                        if not r.supported_by.involves(partner):
+                            partner.supports_rules.discard(r)
+                if not r.supported_by and not r.asserted:
+                    stack.append(r)
+
+        return removed_facts, removed_rules
 
-        #print("THIS IS IMPORTANT------------", len(f_r.supports_facts))
-
-        for f in f_r.supports_facts:
-            
-            ind3 = f.supported_by.index(f_r)
-            if ind3 % 2 == 1:
-                tmp = f.supported_by[ind3-1]
-                f.supported_by.remove(tmp)
-                tmp = f.supported_by[ind3-1]
-                f.supported_by.remove(tmp)
-            elif ind3 % 2 == 0:
-                tmp = f.supported_by[ind3]
-                f.supported_by.remove(tmp)
-
-                tmp = f.supported_by[ind3]
-                f.supported_by.remove(tmp)
-
-            if len(f.supported_by) == 0:
-                ind3 = self.facts.index(f)
-                temp = self.facts[ind3]
-                #self.facts.remove(self.facts[ind3])
-                self.kb_retract_helper(temp)
-                
-                
-        for r in f_r.supports_rules:
-
-            ind3 = r.supported_by.index(f_r)
-            if ind3 % 2 == 1:
-                tmp = r.supported_by[ind3-1]
-                r.supported_by.remove(tmp)
-                tmp = r.supported_by[ind3-1]
-                r.supported_by.remove(tmp)
-            elif ind3 % 2 == 0:
-                tmp = r.supported_by[ind3]
-                r.supported_by.remove(tmp)
-
-                tmp = r.supported_by[ind3]
-                r.supported_by.remove(tmp)
-
-            if (len(r.supported_by)) == 0:
-                ind3 = self.rules.index(r)
-                temp = self.rules[ind3]
-                #self.rules.remove(self.rules[ind3])
-                self.kb_retract_helper(temp)
-                
-
-        if isinstance(f_r, Fact) and len(f_r.supported_by) == 0:
-            del self.facts[ind]
-
-        
 
 class InferenceEngine(object):
+    def saturate(self, kb):
+        """Empty the agenda of a KB, running inference for each fact and rule
+            still pending in the order they were added
+
+        Args:
+            kb (KnowledgeBase) - The KnowledgeBase to saturate
+        """
+        while kb.agenda:
+            fact_rule = kb.agenda.popleft()
+            if fact_rule not in kb.pending:
+                continue
+            kb.pending.discard(fact_rule)
+            if isinstance(fact_rule, Fact):
+                self.fact_added(fact_rule, kb)
+            else:
+                self.rule_added(fact_rule, kb)
+
+    def fact_added(self, fact, kb):
+        """Run inference for a fact that was just added to the KB
+
+        Args:
+            fact (Fact) - The new fact
+            kb (KnowledgeBase) - The KnowledgeBase it was added to
+        """
+        for rule in kb.rule_index.candidates(fact.statement):
+            if rule not in kb.pending:
+                self.fc_infer(fact, rule, kb)
+
+    def rule_added(self, rule, kb):
+        """Run inference for a rule that was just added to the KB
+
+        Args:
+            rule (Rule) - The new rule
+            kb (KnowledgeBase) - The KnowledgeBase it was added to
+        """
+        for fact in kb.fact_index.candidates(rule.lhs[0]):
+            if fact not in kb.pending:
+                self.fc_infer(fact, rule, kb)
+
+    def restored(self, kb):
+        """Notification that the facts and rules of a KB were restored from a
+            snapshot without inference, nothing to do here: this engine keeps
+            no state of its own
+
+        Args:
+            kb (KnowledgeBase) - The restored KnowledgeBase
+        """
+        pass
+
+    def fact_removed(self, fact, kb):
+        """Notification that a fact was removed from the KB, nothing to do here
+
+        Args:
+            fact (Fact) - The removed fact
+            kb (KnowledgeBase) - The KnowledgeBase it was removed from
+        """
+        pass
+
+    def rule_removed(self, rule, kb):
+        """Notification that a rule was removed from the KB, nothing to do here
+
+        Args:
+            rule (Rule) - The removed rule
+            kb (KnowledgeBase) - The KnowledgeBase it was removed from
+        """
+        pass
+
     def fc_infer(self, fact, rule, kb):
         """Forward-chaining to infer new facts and rules
 
@@ -236,45 +666,223 @@ class InferenceEngine(object):
         Returns:
             Nothing            
         """
-        printv('Attempting to infer from {!r} and {!r} => {!r}', 1, verbose,
-            [fact.statement, rule.lhs, rule.rhs])
-        ####################################################
-        # Student code goes here
-
-        # 
-
-        binding = match(fact.statement, rule.lhs[0])
-        
-        if binding and len(rule.lhs) == 1:
-            s = instantiate(rule.rhs, binding)
-            # when do i construct fact with [fact,rule] vs [fact]???????????
-            
-            #only call constructor if new 
-            # find "f" in self.facts.. if not in self.facts construct new 
-            # otherwise append the supports_facts and supports_rules
-            
-
-            f = Fact(s, [fact,rule])
-            
-            fact.supports_facts.append(f)
-            rule.supports_facts.append(f)
-
-            kb.kb_assert(f)
-
-        elif binding and len(rule.lhs) > 1: 
-            s_r = instantiate(rule.rhs, binding)
-            
-            
-            lhs_statements = []
-            for i in rule.lhs:
-                lhs_statements.append(instantiate(i, binding))
-
-            del lhs_statements[0] 
-
-            # SAME LOGIC FOR RULE, BASED ON FACT
-            new_rule = Rule([lhs_statements, s_r], [fact, rule])
-        
-            rule.supports_rules.append(new_rule)
-            fact.supports_rules.append(new_rule)
-
-            kb.kb_assert(new_rule)
+        stats = kb.stats
+        if stats is not None and stats.timers:
+            start = time.perf_counter()
+        if fact.statement.predicate in kb.fact_index.nonground:
+            binding = match(fact.statement, rule.lhs[0])
+        else:
+            binding = rule.lhs[0].matcher().match(fact.statement)
+        if stats is not None:
+            stats.attempt(rule, bool(binding),
+                          time.perf_counter() - start if stats.timers else 0.0)
+        if binding:
+            self.fc_fire(fact, rule, binding, kb)
+
+    def fc_fire(self, fact, rule, binding, kb):
+        """Assert the fact or curried rule inferred from a fact matching the
+            first LHS statement of a rule
+
+        Args:
+            fact (Fact) - A fact from the KnowledgeBase
+            rule (Rule) - A rule from the KnowledgeBase
+            binding (Bindings) - Bindings from matching fact with rule.lhs[0]
+            kb (KnowledgeBase) - A KnowledgeBase
+
+        Returns:
+            Nothing
+        """
+        lhs = [instantiate(statement, binding) for statement in rule.lhs[1:]]
+        self.fc_assert(fact, rule, lhs, instantiate(rule.rhs, binding), kb)
+
+    def fc_assert(self, fact, rule, lhs, rhs, kb):
+        """Assert what a fact and rule infer once matched: a fact when the rule
+            had a single LHS statement, else the curried rule, and link it to
+            its supports
+
+        Args:
+            fact (Fact) - A fact from the KnowledgeBase
+            rule (Rule) - A rule from the KnowledgeBase
+            lhs (listof Statement) - remaining LHS statements, instantiated
+            rhs (Statement) - RHS statement, instantiated
+            kb (KnowledgeBase) - A KnowledgeBase
+
+        Returns:
+            Nothing
+        """
+        stats = kb.stats
+        if stats is not None and stats.timers:
+            start = time.perf_counter()
+        if not lhs:
+            derived = Fact(rhs, [(fact, rule)])
+            kb.kb_assert(derived)
+
+            # link to the fact the KB kept, derived is dropped if it was already known
+            f = kb._get_fact(derived)
+            writable(fact, 'supports_facts').add(f)
+            writable(rule, 'supports_facts').add(f)
+
+        else:
+            derived = Rule([lhs, rhs], [(fact, rule)])
+            kb.kb_assert(derived)
+
+            f = kb._get_rule(derived)
+            writable(rule, 'supports_rules').add(f)
+            writable(fact, 'supports_rules').add(f)
+        if stats is not None:
+            stats.fired(fact, rule, f, f is derived,
+                        time.perf_counter() - start if stats.timers else 0.0)
+
+
+class BackwardChainer(object):
+    """Answers a query by goal-directed backward chaining over the asserted
+        rules of a lazy or hybrid KB (KnowledgeBase.backward_rules), on top of
+        the facts in the KB. Subgoals on predicates whose facts are all
+        materialized are looked up directly. Answers of every subgoal are
+        tabled, keyed by the subgoal with its variables numbered in order of
+        appearance, and the evaluation is repeated until no table grows, so
+        recursive rules terminate.
+
+    Attributes:
+        kb (KnowledgeBase): the KB to answer from
+        incomplete (set): predicates that need backward chaining
+        tables (dictof dict): maps a subgoal key to an insertion-ordered set
+            (dict with None values) of the ground Statements answering it
+        evaluated (set): subgoal keys evaluated in the current pass
+        changed (bool): whether a table grew in the current pass
+    """
+    def __init__(self, kb):
+        """Constructor for BackwardChainer
+
+        Args:
+            kb (KnowledgeBase): the KB to answer from
+        """
+        super(BackwardChainer, self).__init__()
+        self.kb = kb
+        self.incomplete = kb._incomplete_predicates()
+        self.tables = {}
+        self.evaluated = set()
+        self.changed = False
+
+    def ask(self, goal):
+        """Find all ground statements in or derivable from the KB matching goal
+
+        Args:
+            goal (Statement): statement to prove, possibly with variables
+
+        Returns:
+            listof Statement: answers, facts of the KB first
+        """
+        self.tables = {}
+        while True:
+            self.evaluated = set()
+            self.changed = False
+            answers = self.solve(goal)
+            if not self.changed:
+                return answers
+
+    def solve(self, goal):
+        """Evaluate a subgoal once per pass and return its current answers
+
+        Args:
+            goal (Statement): subgoal, possibly with variables
+
+        Returns:
+            listof Statement: answers tabled for the subgoal so far
+        """
+        key = table_key(goal)
+        table = self.tables.setdefault(key, {})
+        if key in self.evaluated:
+            return list(table)
+        self.evaluated.add(key)
+
+        for fact in self.kb.fact_index.candidates(goal):
+            if match(goal, fact.statement):
+                self.add_answer(table, fact.statement)
+        if goal.predicate not in self.incomplete:
+            return list(table)
+        for rule in self.kb.backward_rules.candidates(goal):
+            bindings = bind_head(rule.rhs, goal)
+            if bindings is False:
+                continue
+            for body_bindings in self.solve_body(rule.lhs, bindings):
+                answer = instantiate(rule.rhs, body_bindings)
+                if match(goal, answer):
+                    self.add_answer(table, answer)
+        return list(table)
+
+    def solve_body(self, lhs, bindings):
+        """Prove the LHS statements of a rule left to right
+
+        Args:
+            lhs (listof Statement): statements to prove
+            bindings (Bindings): bindings from the rule head
+
+        Returns:
+            listof Bindings: bindings under which every statement holds
+        """
+        partial = [bindings]
+        for statement in lhs:
+            extended = []
+            for bindings in partial:
+                subgoal = instantiate(statement, bindings)
+                for answer in self.solve(subgoal):
+                    new = match(answer, subgoal)
+                    if new:
+                        extended.append(merge_bindings(bindings, new))
+            partial = extended
+        return partial
+
+    def add_answer(self, table, answer):
+        """Table a ground answer, noting that the tables changed if it is new
+        """
+        if answer in table or any(is_var(t) for t in answer.terms):
+            return
+        table[answer] = None
+        self.changed = True
+
+def table_key(statement):
+    """Key of a subgoal for tabling: predicate and terms, with variables
+        replaced by the position they first appear at, so subgoals that only
+        differ in variable names share a table
+    """
+    first_seen = {}
+    key = [statement.predicate]
+    for term in statement.terms:
+        element = term.term.element
+        if is_var(term):
+            key.append(first_seen.setdefault(element, len(first_seen)))
+        else:
+            key.append(element)
+    return tuple(key)
+
+def bind_head(rhs, goal):
+    """Bind the variables of a rule's RHS to the constants of a goal
+
+    Args:
+        rhs (Statement): RHS of a rule
+        goal (Statement): goal with the same predicate and arity
+
+    Returns:
+        Bindings|False: bindings for the rule, or False if the rule cannot
+            conclude the goal
+    """
+    bindings = Bindings()
+    for rhs_term, goal_term in zip(rhs.terms, goal.terms):
+        if is_var(goal_term):
+            continue
+        if is_var(rhs_term):
+            if not bindings.test_and_bind(rhs_term, goal_term):
+                return False
+        elif rhs_term != goal_term:
+            return False
+    return bindings
+
+def merge_bindings(bindings, other):
+    """New Bindings holding the bindings of both arguments
+    """
+    merged = Bindings()
+    for source in (bindings, other):
+        for variable, value in zip(source.variables, source.values):
+            merged.bind_term(variable, value)
+    return merged
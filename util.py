@@ -1,3 +1,5 @@
+import threading
+from contextlib import contextmanager
 import logical_classes as lc
 
 def is_var(var):
@@ -59,6 +61,189 @@ def match_recursive(terms1, terms2, bindings):  # recursive...
         return False
     return match_recursive(terms1[1:], terms2[1:], bindings)
 
+class Matcher(object):
+    """Matcher compiled from a pattern statement (a rule LHS statement or a
+        query). Knows up front which positions hold constants, which hold the
+        first occurrence of a variable and which repeat an earlier variable, so
+        matching a ground statement is a few flat comparisons with no
+        recursion, slicing or allocation unless it succeeds. For ground
+        statements, matcher.match(s) gives the same bindings as match(s, pattern).
+
+    Attributes:
+        predicate (str): predicate of the pattern
+        arity (int): number of terms of the pattern
+        constants (tupleof (int, int)): positions holding constants and the
+            symbol id of their value
+        slots (dictof int): slot of each variable of the pattern, by name,
+            shared by the Bindings this matcher makes
+        variables (tupleof Variable): variable of each slot
+        positions (tupleof int): position of the first occurrence of the
+            variable of each slot
+        repeats (tupleof (int, int)): positions repeating a variable, with the
+            position of its first occurrence
+    """
+    def __init__(self, pattern):
+        """Constructor for Matcher
+
+        Args:
+            pattern (Statement): statement to compile
+        """
+        super(Matcher, self).__init__()
+        self.predicate = pattern.predicate
+        self.arity = len(pattern.terms)
+        constants = []
+        variables = []
+        positions = []
+        repeats = []
+        first_seen = {}
+        self.slots = {}
+        for pos, term in enumerate(pattern.terms):
+            element = term.term.element
+            if not is_var(term):
+                constants.append((pos, term.term.id))
+            elif element in first_seen:
+                repeats.append((pos, first_seen[element]))
+            else:
+                first_seen[element] = pos
+                self.slots[element] = len(variables)
+                variables.append(term.term)
+                positions.append(pos)
+        self.constants = tuple(constants)
+        self.variables = tuple(variables)
+        self.positions = tuple(positions)
+        self.repeats = tuple(repeats)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Matcher({!r}, {!r}, {!r}, {!r})'.format(
+                self.predicate, self.constants, self.variables, self.repeats)
+
+    def match(self, statement):
+        """Match a ground statement against the compiled pattern
+
+        Args:
+            statement (Statement): ground statement, e.g. of a fact
+
+        Returns:
+            Bindings|False: bindings of the pattern's variables, or False
+        """
+        if statement.predicate != self.predicate:
+            return False
+        terms = statement.terms
+        if len(terms) != self.arity:
+            return False
+        for pos, symbol in self.constants:
+            if terms[pos].term.id != symbol:
+                return False
+        for pos, first in self.repeats:
+            if terms[pos].term.id != terms[first].term.id:
+                return False
+        return lc.Bindings(self.slots, self.variables,
+                           [terms[pos] for pos in self.positions])
+
+class ReadWriteLock(object):
+    """Readers-writer lock: any number of threads may read at once, or a
+        single thread may write. Writers are preferred, once one is waiting
+        new readers wait as well, so a steady stream of readers cannot starve
+        writers. Reading and writing are reentrant for the thread holding them
+        and the writing thread may also read.
+
+    Attributes:
+        condition (threading.Condition): guards the fields below
+        readers (int): number of threads reading
+        writer (int|None): ident of the writing thread
+        depth (int): how many times the writing thread holds the lock
+        waiting (int): number of threads waiting to write
+        local (threading.local): read depth of each thread
+    """
+    def __init__(self):
+        """Constructor for ReadWriteLock
+        """
+        super(ReadWriteLock, self).__init__()
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting = 0
+        self.local = threading.local()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'ReadWriteLock({!r} readers, writer {!r}, {!r} waiting)'.format(
+                self.readers, self.writer, self.waiting)
+
+    @contextmanager
+    def reading(self):
+        """Context manager holding the lock for reading
+        """
+        me = threading.get_ident()
+        nested = getattr(self.local, 'depth', 0)
+        if nested or self.writer == me:
+            self.local.depth = nested + 1
+            try:
+                yield
+            finally:
+                self.local.depth = nested
+            return
+        with self.condition:
+            while self.writer is not None or self.waiting:
+                self.condition.wait()
+            self.readers += 1
+        self.local.depth = 1
+        try:
+            yield
+        finally:
+            self.local.depth = 0
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        """Context manager holding the lock for writing
+        """
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer != me:
+                if getattr(self.local, 'depth', 0):
+                    raise RuntimeError("cannot write while reading in the same thread")
+                self.waiting += 1
+                try:
+                    while self.writer is not None or self.readers:
+                        self.condition.wait()
+                finally:
+                    self.waiting -= 1
+                self.writer = me
+            self.depth += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.depth -= 1
+                if not self.depth:
+                    self.writer = None
+                    self.condition.notify_all()
+
+class NoLock(object):
+    """Stand-in for ReadWriteLock that does no locking, for KBs used from a
+        single thread
+    """
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'NoLock()'
+
+    @contextmanager
+    def reading(self):
+        """Context manager doing nothing
+        """
+        yield
+
+    writing = reading
+
 def instantiate(statement, bindings):
     """Generate Statement from given statement and bindings. Constructed statement
         has bound values for variables if they exist in bindings.
@@ -69,8 +254,7 @@ def instantiate(statement, bindings):
     """
     def handle_term(term):
         if is_var(term):
-            bound_value = bindings.bound_to(term.term)
-            return lc.Term(bound_value) if bound_value else term
+            return bindings.term_for(term.term) or term
         else:
             return term
 
@@ -87,16 +271,3 @@ def factq(element):
         bool
     """
     return isinstance(element, lc.Fact)
-
-def printv(message, level, verbose, data=[]):
-    """Prints given message formatted with data if passed in verbose flag is greater than level
-
-    Args:
-        message (str): message to print, if format string data should have values
-            to format with
-        level (int): value of verbose required to print
-        verbose (int): value of verbose flag
-        data (listof any): optional data to format message with
-    """
-    if verbose > level:
-        print(message.format(*data) if data else message)
\ No newline at end of file